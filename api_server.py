@@ -1,7 +1,9 @@
-from app import webserver
+from app import create_app
+
 # Your code will go in the app/ directory.
 # Have a look in:
 #   * __init__.py
 #   * routes.py
 #   * data_ingestor.py
 #   * task_runner.py
+webserver = create_app()
@@ -1,43 +1,267 @@
+"""
+This package implements the webserver. Importing it has no side effects:
+the webserver is built by create_app(config), which sets up logging, the job
+scheduler and the thread pool, and loads the dataset, optionally in the background.
+"""
+
+import atexit
 import os
 import logging
+import queue
 import time
-from queue import Queue
-from threading import Lock
-from logging.handlers import RotatingFileHandler
+from threading import Thread
+from logging.handlers import QueueListener, RotatingFileHandler
 from flask import Flask
 from app.task_runner import ThreadPool
-from app.data_ingestor import DataIngestor
+from app.dataset_registry import DatasetRegistry
 from app.job_counter import JobCounter
+from app.result_cache import ResultCache
+from app.result_store import FileResultStore, MemoryResultStore
+from app.job_coalescer import JobCoalescer
+from app.job_journal import JobJournal
+from app.metrics import Metrics
+from app.job_table import JobTable
+from app.encoding import dumps
+from app.log_pipeline import JsonFormatter, QueueLogHandler, SamplingFilter, parse_sampling
+from app.job_notifier import JobNotifier
+from app.job_scheduler import JobScheduler
+from app.process_backend import ProcessBackend, ProcessTaskRunner
+
+def default_config() -> dict:
+    """
+    Returns the default configuration, read from the environment variables.
+    """
+
+    return {
+        'CSV_PATH': './nutrition_activity_obesity_usa_subset.csv',
+        'LOG_FILE': 'webserver.log',
+        # /api/admin/reload only loads csv files from this folder, the folder of CSV_PATH
+        # by default
+        'DATA_DIR': os.environ.get('DATA_DIR'),
+        # token expected in the X-Admin-Token header of the admin endpoints, which are
+        # disabled without one
+        'ADMIN_TOKEN': os.environ.get('ADMIN_TOKEN', ''),
+        # 'text' or 'json', one json object per line
+        'LOG_FORMAT': os.environ.get('LOG_FORMAT', 'text'),
+        # path -> N, only the info lines of one request out of N are logged for the path
+        'LOG_SAMPLING': parse_sampling(os.environ.get('LOG_SAMPLING', '')),
+        # records waiting for the log thread, more are dropped
+        'LOG_QUEUE_SIZE': int(os.environ.get('LOG_QUEUE_SIZE', '10000')),
+        # None uses TP_NUM_OF_THREADS or the hardware concurrency
+        'NUM_THREADS': None,
+        # keep only the aggregates in memory, for very large csv files
+        'INGEST_STREAMING': os.environ.get('INGEST_STREAMING') == '1',
+        # binary snapshot written next to the csv file
+        'DATA_SNAPSHOT': os.environ.get('DATA_SNAPSHOT') != '0',
+        # number of processes that parse the csv file
+        'INGEST_WORKERS': int(os.environ.get('INGEST_WORKERS', '1')),
+        # load the dataset after create_app returns, reporting progress on /api/ready
+        'LOAD_IN_BACKGROUND': os.environ.get('LOAD_IN_BACKGROUND') == '1',
+        # jobs posted while loading are queued instead of answered with 503
+        'QUEUE_WHILE_LOADING': os.environ.get('QUEUE_WHILE_LOADING') == '1',
+        # limits of the LRU cache of job results, 0 disables it
+        'RESULT_CACHE_ENTRIES': int(os.environ.get('RESULT_CACHE_ENTRIES', '1024')),
+        'RESULT_CACHE_BYTES': int(os.environ.get('RESULT_CACHE_BYTES', str(64 * 1024 * 1024))),
+        # identical jobs posted while one is queued or running share its result
+        'COALESCE_JOBS': os.environ.get('COALESCE_JOBS') != '0',
+        # X-Client-Id -> weight in the fair queuing of jobs, other clients have weight 1
+        'CLIENT_WEIGHTS': {},
+        # interactive jobs served for every bulk job while both classes have queued jobs
+        'INTERACTIVE_SHARE': int(os.environ.get('INTERACTIVE_SHARE', '4')),
+        # 'memory' keeps recent results in memory and spills older ones to RESULT_SEGMENT,
+        # 'files' writes every result to results/<job_id>
+        'RESULT_STORE': os.environ.get('RESULT_STORE', 'memory'),
+        'RESULT_SEGMENT': os.environ.get('RESULT_SEGMENT', 'results.segment'),
+        'RESULT_DIR': os.environ.get('RESULT_DIR', 'results'),
+        # the oldest spilled results are dropped when the segment grows over this size
+        'RESULT_SEGMENT_BYTES': int(os.environ.get('RESULT_SEGMENT_BYTES',
+                                                   str(1024 * 1024 * 1024))),
+        'RESULT_MEMORY_BYTES': int(os.environ.get('RESULT_MEMORY_BYTES',
+                                                  str(64 * 1024 * 1024))),
+        # seconds a result stays in memory before it is spilled
+        'RESULT_TTL': float(os.environ.get('RESULT_TTL', '300')),
+        # append-only journal of the jobs, replayed on startup, '' disables it
+        'JOB_JOURNAL': os.environ.get('JOB_JOURNAL', ''),
+        'JOURNAL_FSYNC_INTERVAL': float(os.environ.get('JOURNAL_FSYNC_INTERVAL', '0.05')),
+        'JOURNAL_COMPACT_RECORDS': int(os.environ.get('JOURNAL_COMPACT_RECORDS', '100000')),
+        # a job started this many times without being done is not queued again
+        'JOB_MAX_ATTEMPTS': int(os.environ.get('JOB_MAX_ATTEMPTS', '3')),
+        # longest wait of /api/get_results?wait= and of an /api/events stream, in seconds
+        'MAX_WAIT': float(os.environ.get('MAX_WAIT', '30')),
+        # jobs kept in the job table, the oldest jobs over it are evicted
+        'JOB_RETENTION': int(os.environ.get('JOB_RETENTION', '1000000')),
+        # largest page of /api/jobs
+        'MAX_JOBS_PAGE': int(os.environ.get('MAX_JOBS_PAGE', '10000')),
+        # largest number of queries accepted by /api/batch
+        'MAX_BATCH_QUERIES': int(os.environ.get('MAX_BATCH_QUERIES', '10000')),
+        # 'process' computes the jobs in worker processes that share the dataset memory
+        'EXECUTION_BACKEND': os.environ.get('EXECUTION_BACKEND', 'thread'),
+        # None uses the hardware concurrency
+        'PROCESS_WORKERS': int(os.environ['PROCESS_WORKERS'])
+                           if 'PROCESS_WORKERS' in os.environ else None,
+    }
+
+def setup_logger(logging_file: str, log_format: str = 'text', sampling: dict = None,
+                 queue_size: int = 10000) -> logging.Logger:
+    """
+    Configures the webserver logger to write to a rotating log file. The request threads
+    only queue the records, a background thread formats and writes them.
+    """
+
+    if os.path.exists(logging_file):
+        os.remove(logging_file)
+    format = '%(asctime)s - %(levelname)s - %(message)s'
+    # set 5 MB max size, 3 istoric files
+    handler = RotatingFileHandler(logging_file, maxBytes = 5 * 1024 * 1024, backupCount = 3)
+    handler.setLevel(logging.INFO)
+    if log_format == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(format)
+        formatter.converter = time.gmtime
+    handler.setFormatter(formatter)
+    queue_handler = QueueLogHandler(queue.Queue(queue_size))
+    if sampling:
+        queue_handler.addFilter(SamplingFilter(sampling))
+    queue_handler.listener = QueueListener(queue_handler.queue, handler)
+    queue_handler.listener.start()
+    logger = logging.getLogger('webserver')
+    logger.setLevel(logging.INFO)
+    # a new app replaces the handlers of the previous one
+    for old_handler in list(logger.handlers):
+        logger.removeHandler(old_handler)
+        old_handler.close()
+    logger.addHandler(queue_handler)
+    # the records still queued are written when the server exits
+    atexit.register(queue_handler.close)
+    return logger
+
+def recover_jobs(webserver: Flask):
+    """
+    Replays the job journal: restores the job counter and the status of the old jobs,
+    and queues the jobs that were not done again. A job is only done in the journal once
+    its result is on disk, so the jobs whose results were lost in memory by a crash are
+    computed again. Jobs that were started too many times are done with an error
+    instead, so a job that crashes the server is not retried forever.
+    """
+
+    from app.routes import Job
+
+    counter, pending = webserver.job_journal.recover()
+    webserver.job_counter.counter = counter
+    # the results of the done jobs are found in the result store, if it kept them
+    webserver.job_status.fill(counter, "done")
+    for record in pending:
+        if record['attempts'] >= webserver.config['JOB_MAX_ATTEMPTS']:
+            webserver.logger.error("[ERROR] Job %s failed %d times, not queued again",
+                                   record['id'], record['attempts'])
+            webserver.result_store.put(record['id'], dumps(
+                {"status": "error",
+                 "reason": f"job failed after {record['attempts']} attempts"}))
+            continue
+        webserver.job_status.add(record['id'], record['type'])
+        webserver.job_queue.put(Job(job_id=record['id'], data=record['data'],
+                                    type=record['type'], status="running",
+                                    client_id=record['client_id'],
+                                    priority=record['priority']))
+    queued = webserver.job_queue.qsize()
+    # /api/num_jobs counts the jobs that are not done from the job counter
+    webserver.metrics.recovered_done = counter - queued
+    webserver.logger.info("Recovered %d jobs, queued %d again", counter, queued)
+
+def create_app(config: dict = None) -> Flask:
+    """
+    Builds the webserver. The config overrides the values of default_config().
+    """
+
+    from app.routes import api
+
+    webserver = Flask(__name__)
+    webserver.config.update(default_config())
+    webserver.config.update(config or {})
+    if not webserver.config['DATA_DIR']:
+        csv_path = os.path.abspath(webserver.config['CSV_PATH'])
+        webserver.config['DATA_DIR'] = os.path.dirname(csv_path)
+    webserver.logger = setup_logger(webserver.config['LOG_FILE'], webserver.config['LOG_FORMAT'],
+                                    webserver.config['LOG_SAMPLING'],
+                                    webserver.config['LOG_QUEUE_SIZE'])
+
+    webserver.job_counter = JobCounter()
+    # priority classes, with weighted fair queuing between the X-Client-Id of the jobs
+    webserver.job_queue = JobScheduler(webserver.config['CLIENT_WEIGHTS'],
+                                       webserver.config['INTERACTIVE_SHARE'])
+    # create a map for job_ids witg running/done status
+    # status and type of the jobs, the oldest jobs are evicted over JOB_RETENTION
+    webserver.job_status = JobTable(webserver.config['JOB_RETENTION'])
+    webserver.shutdown = False
+    # the dataset can be replaced at runtime through the admin endpoints
+    webserver.datasets = DatasetRegistry(streaming=webserver.config['INGEST_STREAMING'],
+                                         use_snapshot=webserver.config['DATA_SNAPSHOT'],
+                                         workers=webserver.config['INGEST_WORKERS'])
+
+    webserver.result_cache = ResultCache(webserver.config['RESULT_CACHE_ENTRIES'],
+                                         webserver.config['RESULT_CACHE_BYTES'])
+
+    webserver.job_coalescer = JobCoalescer() if webserver.config['COALESCE_JOBS'] else None
+
+    if webserver.config['RESULT_STORE'] == 'files':
+        if not os.path.exists(webserver.config['RESULT_DIR']):
+            os.mkdir(webserver.config['RESULT_DIR'])
+        webserver.result_store = FileResultStore(webserver.config['RESULT_DIR'],
+                                                 webserver.config['JOURNAL_FSYNC_INTERVAL'])
+    else:
+        webserver.result_store = MemoryResultStore(webserver.config['RESULT_SEGMENT'],
+                                                   webserver.config['RESULT_MEMORY_BYTES'],
+                                                   webserver.config['RESULT_TTL'],
+                                                   webserver.config['RESULT_SEGMENT_BYTES'],
+                                                   webserver.config['JOURNAL_FSYNC_INTERVAL'])
+    # the results still in memory are written to disk and synced when the server exits
+    atexit.register(webserver.result_store.close)
+
+    # completion events for long-poll requests and event streams
+    webserver.job_notifier = JobNotifier()
+
+    runner_options = {}
+    webserver.process_backend = None
+    if webserver.config['EXECUTION_BACKEND'] == 'process':
+        webserver.process_backend = ProcessBackend(webserver.config['PROCESS_WORKERS'])
+        runner_options = {'runner_class': ProcessTaskRunner,
+                          'backend': webserver.process_backend}
+
+    # latency histograms and counters of the runners, served by /metrics
+    webserver.metrics = Metrics()
+    webserver.job_journal = None
+    if webserver.config['JOB_JOURNAL']:
+        webserver.job_journal = JobJournal(webserver.config['JOB_JOURNAL'],
+                                           webserver.config['JOURNAL_FSYNC_INTERVAL'],
+                                           webserver.config['JOURNAL_COMPACT_RECORDS'])
+        # jobs are done in the journal when their results are synced to disk
+        webserver.result_store.on_durable = webserver.job_journal.done
+        recover_jobs(webserver)
+
+    webserver.tasks_runner = ThreadPool(webserver.job_queue, webserver.job_status,
+                                        webserver.datasets, webserver.config['NUM_THREADS'],
+                                        cache=webserver.result_cache,
+                                        coalescer=webserver.job_coalescer,
+                                        notifier=webserver.job_notifier,
+                                        result_store=webserver.result_store,
+                                        journal=webserver.job_journal,
+                                        metrics=webserver.metrics, **runner_options)
+    webserver.tasks_runner.start()
+    webserver.register_blueprint(api)
+
+    csv_path = webserver.config['CSV_PATH']
+    if webserver.config['LOAD_IN_BACKGROUND']:
+        Thread(target=webserver.datasets.load, args=(csv_path,), daemon=True).start()
+    elif not webserver.datasets.load(csv_path):
+        raise RuntimeError(f"Could not load the dataset from {csv_path}")
+
+    webserver.logger.info('Server initialized')
+    return webserver
 
-if not os.path.exists('results'):
-    os.mkdir('results')
-
-webserver = Flask(__name__)
-webserver.job_counter = JobCounter()
-webserver.job_queue = Queue()
-# create a map for job_ids witg running/done status
-webserver.job_status = {}
-# create a lock for the job_counter
-webserver.shutdown = False
-webserver.data_ingestor = DataIngestor("./nutrition_activity_obesity_usa_subset.csv")
-
-webserver.tasks_runner = ThreadPool(webserver.job_queue, webserver.job_status,
-                                    webserver.data_ingestor)
-
-webserver.tasks_runner.start()
-
-logging_file = 'webserver.log'
-if os.path.exists(logging_file):
-    os.remove(logging_file)
-format = '%(asctime)s - %(levelname)s - %(message)s'
-# set 5 MB max size, 3 istoric files
-handler = RotatingFileHandler(logging_file, maxBytes = 5 * 1024 * 1024, backupCount = 3)
-handler.setLevel(logging.INFO)
-formatter = logging.Formatter(format)
-formatter.converter = time.gmtime
-handler.setFormatter(formatter)
-webserver.logger = logging.getLogger('webserver')
-webserver.logger.setLevel(logging.INFO)
-webserver.logger.addHandler(handler)
-webserver.logger.info('Server initialized')
-from app import routes
+def __getattr__(name):
+    # keep `from app import webserver` working, the default app is built on first use
+    if name == 'webserver':
+        globals()['webserver'] = create_app()
+        return globals()['webserver']
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
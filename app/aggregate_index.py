@@ -0,0 +1,241 @@
+"""
+This module defines the AggregateIndex class, which keeps precomputed (sum, count) pairs
+of the data values for every grouping used by the endpoints. The index is built once,
+after the csv file is loaded, so the endpoints only do dictionary lookups.
+"""
+
+from threading import Lock
+from app.aggregation import Grouping, StatsReducer, aggregate, copy_tree, merge_tree, store_rows
+from app.column_store import ColumnStore
+
+STRATIFICATION = ('stratification_category1', 'stratification1')
+PERIOD = ('year_start', 'year_end')
+
+# name -> group-by keys of the precomputed groupings
+GROUPINGS = {
+    # question -> [sum, count]
+    'by_question': ('question',),
+    # question -> location -> [sum, count]
+    'by_location': ('question', 'location'),
+    # question -> location -> (stratification_category1, stratification1) -> [sum, count]
+    'by_category': ('question', 'location', STRATIFICATION),
+    # question -> (stratification_category1, stratification1) -> [sum, count]
+    'by_stratification': ('question', STRATIFICATION),
+    # question -> location -> year_start -> [sum, count], the time series of every state
+    'by_year': ('question', 'location', 'year_start'),
+}
+
+# name -> group-by keys of the precomputed statistics (count, stddev, quantiles, ...)
+STATISTICS = {
+    # question -> location -> [count, mean, squared deviations, digest]
+    'stats_by_location': ('question', 'location'),
+    # question -> (stratification_category1, stratification1) -> [count, mean, ...]
+    'stats_by_stratification': ('question', STRATIFICATION),
+}
+
+class AggregateIndex:
+    """
+    This class keeps the [sum, count] of the data values, grouped by:
+    - question
+    - question and location
+    - question, location, stratification category and stratification
+    - question, stratification category and stratification
+    - question, location and year
+    and the statistics of the values (standard deviation, median, p90) by question and
+    location, and by question and stratification.
+    Every grouping also has a copy split by (year_start, year_end) period, right under
+    the question, so a year range merges the few periods that overlap it instead of
+    scanning the rows. The groupings by period are as costly to build as the others and
+    only serve the ranged requests, so an index built from a store computes them with a
+    second pass over the rows, on the first ranged lookup.
+    The groupings of a pass are all computed together by the aggregation engine.
+    """
+
+    def __init__(self):
+        self.groupings = {name: Grouping(keys) for name, keys in GROUPINGS.items()}
+        self.groupings.update({name: Grouping(keys, StatsReducer)
+                               for name, keys in STATISTICS.items()})
+        # name -> the grouping split by period: question -> period -> other keys -> state
+        self.periods = self.empty_periods()
+        # stores and lists of rows that are not in the periods yet
+        self.pending = []
+        self.lock = Lock()
+
+    def empty_periods(self) -> dict:
+        """
+        Returns the groupings by period, without any rows.
+        """
+
+        return {name: Grouping(grouping.keys[:1] + (PERIOD,) + grouping.keys[1:],
+                               grouping.reducer)
+                for name, grouping in self.groupings.items()}
+
+    @property
+    def by_question(self) -> dict:
+        """
+        question -> [sum, count]
+        """
+
+        return self.groupings['by_question'].table
+
+    @property
+    def by_location(self) -> dict:
+        """
+        question -> location -> [sum, count]
+        """
+
+        return self.groupings['by_location'].table
+
+    @property
+    def by_category(self) -> dict:
+        """
+        question -> location -> (stratification_category1, stratification1) -> [sum, count]
+        """
+
+        return self.groupings['by_category'].table
+
+    @property
+    def by_stratification(self) -> dict:
+        """
+        question -> (stratification_category1, stratification1) -> [sum, count]
+        """
+
+        return self.groupings['by_stratification'].table
+
+    @classmethod
+    def build(cls, store: ColumnStore):
+        """
+        Builds the index with a single pass over the rows of the store, in their order.
+        """
+
+        index = cls()
+        aggregate(store_rows(store), list(index.groupings.values()))
+        # the store is read again when the periods are needed
+        index.pending.append(store)
+        return index
+
+    def add_rows(self, rows):
+        """
+        Folds rows (tuples in the order of aggregation.FIELDS) into the index.
+        """
+
+        if not self.pending:
+            aggregate(rows, list(self.groupings.values()) + list(self.periods.values()))
+            return
+        rows = list(rows)
+        aggregate(rows, list(self.groupings.values()))
+        self.pending.append(rows)
+
+    def build_periods(self) -> dict:
+        """
+        Folds the pending rows into the groupings by period, once, and returns them.
+        """
+
+        if self.pending:
+            with self.lock:
+                for rows in self.pending:
+                    if isinstance(rows, ColumnStore):
+                        rows = store_rows(rows)
+                    aggregate(rows, list(self.periods.values()))
+                # the readers that see no pending rows read the periods without the lock
+                self.pending = []
+        return self.periods
+
+    def copy(self, rows=None):
+        """
+        Returns a copy of the index that can be updated without changing this one. With
+        rows (tuples in the order of aggregation.FIELDS), only the groups of those rows
+        are copied and may be updated; the others are shared with this index, which is
+        never updated again.
+        """
+
+        index = AggregateIndex.__new__(AggregateIndex)
+        index.groupings = {name: grouping.copy(rows)
+                           for name, grouping in self.groupings.items()}
+        index.lock = Lock()
+        with self.lock:
+            index.pending = list(self.pending)
+            if index.pending:
+                index.periods = self.empty_periods()
+            else:
+                index.periods = {name: grouping.copy(rows)
+                                 for name, grouping in self.periods.items()}
+        return index
+
+    def __getstate__(self) -> dict:
+        # a pickled index carries its periods, not the store they are built from
+        self.build_periods()
+        state = dict(self.__dict__)
+        del state['lock']
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.lock = Lock()
+
+    def lookup(self, name: str, keys: tuple, years: tuple = None):
+        """
+        Returns the subtree (or the state) under the given keys of a grouping, or None.
+        The first key is the question. With years = (year_from, year_to), either of
+        them None for an open end, only the rows whose period overlaps the range are
+        counted: the subtrees of the overlapping periods are merged into a new one.
+        """
+
+        if years is None:
+            return self.groupings[name].lookup(*keys)
+        year_from, year_to = years
+        grouping = self.build_periods()[name]
+        # levels of keys under the given ones, 0 for a state
+        depth = len(grouping.keys) - len(keys) - 1
+        merged = None
+        for (year_start, year_end), node in (grouping.lookup(keys[0]) or {}).items():
+            if year_to is not None and year_start > year_to:
+                continue
+            if year_from is not None and year_end < year_from:
+                continue
+            for key in keys[1:]:
+                node = node.get(key)
+                if node is None:
+                    break
+            if node is None:
+                continue
+            if merged is None:
+                merged = copy_tree(node, depth, grouping.reducer)
+            else:
+                merge_tree(merged, node, depth, grouping.reducer)
+        return merged
+
+    def question_total(self, question: str):
+        """
+        Returns the [sum, count] of a question.
+        """
+
+        return self.by_question.get(question, [0.0, 0])
+
+    def location_totals(self, question: str) -> dict:
+        """
+        Returns the [sum, count] of every location for a question.
+        """
+
+        return self.by_location.get(question, {})
+
+    def location_total(self, question: str, location: str):
+        """
+        Returns the [sum, count] of a question for a location.
+        """
+
+        return self.location_totals(question).get(location, [0.0, 0])
+
+    def category_totals(self, question: str) -> dict:
+        """
+        Returns the [sum, count] of every location and stratification for a question.
+        """
+
+        return self.by_category.get(question, {})
+
+    def stratification_totals(self, question: str) -> dict:
+        """
+        Returns the [sum, count] of every stratification for a question, over all locations.
+        """
+
+        return self.by_stratification.get(question, {})
@@ -0,0 +1,274 @@
+"""
+This module implements a generic group-by aggregation engine.
+A Grouping describes what to compute: an optional filter, the group-by keys and
+a reducer. aggregate() computes any number of groupings in a single pass over
+the rows, so adding a statistic does not add another scan of the data.
+
+Rows are tuples with the values of FIELDS, in that order. The result of a grouping
+is a tree of nested dicts, one level per key, with a reducer state at the leaves.
+A key level can be a single field or a tuple of fields, for example
+("question", "location", ("stratification_category1", "stratification1")).
+"""
+
+import math
+from operator import itemgetter
+from app.column_store import ColumnStore
+from app.sketches import TDigest
+
+FIELDS = ('question', 'location', 'stratification_category1', 'stratification1',
+          'year_start', 'year_end', 'data_value')
+VALUE = FIELDS.index('data_value')
+
+class MeanReducer:
+    """
+    Reducer that keeps the [sum, count] of the values.
+    """
+
+    @staticmethod
+    def new():
+        """
+        Returns an empty state.
+        """
+
+        return [0.0, 0]
+
+    @staticmethod
+    def add(state, value: float):
+        """
+        Adds a value to a state.
+        """
+
+        state[0] += value
+        state[1] += 1
+
+    @staticmethod
+    def merge(state, other):
+        """
+        Adds the values of another state to a state.
+        """
+
+        state[0] += other[0]
+        state[1] += other[1]
+
+    @staticmethod
+    def copy(state):
+        """
+        Returns an independent copy of a state.
+        """
+
+        return list(state)
+
+    @staticmethod
+    def result(state) -> float:
+        """
+        Returns the mean of a state, or 0 for an empty state.
+        """
+
+        return state[0] / state[1] if state[1] > 0 else 0.0
+
+class StatsReducer:
+    """
+    Reducer that keeps the [count, mean, sum of squared deviations, digest] of the values.
+    The mean and deviations are updated with Welford's algorithm, which stays accurate
+    for large groups, and the TDigest estimates the quantiles with bounded memory.
+    States of different rows can be merged, so groups can be combined.
+    """
+
+    @staticmethod
+    def new():
+        """
+        Returns an empty state.
+        """
+
+        return [0, 0.0, 0.0, TDigest()]
+
+    @staticmethod
+    def add(state, value: float):
+        """
+        Adds a value to a state.
+        """
+
+        state[0] += 1
+        delta = value - state[1]
+        state[1] += delta / state[0]
+        state[2] += delta * (value - state[1])
+        state[3].add(value)
+
+    @staticmethod
+    def merge(state, other):
+        """
+        Adds the values of another state to a state.
+        """
+
+        count = state[0] + other[0]
+        if count == 0:
+            return
+        delta = other[1] - state[1]
+        state[2] += other[2] + delta * delta * state[0] * other[0] / count
+        state[1] += delta * other[0] / count
+        state[0] = count
+        state[3].merge(other[3])
+
+    @staticmethod
+    def copy(state):
+        """
+        Returns an independent copy of a state.
+        """
+
+        return [state[0], state[1], state[2], state[3].copy()]
+
+    @staticmethod
+    def result(state) -> dict:
+        """
+        Returns the count, mean, sample standard deviation, extremes, median and 90th
+        percentile of a state.
+        """
+
+        count, mean, squares, digest = state
+        if count == 0:
+            return {"count": 0, "mean": 0.0, "stddev": 0.0, "min": 0.0, "max": 0.0,
+                    "median": 0.0, "p90": 0.0}
+        return {"count": count, "mean": mean,
+                "stddev": math.sqrt(squares / (count - 1)) if count > 1 else 0.0,
+                "min": digest.min, "max": digest.max,
+                "median": digest.quantile(0.5), "p90": digest.quantile(0.9)}
+
+def field_getter(level):
+    """
+    Returns a function that extracts the key of a level from a row.
+    """
+
+    if isinstance(level, tuple):
+        return itemgetter(*(FIELDS.index(field) for field in level))
+    return itemgetter(FIELDS.index(level))
+
+class Grouping:
+    """
+    This class describes one aggregation: a filter, the group-by keys and the reducer.
+    The filter is a dict of field -> required value.
+    """
+
+    def __init__(self, keys: tuple, reducer=MeanReducer, where: dict = None):
+        self.keys = keys
+        self.reducer = reducer
+        self.where = [(FIELDS.index(field), value) for field, value in (where or {}).items()]
+        self.getters = [field_getter(level) for level in keys]
+        self.table = {}
+
+    def copy(self, rows=None):
+        """
+        Returns a copy of the grouping whose table can be updated independently. With
+        rows, only the groups those rows fall in are copied, along their path of keys, so
+        they can be added to the copy; the other groups are shared with this grouping.
+        """
+
+        grouping = Grouping.__new__(Grouping)
+        grouping.keys = self.keys
+        grouping.reducer = self.reducer
+        grouping.where = self.where
+        grouping.getters = self.getters
+        if rows is None:
+            grouping.table = copy_tree(self.table, len(self.keys), self.reducer)
+            return grouping
+        grouping.table = dict(self.table)
+        # ids of the nodes that belong to the copy already
+        copied = set()
+        last = len(self.getters) - 1
+        for row in rows:
+            node = grouping.table
+            for depth, getter in enumerate(self.getters):
+                key = getter(row)
+                child = node.get(key)
+                if child is None:
+                    # a new group, created by the aggregation
+                    break
+                if id(child) not in copied:
+                    child = self.reducer.copy(child) if depth == last else dict(child)
+                    copied.add(id(child))
+                    node[key] = child
+                node = child
+        return grouping
+
+    def lookup(self, *keys):
+        """
+        Returns the subtree (or the reducer state) under the given keys, or None.
+        """
+
+        node = self.table
+        for key in keys:
+            node = node.get(key)
+            if node is None:
+                return None
+        return node
+
+def copy_tree(node, depth: int, reducer):
+    """
+    Returns an independent copy of a subtree with depth levels of keys above the states.
+    """
+
+    if depth == 0:
+        return reducer.copy(node)
+    return {key: copy_tree(child, depth - 1, reducer) for key, child in node.items()}
+
+def merge_tree(node, other, depth: int, reducer):
+    """
+    Adds the states of a subtree to the states of another one, with the same depth,
+    key by key. Returns the updated subtree.
+    """
+
+    if depth == 0:
+        reducer.merge(node, other)
+        return node
+    for key, child in other.items():
+        if key in node:
+            merge_tree(node[key], child, depth - 1, reducer)
+        else:
+            node[key] = copy_tree(child, depth - 1, reducer)
+    return node
+
+def aggregate(rows, groupings: list):
+    """
+    Folds the rows into every grouping, with a single pass over the rows.
+    """
+
+    # (filter, getters of the inner levels, getter of the last level, table,
+    #  new state of the reducer, add of the reducer) per grouping
+    plans = [(grouping.where, grouping.getters[:-1], grouping.getters[-1], grouping.table,
+              grouping.reducer.new, grouping.reducer.add) for grouping in groupings]
+    for row in rows:
+        value = row[VALUE]
+        for where, inner, last, table, new, add in plans:
+            if where and any(row[field] != required for field, required in where):
+                continue
+            node = table
+            for getter in inner:
+                key = getter(row)
+                child = node.get(key)
+                if child is None:
+                    child = node[key] = {}
+                node = child
+            key = last(row)
+            state = node.get(key)
+            if state is None:
+                state = node[key] = new()
+            add(state, value)
+    return groupings
+
+def store_rows(store: ColumnStore, question: str = None, location: str = None):
+    """
+    Iterates over the rows of a store as FIELDS tuples. The question and location
+    filters are applied on the encoded columns, before the rows are built.
+    """
+
+    if question is None and location is None:
+        def column(name):
+            values = getattr(store, name)
+            if hasattr(values, 'codes'):
+                return map(values.values.__getitem__, values.codes)
+            return iter(values)
+    else:
+        mask = store.mask(question=question, location=location)
+
+        def column(name):
+            return store.select(getattr(store, name), mask)
+    return zip(*(column(name) for name in FIELDS))
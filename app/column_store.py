@@ -0,0 +1,237 @@
+"""
+This module defines the ColumnStore class, a columnar representation of the dataset.
+Numeric fields are kept in typed arrays, while the repeated string fields (question,
+location and stratification) are dictionary-encoded as integer codes.
+The module also defines QuestionView, a read-only sequence of Question objects
+built on demand from the columns.
+"""
+
+from array import array
+from collections.abc import Sequence
+from itertools import compress
+from operator import and_
+from app.question import Question
+
+def copy_array(column) -> array:
+    """
+    Copies an array or a memory-mapped column into a new array.
+    """
+
+    result = array(getattr(column, 'typecode', None) or column.format)
+    result.frombytes(memoryview(column).cast('B'))
+    return result
+
+class DictionaryColumn:
+    """
+    This class stores a string column as integer codes into a table of distinct values.
+    """
+
+    def __init__(self):
+        # distinct values, in order of first appearance
+        self.values = []
+        # value -> code
+        self.index = {}
+        self.codes = array('I')
+
+    def encode(self, value: str) -> int:
+        """
+        Returns the code of a value, adding it to the table if it is new.
+        """
+
+        code = self.index.get(value)
+        if code is None:
+            code = len(self.values)
+            self.values.append(value)
+            self.index[value] = code
+        return code
+
+    def append(self, value: str):
+        """
+        Appends a value at the end of the column.
+        """
+
+        self.codes.append(self.encode(value))
+
+    def extend(self, other):
+        """
+        Appends the values of another DictionaryColumn, translating its codes.
+        """
+
+        translation = [self.encode(value) for value in other.values]
+        self.codes.extend(map(translation.__getitem__, other.codes))
+
+    def copy(self):
+        """
+        Returns an independent, appendable copy of the column.
+        """
+
+        column = DictionaryColumn()
+        column.values = list(self.values)
+        column.index = dict(self.index)
+        column.codes = copy_array(self.codes)
+        return column
+
+    def code_of(self, value: str) -> int:
+        """
+        Returns the code of a value, or -1 if the value does not appear in the column.
+        """
+
+        return self.index.get(value, -1)
+
+    def __getitem__(self, row: int) -> str:
+        return self.values[self.codes[row]]
+
+    def __len__(self):
+        return len(self.codes)
+
+class ColumnStore:
+    """
+    This class keeps the rows of the csv file as typed columns.
+    """
+
+    def __init__(self):
+        self.year_start = array('i')
+        self.year_end = array('i')
+        self.data_value = array('d')
+        self.question = DictionaryColumn()
+        self.location = DictionaryColumn()
+        self.stratification_category1 = DictionaryColumn()
+        self.stratification1 = DictionaryColumn()
+
+    def append(self, location: str, year_start: int, year_end: int, question: str,
+               data_value: float, stratification_category1: str, stratification1: str):
+        """
+        Appends one row to the store.
+        """
+
+        self.location.append(location)
+        self.year_start.append(year_start)
+        self.year_end.append(year_end)
+        self.question.append(question)
+        self.data_value.append(data_value)
+        self.stratification_category1.append(stratification_category1)
+        self.stratification1.append(stratification1)
+
+    def __len__(self):
+        return len(self.data_value)
+
+    def extend(self, other):
+        """
+        Appends all the rows of another ColumnStore.
+        """
+
+        self.year_start.extend(other.year_start)
+        self.year_end.extend(other.year_end)
+        self.data_value.extend(other.data_value)
+        self.question.extend(other.question)
+        self.location.extend(other.location)
+        self.stratification_category1.extend(other.stratification_category1)
+        self.stratification1.extend(other.stratification1)
+
+    def copy(self):
+        """
+        Returns an independent, appendable copy of the store. Memory-mapped columns
+        are copied into arrays.
+        """
+
+        store = ColumnStore()
+        store.year_start = copy_array(self.year_start)
+        store.year_end = copy_array(self.year_end)
+        store.data_value = copy_array(self.data_value)
+        store.question = self.question.copy()
+        store.location = self.location.copy()
+        store.stratification_category1 = self.stratification_category1.copy()
+        store.stratification1 = self.stratification1.copy()
+        return store
+
+    def row(self, index: int) -> Question:
+        """
+        Builds the Question object for the row at the given index.
+        """
+
+        return Question(self.location[index], self.year_start[index], self.year_end[index],
+                        self.question[index], self.data_value[index],
+                        self.stratification_category1[index], self.stratification1[index])
+
+    def sort_by_location(self):
+        """
+        Reorders the rows by location in alphabetical order. The sort is stable, so rows
+        of the same location keep their original order.
+        """
+
+        names = self.location.values
+        # rank of every location code in alphabetical order
+        rank = [0] * len(names)
+        for position, code in enumerate(sorted(range(len(names)), key=names.__getitem__)):
+            rank[code] = position
+        # counting sort on the ranks, done on the codes only
+        starts = [0] * (len(names) + 1)
+        for code in self.location.codes:
+            starts[rank[code] + 1] += 1
+        for position in range(len(names)):
+            starts[position + 1] += starts[position]
+        order = array('I', bytes(4 * len(self)))
+        for index, code in enumerate(self.location.codes):
+            bucket = rank[code]
+            order[starts[bucket]] = index
+            starts[bucket] += 1
+
+        def permute(column):
+            return array(column.typecode, map(column.__getitem__, order))
+
+        self.year_start = permute(self.year_start)
+        self.year_end = permute(self.year_end)
+        self.data_value = permute(self.data_value)
+        for column in (self.question, self.location,
+                       self.stratification_category1, self.stratification1):
+            column.codes = permute(column.codes)
+
+    def mask(self, question: str = None, location: str = None) -> bytes:
+        """
+        Returns a byte mask with 1 for the rows matching the given question and location.
+        A filter left as None matches every row.
+        """
+
+        result = None
+        for column, value in ((self.question, question), (self.location, location)):
+            if value is None:
+                continue
+            current = bytes(map(column.code_of(value).__eq__, column.codes))
+            result = current if result is None else bytes(map(and_, result, current))
+        if result is None:
+            result = b'\x01' * len(self)
+        return result
+
+    @staticmethod
+    def select(column, mask: bytes):
+        """
+        Iterates over the values of a column for the rows selected by the mask.
+        """
+
+        if isinstance(column, DictionaryColumn):
+            return map(column.values.__getitem__, compress(column.codes, mask))
+        return compress(column, mask)
+
+class QuestionView(Sequence):
+    """
+    This class exposes the rows of a ColumnStore as a read-only sequence of Question objects,
+    followed by the Question objects of the appended rows, if any.
+    """
+
+    def __init__(self, store: ColumnStore, appended: tuple = ()):
+        self.store = store
+        self.appended = appended
+
+    def __len__(self):
+        return len(self.store) + len(self.appended)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('row index out of range')
+        if index >= len(self.store):
+            return self.appended[index - len(self.store)]
+        return self.store.row(index)
@@ -1,68 +1,189 @@
 """
 This module defines the DataIngestor class, which is responsible for reading and processing
-data from a CSV file. Each line of the CSV file is converted into a Question object.
+data from a CSV file. The lines of the CSV file are stored column by column in a ColumnStore
+and can still be accessed as Question objects through the questions view.
 The module also defines two lists:
-- questions_best_is_min: Questions where lower values are better.
-- questions_best_is_max: Questions where higher values are better.
+- QUESTIONS_BEST_IS_MIN: Questions where lower values are better.
+- QUESTIONS_BEST_IS_MAX: Questions where higher values are better.
 """
 
+import copy
 import csv
-from app.question import Question
+import logging
+import os
+import time
+from itertools import islice
+from app.column_store import ColumnStore, QuestionView
+from app.aggregate_index import AggregateIndex
+from app import snapshot
+from app.parallel_ingest import parse_parallel
+
+# number of csv lines converted at a time
+DEFAULT_CHUNK_SIZE = 65536
+
+logger = logging.getLogger('webserver')
+
+QUESTIONS_BEST_IS_MIN = [
+    'Percent of adults aged 18 years and older who have an overweight '
+    'classification',
+    'Percent of adults aged 18 years and older who have obesity',
+    'Percent of adults who engage in no leisure-time physical activity',
+    'Percent of adults who report consuming fruit less than one time daily',
+    'Percent of adults who report consuming vegetables less than one time '
+    'daily'
+]
+
+QUESTIONS_BEST_IS_MAX = [
+    (
+        'Percent of adults who achieve at least 150 minutes a week of '
+        'moderate-intensity aerobic physical activity or 75 minutes a week of '
+        'vigorous-intensity aerobic activity (or an equivalent combination)'
+    ),
+    (
+        'Percent of adults who achieve at least 150 minutes a week of '
+        'moderate-intensity aerobic physical activity or 75 minutes a week of '
+        'vigorous-intensity aerobic physical activity and engage in '
+        'muscle-strengthening activities on 2 or more days a week'
+    ),
+    (
+        'Percent of adults who achieve at least 300 minutes a week of '
+        'moderate-intensity aerobic physical activity or 150 minutes a week of '
+        'vigorous-intensity aerobic activity (or an equivalent combination)'
+    ),
+    'Percent of adults who engage in muscle-strengthening activities on 2 or '
+    'more days a week',
+]
 
 class DataIngestor:
     """
     This class is responsible for reading a CSV file.
+    In streaming mode the lines are folded straight into the aggregate index and
+    then discarded, so memory stays bounded no matter how large the file is. The
+    questions view is empty in that mode.
+    With workers > 1 the csv file is parsed by a pool of processes.
+    The progress callback, if given, is called with (rows_loaded, bytes_read, total_bytes)
+    after every batch.
     """
 
-    def __init__(self, csv_path: str):
-        # use Question dataclass to create the array of information of each line of the csv file
-        self.questions = []
+    def __init__(self, csv_path: str, streaming: bool = False,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, use_snapshot: bool = False,
+                 workers: int = 1, progress=None):
+        self.streaming = streaming
+        self.progress = progress
+        # keep the lines of the csv file as typed, dictionary-encoded columns
+        self.store = ColumnStore()
+        self.aggregates = AggregateIndex()
+        # loading progress
+        self.total_bytes = os.path.getsize(csv_path)
+        self.bytes_read = 0
+        self.rows_loaded = 0
+        # a snapshot only helps when the rows are kept in memory
+        use_snapshot = use_snapshot and not streaming
+        store = snapshot.load_snapshot(csv_path) if use_snapshot else None
+        if store is not None:
+            self.store = store
+            self.rows_loaded = len(store)
+            self.bytes_read = self.total_bytes
+            logger.info("Loaded %d rows from the snapshot of %s", self.rows_loaded, csv_path)
+        else:
+            start_time = time.perf_counter()
+            if workers > 1 and not streaming:
+                self.load_csv_parallel(csv_path, workers)
+            else:
+                self.load_csv(csv_path, chunk_size)
+            elapsed = max(time.perf_counter() - start_time, 1e-9)
+            logger.info("Parsed %d rows from %s in %.3fs (%.0f rows/s, %d processes)",
+                        self.rows_loaded, csv_path, elapsed, self.rows_loaded / elapsed,
+                        workers if workers > 1 and not streaming else 1)
+            if use_snapshot:
+                try:
+                    snapshot.write_snapshot(self.store, csv_path)
+                except OSError as error:
+                    logger.warning("Could not write the snapshot of %s: %s", csv_path, error)
+        if not streaming:
+            # sums and counts never change after load, so they are computed only once
+            self.aggregates = AggregateIndex.build(self.store)
+        # Question objects are built on demand, only when a row is accessed
+        self.questions = QuestionView(self.store)
+        self.questions_best_is_min = QUESTIONS_BEST_IS_MIN
+        self.questions_best_is_max = QUESTIONS_BEST_IS_MAX
+
+    def with_rows(self, rows: list):
+        """
+        Returns a new DataIngestor with the given Question rows appended. This one is
+        left unchanged, so jobs that are still reading it are not affected.
+        The cost depends on the new rows, not on the dataset: the store of the csv file is
+        shared, the appended rows follow its location-sorted rows in the questions view,
+        and only the aggregates the new rows fall in are copied.
+        """
+
+        ingestor = copy.copy(self)
+        if not self.streaming:
+            ingestor.questions = QuestionView(self.store, self.questions.appended + tuple(rows))
+        fields = [(row.question, row.location, row.stratification_category1,
+                   row.stratification1, row.year_start, row.year_end, row.data_value)
+                  for row in rows]
+        ingestor.aggregates = self.aggregates.copy(fields)
+        ingestor.aggregates.add_rows(fields)
+        ingestor.rows_loaded += len(rows)
+        return ingestor
+
+    def report_progress(self, csv_path: str):
+        """
+        Logs the loading progress and passes it to the progress callback.
+        """
+
+        logger.info("Loaded %d rows (%d/%d bytes) from %s", self.rows_loaded,
+                    self.bytes_read, self.total_bytes, csv_path)
+        if self.progress is not None:
+            self.progress(self.rows_loaded, self.bytes_read, self.total_bytes)
+
+    def load_csv(self, csv_path: str, chunk_size: int):
+        """
+        Reads the csv file in batches of chunk_size lines.
+        """
+
         # open with sopecified encoding
         with open(csv_path, encoding='utf-8') as file:
             reader = csv.reader(file)
             next(reader)
-            for line in reader:
-                location = line[4]
-                year_start = int(line[1])
-                year_end = int(line[2])
-                question = line[8]
-                data_value = float(line[11])
-                # second and third last columns are the stratification category and stratification
-                stratification_category1 = line[-4]
-                stratification1 = line[-3]
-                new_question = Question(location, year_start, year_end, question,
-                                        data_value, stratification_category1, stratification1)
-                self.questions.append(new_question)
-        #sort the array by state in alphabetical order
-        self.questions = sorted(self.questions, key=lambda x: x.location)
-
-        self.questions_best_is_min = [
-            'Percent of adults aged 18 years and older who have an overweight '
-            'classification',
-            'Percent of adults aged 18 years and older who have obesity',
-            'Percent of adults who engage in no leisure-time physical activity',
-            'Percent of adults who report consuming fruit less than one time daily',
-            'Percent of adults who report consuming vegetables less than one time '
-            'daily'
-        ]
-
-        self.questions_best_is_max = [
-            (
-                'Percent of adults who achieve at least 150 minutes a week of '
-                'moderate-intensity aerobic physical activity or 75 minutes a week of '
-                'vigorous-intensity aerobic activity (or an equivalent combination)'
-            ),
-            (
-                'Percent of adults who achieve at least 150 minutes a week of '
-                'moderate-intensity aerobic physical activity or 75 minutes a week of '
-                'vigorous-intensity aerobic physical activity and engage in '
-                'muscle-strengthening activities on 2 or more days a week'
-            ),
-            (
-                'Percent of adults who achieve at least 300 minutes a week of '
-                'moderate-intensity aerobic physical activity or 150 minutes a week of '
-                'vigorous-intensity aerobic activity (or an equivalent combination)'
-            ),
-            'Percent of adults who engage in muscle-strengthening activities on 2 or '
-            'more days a week',
-        ]
+            while True:
+                chunk = list(islice(reader, chunk_size))
+                if not chunk:
+                    break
+                self.ingest_chunk(chunk)
+                self.rows_loaded += len(chunk)
+                self.bytes_read = file.buffer.tell()
+                self.report_progress(csv_path)
+        self.bytes_read = self.total_bytes
+        if not self.streaming:
+            #sort the rows by state in alphabetical order
+            self.store.sort_by_location()
+
+    def load_csv_parallel(self, csv_path: str, workers: int):
+        """
+        Reads the csv file with a pool of processes, merging the parsed ranges in file order.
+        """
+
+        for end, partial in parse_parallel(csv_path, workers):
+            self.store.extend(partial)
+            self.rows_loaded += len(partial)
+            self.bytes_read = end
+            self.report_progress(csv_path)
+        #sort the rows by state in alphabetical order
+        self.store.sort_by_location()
+
+    def ingest_chunk(self, chunk: list):
+        """
+        Converts a batch of csv lines into the column store or, in streaming mode,
+        into the aggregate index.
+        """
+
+        # second and third last columns are the stratification category and stratification
+        if self.streaming:
+            self.aggregates.add_rows((line[8], line[4], line[-4], line[-3], int(line[1]),
+                                      int(line[2]), float(line[11])) for line in chunk)
+            return
+        for line in chunk:
+            self.store.append(line[4], int(line[1]), int(line[2]), line[8],
+                              float(line[11]), line[-4], line[-3])
@@ -0,0 +1,155 @@
+"""
+This module defines the DatasetRegistry class, which holds the dataset currently
+served by the webserver. Datasets are never changed in place: appending rows or
+reloading the csv file builds a new DataIngestor and publishes it under a new
+version, so jobs keep reading the version they started with.
+The registry can also be created empty and filled by load(), for example from a
+background thread, while it reports the loading progress.
+"""
+
+import logging
+import os
+from threading import Event, Lock
+from app.data_ingestor import DataIngestor
+
+logger = logging.getLogger('webserver')
+
+# errors raised by DataIngestor for a missing, unreadable or malformed csv file
+INGEST_ERRORS = (OSError, ValueError, IndexError, KeyError, StopIteration)
+
+class DatasetRegistry:
+    """
+    This class publishes copy-on-write versions of the dataset.
+    """
+
+    def __init__(self, data_ingestor: DataIngestor = None, **load_options):
+        # (version, data_ingestor), replaced as a whole so readers see a consistent pair
+        self.published = (0, None)
+        # options used to load a new csv file (streaming, use_snapshot, ...)
+        self.load_options = load_options
+        # only one writer builds the next version at a time
+        self.lock = Lock()
+        # only one reload at a time; it builds the new dataset without the lock
+        self.reload_lock = Lock()
+        # rows appended while a reload builds its dataset, applied to it when it publishes
+        self.reload_appends = None
+        # set once the first dataset is published, or the first load failed
+        self.ready_event = Event()
+        # loading, ready or failed
+        self.state = "loading"
+        self.progress = {"rows_loaded": 0, "bytes_read": 0, "total_bytes": 0}
+        if data_ingestor is not None:
+            self.publish(data_ingestor)
+
+    def is_ready(self) -> bool:
+        """
+        Checks if a dataset has been published.
+        """
+
+        return self.published[1] is not None
+
+    def wait_ready(self, timeout: float = None) -> bool:
+        """
+        Blocks until the first load finishes. Returns True if a dataset is available.
+        """
+
+        self.ready_event.wait(timeout)
+        return self.is_ready()
+
+    def update_progress(self, rows_loaded: int, bytes_read: int, total_bytes: int):
+        """
+        Records the progress of the load in progress.
+        """
+
+        self.progress = {"rows_loaded": rows_loaded, "bytes_read": bytes_read,
+                         "total_bytes": total_bytes}
+
+    def load(self, csv_path: str) -> int:
+        """
+        Loads the first dataset, reporting progress while the csv file is read.
+        Returns the published version, or 0 if the load failed.
+        """
+
+        self.state = "loading"
+        try:
+            data_ingestor = DataIngestor(csv_path, progress=self.update_progress,
+                                         **self.load_options)
+        except INGEST_ERRORS as error:
+            logger.error("[ERROR] Could not load %s: %s", csv_path, error)
+            self.state = "failed"
+            self.ready_event.set()
+            return 0
+        return self.publish(data_ingestor)
+
+    def current(self) -> DataIngestor:
+        """
+        Returns the latest published dataset.
+        """
+
+        return self.published[1]
+
+    def current_version(self):
+        """
+        Returns the (version, data_ingestor) pair of the latest published dataset.
+        """
+
+        return self.published
+
+    @property
+    def version(self) -> int:
+        """
+        The version of the latest published dataset.
+        """
+
+        return self.published[0]
+
+    def publish(self, data_ingestor: DataIngestor) -> int:
+        """
+        Makes a dataset the current one and returns its version.
+        """
+
+        with self.lock:
+            return self._publish(data_ingestor)
+
+    def _publish(self, data_ingestor: DataIngestor) -> int:
+        version = self.published[0] + 1
+        self.published = (version, data_ingestor)
+        self.update_progress(data_ingestor.rows_loaded, data_ingestor.total_bytes,
+                             data_ingestor.total_bytes)
+        self.state = "ready"
+        self.ready_event.set()
+        return version
+
+    def append_rows(self, rows: list) -> int:
+        """
+        Publishes a new version with the given Question rows appended and returns it.
+        """
+
+        with self.lock:
+            if self.reload_appends is not None:
+                self.reload_appends.extend(rows)
+            return self._publish(self.current().with_rows(rows))
+
+    def reload(self, csv_path: str) -> int:
+        """
+        Loads a csv file, publishes it as the new version and returns the version.
+        The rows appended while the file is loaded are appended to it too, so they are not
+        lost. Raises ValueError if the file can not be loaded; the current version is kept.
+        """
+
+        with self.reload_lock:
+            with self.lock:
+                self.reload_appends = []
+            try:
+                try:
+                    data_ingestor = DataIngestor(csv_path, **self.load_options)
+                except INGEST_ERRORS as error:
+                    logger.error("[ERROR] Could not reload %s: %r", csv_path, error)
+                    raise ValueError(f"could not load {os.path.basename(csv_path)}") from error
+                with self.lock:
+                    if self.reload_appends:
+                        data_ingestor = data_ingestor.with_rows(self.reload_appends)
+                    return self._publish(data_ingestor)
+            finally:
+                with self.lock:
+                    self.reload_appends = None
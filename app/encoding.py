@@ -0,0 +1,100 @@
+"""
+This module encodes the results of the jobs once, when they are stored, so serving them
+costs no json encoding or compression:
+- dumps() encodes a result with orjson when it is installed, or with the json module.
+- EncodedResult keeps the response body of a done job, its ETag (a hash of the body)
+  and, for large bodies, the body compressed ahead of time. The compressed stream is
+  kept once, raw, and framed as gzip or deflate (zlib) when it is sent.
+"""
+
+import hashlib
+import json
+import os
+import struct
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# start of the body of a done job, followed by the result and a closing brace
+DONE_PREFIX = b'{"status": "done", "data": '
+
+# smaller bodies are not worth compressing
+MIN_COMPRESS_BYTES = 1024
+
+# header of a gzip member: magic, deflate, no flags, no mtime, no extra flags, unknown os
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+# header of a zlib stream: deflate with a 32K window, default compression
+ZLIB_HEADER = b'\x78\x9c'
+
+def dumps(value) -> str:
+    """
+    Encodes a result as json. orjson is used if it is installed, unless FAST_JSON=0.
+    """
+
+    if orjson is not None and os.environ.get('FAST_JSON') != '0':
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+    return json.dumps(value)
+
+class EncodedResult:
+    """
+    This class keeps the response body of a done job with its ETag and compressed forms.
+    """
+
+    __slots__ = ('body', 'etag', 'deflated', 'crc32', 'adler32')
+
+    def __init__(self, data: bytes):
+        self.body = DONE_PREFIX + data + b'}'
+        self.etag = hashlib.blake2b(self.body, digest_size=12).hexdigest()
+        self.deflated = None
+        if len(self.body) >= MIN_COMPRESS_BYTES:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+            self.deflated = compressor.compress(self.body) + compressor.flush()
+            self.crc32 = zlib.crc32(self.body)
+            self.adler32 = zlib.adler32(self.body)
+
+    @classmethod
+    def restore(cls, data: bytes, etag: str, deflated: bytes, crc32: int, adler32: int):
+        """
+        Rebuilds an encoded result from its stored parts, without hashing or compressing
+        it again. deflated is None for a body that was not compressed.
+        """
+
+        result = cls.__new__(cls)
+        result.body = DONE_PREFIX + data + b'}'
+        result.etag = etag
+        result.deflated = deflated
+        result.crc32 = crc32
+        result.adler32 = adler32
+        return result
+
+    @property
+    def data(self) -> bytes:
+        """
+        The encoded result, without the status around it.
+        """
+
+        return self.body[len(DONE_PREFIX):-1]
+
+    @property
+    def size(self) -> int:
+        """
+        Number of bytes kept for the result.
+        """
+
+        return len(self.body) + len(self.deflated or b'')
+
+    def encoded(self, encoding: str) -> bytes:
+        """
+        Returns the body compressed with 'gzip' or 'deflate', or None if the body is
+        too small to be compressed.
+        """
+
+        if self.deflated is None:
+            return None
+        if encoding == 'gzip':
+            return (GZIP_HEADER + self.deflated
+                    + struct.pack('<II', self.crc32, len(self.body) & 0xffffffff))
+        return ZLIB_HEADER + self.deflated + struct.pack('>I', self.adler32)
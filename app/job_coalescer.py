@@ -0,0 +1,40 @@
+"""
+This module defines the JobCoalescer class, which merges identical jobs.
+While a job is queued or running, new jobs with the same key (job type, job data
+and dataset version) are attached to it as followers instead of being queued.
+When the leader finishes, its result completes all of its followers.
+"""
+
+from threading import Lock
+
+class JobCoalescer:
+    """
+    This class keeps the followers of every queued or running leader job.
+    """
+
+    def __init__(self):
+        # key -> job ids of the followers of the leader with that key
+        self.inflight = {}
+        self.lock = Lock()
+
+    def attach(self, key: tuple, job_id: int) -> bool:
+        """
+        Registers a job. Returns True if the job is a new leader that must be queued,
+        or False if it was attached to the leader with the same key.
+        """
+
+        with self.lock:
+            followers = self.inflight.get(key)
+            if followers is None:
+                self.inflight[key] = []
+                return True
+            followers.append(job_id)
+            return False
+
+    def complete(self, key: tuple) -> list:
+        """
+        Removes the leader with the given key and returns the job ids of its followers.
+        """
+
+        with self.lock:
+            return self.inflight.pop(key, [])
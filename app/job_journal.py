@@ -0,0 +1,177 @@
+"""
+This module defines the JobJournal class, an append-only log of the jobs that lets the
+webserver recover its jobs after a crash or a restart.
+Every job is recorded when it is submitted, started and done, one json line per event.
+The lines are written to the file right away, so they survive a crash of the process,
+and a background thread syncs them to disk every fsync_interval seconds, so many jobs
+share one fsync. On startup the journal is replayed: the job counter continues from the
+last job id and the jobs that were not done are queued again. Compaction rewrites the
+journal as a checkpoint of the counter followed by the jobs that are not done.
+"""
+
+import json
+import logging
+import os
+from threading import Event, Lock, Thread
+
+logger = logging.getLogger('webserver')
+
+class JobJournal:
+    """
+    This class appends job events to the journal file and replays it on startup.
+    """
+
+    def __init__(self, path: str, fsync_interval: float = 0.05, compact_records: int = 100000):
+        self.path = path
+        self.fsync_interval = fsync_interval
+        # the journal is compacted after this many records
+        self.compact_records = compact_records
+        self.records = 0
+        self.dirty = False
+        # job id -> submit record of the jobs that are not done, with their attempts
+        self.pending = {}
+        self.counter = 0
+        self.file = None
+        self.lock = Lock()
+        self.stopped = Event()
+        self.flusher = Thread(target=self.flush_loop, daemon=True)
+
+    def recover(self):
+        """
+        Replays the journal and returns (last job id, submit records of the jobs that
+        were not done, in id order). Every record has the number of times the job was
+        started. The journal is then compacted and opened for new records.
+        """
+
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        self.replay(json.loads(line))
+                    except (ValueError, KeyError):
+                        # the last line may have been cut by a crash
+                        logger.warning("Skipping a damaged line of the job journal %s",
+                                       self.path)
+        logger.info("Recovered %d jobs, %d not done, from %s", self.counter,
+                    len(self.pending), self.path)
+        with self.lock:
+            self.compact()
+        self.flusher.start()
+        return self.counter, [self.pending[job_id] for job_id in sorted(self.pending)]
+
+    def replay(self, record: dict):
+        """
+        Applies a record of the journal to the recovered state.
+        """
+
+        operation = record['op']
+        if operation == "checkpoint":
+            self.counter = max(self.counter, record['counter'])
+        elif operation == "submit":
+            self.counter = max(self.counter, record['id'])
+            self.pending[record['id']] = dict(record, attempts=record.get('attempts', 0))
+        elif operation == "start":
+            if record['id'] in self.pending:
+                self.pending[record['id']]['attempts'] += 1
+        elif operation == "done":
+            self.pending.pop(record['id'], None)
+
+    def append(self, record: dict):
+        """
+        Writes a record to the journal file. Called with the lock held. Records arriving
+        after the journal is closed are dropped.
+        """
+
+        if self.file is None:
+            return
+        self.file.write(json.dumps(record) + '\n')
+        # the records of a call are flushed together
+        self.file.flush()
+        self.dirty = True
+        self.records += 1
+
+    def submit(self, job):
+        """
+        Records a new job.
+        """
+
+        record = {"op": "submit", "id": int(job.job_id), "type": job.type, "data": job.data,
+                  "client_id": job.client_id, "priority": job.priority}
+        with self.lock:
+            self.counter = max(self.counter, record['id'])
+            self.pending[record['id']] = dict(record, attempts=0)
+            self.append(record)
+
+    def start(self, job_id: int):
+        """
+        Records that a runner started a job.
+        """
+
+        with self.lock:
+            if job_id in self.pending:
+                self.pending[job_id]['attempts'] += 1
+            self.append({"op": "start", "id": job_id})
+
+    def done(self, *job_ids: int):
+        """
+        Records that the results of jobs are stored durably, so they are not queued again
+        after a restart.
+        """
+
+        with self.lock:
+            for job_id in job_ids:
+                self.pending.pop(job_id, None)
+                self.append({"op": "done", "id": job_id})
+
+    def compact(self):
+        """
+        Rewrites the journal as a checkpoint and the jobs that are not done, and opens it
+        for new records. Called with the lock held.
+        """
+
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.write(json.dumps({"op": "checkpoint", "counter": self.counter}) + '\n')
+            for job_id in sorted(self.pending):
+                file.write(json.dumps(self.pending[job_id]) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_path, self.path)
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.path, 'a', encoding='utf-8')
+        self.records = 0
+        self.dirty = False
+
+    def flush_loop(self):
+        """
+        Syncs the new records to disk every fsync_interval seconds, and compacts the
+        journal when it has grown.
+        """
+
+        while not self.stopped.wait(self.fsync_interval):
+            with self.lock:
+                if self.records >= self.compact_records:
+                    self.compact()
+                    continue
+                if not self.dirty:
+                    continue
+                self.dirty = False
+                fileno = self.file.fileno()
+            # new records can be appended while the older ones are synced
+            os.fsync(fileno)
+
+    def close(self):
+        """
+        Syncs the journal and stops the background thread.
+        """
+
+        self.stopped.set()
+        if self.flusher.is_alive():
+            self.flusher.join()
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
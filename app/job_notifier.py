@@ -0,0 +1,87 @@
+"""
+This module defines the JobNotifier class, which tells clients when their jobs are done,
+so they do not have to poll /api/get_results.
+A long-poll request waits on the completion event of its job; an event stream watches
+a set of jobs and receives the id of every job of the set as soon as it is done.
+"""
+
+from queue import Queue
+from threading import Event, Lock
+
+class JobNotifier:
+    """
+    This class keeps the completion events of the jobs that somebody is waiting for.
+    The runners set the status of a job before calling notify(), and the waiters register
+    before reading the status, so no completion is missed.
+    """
+
+    def __init__(self):
+        # job id -> [event set when the job is done, number of waiters]
+        self.events = {}
+        # job id -> queues of the event streams watching the job
+        self.watchers = {}
+        self.lock = Lock()
+
+    def wait(self, job_id: int, is_done, timeout: float) -> bool:
+        """
+        Waits until a job is done, for at most timeout seconds. is_done() reads the status
+        of the job. Returns True if the job is done. The event of the job is dropped by
+        its last waiter, so waits on done jobs leave nothing behind.
+        """
+
+        if is_done():
+            return True
+        with self.lock:
+            entry = self.events.setdefault(job_id, [Event(), 0])
+            entry[1] += 1
+        try:
+            if is_done():
+                return True
+            return entry[0].wait(timeout)
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0 and self.events.get(job_id) is entry:
+                    del self.events[job_id]
+
+    def watch(self, job_ids, is_done) -> Queue:
+        """
+        Returns a queue that receives the id of every given job when it is done. Jobs
+        that are already done are put in the queue right away.
+        """
+
+        queue = Queue()
+        with self.lock:
+            for job_id in job_ids:
+                self.watchers.setdefault(job_id, []).append(queue)
+        for job_id in job_ids:
+            if is_done(job_id):
+                self.unwatch([job_id], queue)
+                queue.put(job_id)
+        return queue
+
+    def unwatch(self, job_ids, queue: Queue):
+        """
+        Stops sending the completions of the given jobs to a queue.
+        """
+
+        with self.lock:
+            for job_id in job_ids:
+                queues = self.watchers.get(job_id, [])
+                if queue in queues:
+                    queues.remove(queue)
+                if not queues:
+                    self.watchers.pop(job_id, None)
+
+    def notify(self, job_id: int):
+        """
+        Wakes up everybody waiting for a job. Called after its status is set to done.
+        """
+
+        with self.lock:
+            entry = self.events.pop(job_id, None)
+            queues = self.watchers.pop(job_id, [])
+        if entry is not None:
+            entry[0].set()
+        for queue in queues:
+            queue.put(job_id)
@@ -0,0 +1,176 @@
+"""
+This module defines the JobScheduler class, which replaces the FIFO job queue.
+Jobs are split into priority classes by their cost: cheap lookups (interactive) are served
+before expensive scans (bulk), and the shutdown job is served last. While both classes
+have queued jobs, one bulk job is served after every interactive_share interactive jobs,
+so a steady stream of lookups cannot starve the scans. A client can only demote its
+jobs to a lower class, never promote them. Inside a class,
+the clients share the threads by weighted fair queuing: every job gets a virtual
+finish time of start + cost / weight, where start is the later of the current virtual
+time and the finish time of the previous job of the same client, and the job with the
+earliest finish time is served first. A client that floods the queue only delays its
+own jobs.
+"""
+
+import heapq
+import time
+from itertools import count
+from queue import Empty
+from threading import Condition
+
+# priority classes, served in this order
+PRIORITY_CLASSES = ("interactive", "bulk", "shutdown")
+
+# estimated cost of every job type, in units of a single dictionary lookup
+JOB_COSTS = {
+    "state_mean": 1,
+    "global_mean": 1,
+    "state_diff_from_mean": 1,
+    "state_mean_by_category": 2,
+    "state_stats": 2,
+    "state_trend": 2,
+    "states_mean": 4,
+    "diff_from_mean": 4,
+    "best5": 4,
+    "worst5": 4,
+    "topk": 4,
+    "mean_by_category": 16,
+    "states_stats": 16,
+    "stats_by_category": 16,
+    "states_trend": 16,
+}
+
+# jobs that cost at most this much are interactive
+INTERACTIVE_COST = 2
+
+def job_cost(job) -> int:
+    """
+    Returns the estimated cost of a job. A batch costs as much as its queries.
+    """
+
+    if job.type == "batch":
+        return sum(JOB_COSTS.get(query.get('type'), 1) for query in job.data['queries'])
+    return JOB_COSTS.get(job.type, 1)
+
+def priority_class(job) -> str:
+    """
+    Returns the priority class of a job: the one of its cost, or the lower one requested
+    for it.
+    """
+
+    if job.type == "shutdown":
+        return "shutdown"
+    name = "interactive" if job_cost(job) <= INTERACTIVE_COST else "bulk"
+    if job.priority in PRIORITY_CLASSES[:-1]:
+        # the later of the two classes, a client cannot promote its jobs
+        return max(name, job.priority, key=PRIORITY_CLASSES.index)
+    return name
+
+class JobScheduler:
+    """
+    This class implements a blocking, thread-safe priority queue of jobs with weighted
+    fair queuing between clients. It keeps the put/get/qsize/empty interface of
+    queue.Queue, so the TaskRunners use it the same way.
+    """
+
+    def __init__(self, client_weights: dict = None, interactive_share: int = 4):
+        # client id -> weight, clients that are not listed have weight 1
+        self.client_weights = client_weights or {}
+        # interactive jobs served for every bulk job while both are queued
+        self.interactive_share = interactive_share
+        # interactive jobs served in a row while bulk jobs were queued
+        self.streak = 0
+        self.condition = Condition()
+        # priority class -> heap of (finish time, order, job)
+        self.heaps = {name: [] for name in PRIORITY_CLASSES}
+        # priority class -> virtual time, the finish time of the last served job
+        self.virtual_time = {name: 0.0 for name in PRIORITY_CLASSES}
+        # priority class -> client id -> finish time of its last queued job
+        self.last_finish = {name: {} for name in PRIORITY_CLASSES}
+        # priority class -> [served jobs, total wait, longest wait] in seconds
+        self.waits = {name: [0, 0.0, 0.0] for name in PRIORITY_CLASSES}
+        self.order = count()
+        self.size = 0
+
+    def put(self, job):
+        """
+        Queues a job and wakes up a thread waiting for one.
+        """
+
+        name = priority_class(job)
+        weight = self.client_weights.get(job.client_id, 1)
+        with self.condition:
+            last_finish = self.last_finish[name]
+            start = max(self.virtual_time[name], last_finish.get(job.client_id, 0.0))
+            finish = start + job_cost(job) / weight
+            last_finish[job.client_id] = finish
+            job.enqueued_at = time.monotonic()
+            heapq.heappush(self.heaps[name], (finish, next(self.order), job))
+            self.size += 1
+            self.condition.notify()
+
+    def get(self, block: bool = True, timeout: float = None):
+        """
+        Removes and returns the next job, waiting for one if the queue is empty.
+        Raises queue.Empty if no job arrives before the timeout.
+        """
+
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.size > 0,
+                                           timeout if block else 0):
+                raise Empty
+            name = self.next_class()
+            finish, _, job = heapq.heappop(self.heaps[name])
+            self.size -= 1
+            self.virtual_time[name] = finish
+            # a client with no queued jobs restarts from the virtual time
+            if self.last_finish[name].get(job.client_id, 0.0) <= finish:
+                self.last_finish[name].pop(job.client_id, None)
+            wait = time.monotonic() - job.enqueued_at
+            stats = self.waits[name]
+            stats[0] += 1
+            stats[1] += wait
+            stats[2] = max(stats[2], wait)
+            return job
+
+    def next_class(self) -> str:
+        """
+        Returns the priority class of the next job: the first one with queued jobs, or
+        bulk once interactive_share interactive jobs were served in a row before it.
+        Called with the lock held.
+        """
+
+        if not self.heaps["bulk"]:
+            self.streak = 0
+            return "interactive" if self.heaps["interactive"] else "shutdown"
+        if self.heaps["interactive"] and self.streak < self.interactive_share:
+            self.streak += 1
+            return "interactive"
+        self.streak = 0
+        return "bulk"
+
+    def qsize(self) -> int:
+        """
+        Returns the number of queued jobs.
+        """
+
+        with self.condition:
+            return self.size
+
+    def empty(self) -> bool:
+        """
+        Checks if there are no queued jobs.
+        """
+
+        return self.qsize() == 0
+
+    def stats(self) -> dict:
+        """
+        Returns the number of queued jobs and the queue wait times of every priority class.
+        """
+
+        with self.condition:
+            return {name: {"queued": len(self.heaps[name]), "served": served,
+                           "mean_wait": total / served if served else 0.0,
+                           "max_wait": longest}
+                    for name, (served, total, longest) in self.waits.items()}
@@ -0,0 +1,184 @@
+"""
+This module defines the JobTable class, which keeps the status and the type of every job
+in two byte arrays indexed by the job id, instead of a dict entry per job.
+Job ids are given in order, so the table only grows at its end. Once it holds more than
+retention jobs, the oldest jobs are evicted from its start; an evicted job is still
+reported as done, its result stays wherever the result store keeps it. The few evicted
+jobs that are still running are kept apart until they are done, so a stuck job does not
+stop the eviction.
+"""
+
+from threading import Lock
+
+# status codes kept in the table, 0 for ids that have no job
+STATUSES = (None, "running", "done")
+STATUS_CODES = {status: code for code, status in enumerate(STATUSES) if status is not None}
+
+# jobs scanned at once when a page of the table is read
+SCAN_CHUNK = 4096
+
+class JobTable:
+    """
+    This class maps job ids to statuses, like a dict, and lists them page by page.
+    """
+
+    def __init__(self, retention: int = 1000000):
+        self.retention = retention
+        # id of the job at index 0 of the arrays, the jobs before it were evicted
+        self.base = 0
+        self.statuses = bytearray()
+        self.types = bytearray()
+        # job id -> type code of the running jobs that were evicted from the arrays
+        self.evicted_running = {}
+        # type code -> job type, 0 for jobs registered without a type
+        self.type_names = [None]
+        self.type_codes = {}
+        # size of the arrays at which the next eviction is tried
+        self.evict_at = retention + SCAN_CHUNK
+        self.lock = Lock()
+
+    def add(self, job_id: int, job_type: str, status: str = "running"):
+        """
+        Registers a job with its type.
+        """
+
+        with self.lock:
+            code = self.type_codes.get(job_type)
+            if code is None:
+                code = self.type_codes[job_type] = len(self.type_names)
+                self.type_names.append(job_type)
+            self.set(job_id, STATUS_CODES[status])
+            if job_id >= self.base:
+                self.types[job_id - self.base] = code
+
+    def set(self, job_id: int, code: int):
+        """
+        Sets the status code of a job, growing the table if needed. Called with the lock held.
+        """
+
+        index = job_id - self.base
+        if index < 0:
+            # the job was evicted, it is kept apart only while it runs
+            if code != STATUS_CODES["running"]:
+                self.evicted_running.pop(job_id, None)
+            return
+        if index >= len(self.statuses):
+            missing = index + 1 - len(self.statuses)
+            self.statuses.extend(bytes(missing))
+            self.types.extend(bytes(missing))
+        self.statuses[index] = code
+        if len(self.statuses) >= self.evict_at:
+            self.evict()
+
+    def evict(self):
+        """
+        Drops the oldest jobs over the retention, moving the running ones among them to
+        evicted_running. Done in chunks, so the arrays are not shifted for every new job.
+        Called with the lock held.
+        """
+
+        excess = len(self.statuses) - self.retention
+        running = self.statuses.find(STATUS_CODES["running"], 0, excess)
+        while running != -1:
+            self.evicted_running[self.base + running] = self.types[running]
+            running = self.statuses.find(STATUS_CODES["running"], running + 1, excess)
+        del self.statuses[:excess]
+        del self.types[:excess]
+        self.base += excess
+        self.evict_at = max(self.retention, len(self.statuses)) + SCAN_CHUNK
+
+    def fill(self, last_id: int, status: str):
+        """
+        Sets the status of every kept job from 1 to last_id, growing the table if needed.
+        The jobs over the retention are evicted when the next job is set.
+        """
+
+        with self.lock:
+            if status != "running":
+                self.evicted_running = {job_id: code for job_id, code
+                                        in self.evicted_running.items() if job_id > last_id}
+            start, end = max(1 - self.base, 0), last_id + 1 - self.base
+            if end <= start:
+                return
+            if end > len(self.statuses):
+                missing = end - len(self.statuses)
+                self.statuses.extend(bytes(missing))
+                self.types.extend(bytes(missing))
+            self.statuses[start:end] = bytes([STATUS_CODES[status]]) * (end - start)
+
+    def __setitem__(self, job_id: int, status: str):
+        with self.lock:
+            self.set(job_id, STATUS_CODES[status])
+
+    def get(self, job_id: int, default=None):
+        """
+        Returns the status of a job, or default if there is no such job.
+        """
+
+        with self.lock:
+            index = job_id - self.base
+            if index < 0:
+                if job_id in self.evicted_running:
+                    return "running"
+                return "done" if job_id > 0 else default
+            if index >= len(self.statuses):
+                return default
+            return STATUSES[self.statuses[index]] or default
+
+    def __getitem__(self, job_id: int) -> str:
+        status = self.get(job_id)
+        if status is None:
+            raise KeyError(job_id)
+        return status
+
+    def __delitem__(self, job_id: int):
+        with self.lock:
+            index = job_id - self.base
+            if 0 <= index < len(self.statuses):
+                self.statuses[index] = 0
+            self.evicted_running.pop(job_id, None)
+
+    def __contains__(self, job_id: int) -> bool:
+        return self.get(job_id) is not None
+
+    def page(self, cursor: int, limit: int, status: str = None, job_type: str = None):
+        """
+        Returns up to limit (job id, status) pairs of the kept jobs, from the job id cursor
+        on, with the given status and type, and the cursor of the next page (None after
+        the last page). The table is copied chunk by chunk, so other requests are not
+        blocked while a page is read.
+        """
+
+        status_code = STATUS_CODES.get(status) if status is not None else None
+        jobs = []
+        if status in (None, "running"):
+            with self.lock:
+                evicted = sorted((job_id, code) for job_id, code in self.evicted_running.items()
+                                 if job_id >= cursor)
+                type_code = self.type_codes.get(job_type) if job_type is not None else None
+            for job_id, code in evicted:
+                if job_type is None or code == type_code:
+                    jobs.append((job_id, "running"))
+                    if len(jobs) == limit:
+                        return jobs, job_id + 1
+        while len(jobs) < limit:
+            with self.lock:
+                start = max(cursor - self.base, 0)
+                if start >= len(self.statuses):
+                    return jobs, None
+                base = self.base
+                statuses = self.statuses[start:start + SCAN_CHUNK]
+                types = self.types[start:start + SCAN_CHUNK]
+                type_code = self.type_codes.get(job_type) if job_type is not None else None
+            if job_type is not None and type_code is None:
+                # no job of that type was ever added
+                return jobs, None
+            for offset, code in enumerate(statuses):
+                if (code == 0 or (status_code is not None and code != status_code)
+                        or (type_code is not None and types[offset] != type_code)):
+                    continue
+                jobs.append((base + start + offset, STATUSES[code]))
+                if len(jobs) == limit:
+                    return jobs, base + start + offset + 1
+            cursor = base + start + len(statuses)
+        return jobs, cursor
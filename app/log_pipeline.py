@@ -0,0 +1,100 @@
+"""
+This module moves the writing of the log off the request threads:
+- QueueLogHandler only puts the records in a bounded queue; a QueueListener thread
+  formats them and writes them to the rotating log file.
+- SamplingFilter keeps one request out of N for the endpoints configured in
+  LOG_SAMPLING, so high-volume info lines do not flood the log. Warnings and errors
+  are always kept.
+- JsonFormatter writes every record as one json line.
+"""
+
+import itertools
+import logging
+import queue
+from flask import g, has_request_context, request
+from app.encoding import dumps
+
+class QueueLogHandler(logging.Handler):
+    """
+    This class puts the records in a queue for the listener thread. The message is not
+    formatted here; a record that does not fit in the full queue is dropped and counted.
+    """
+
+    def __init__(self, records: queue.Queue):
+        super().__init__()
+        self.queue = records
+        self.dropped = 0
+        # started by setup_logger, stopped with the handler
+        self.listener = None
+
+    def emit(self, record: logging.LogRecord):
+        if record.exc_info:
+            # tracebacks keep the frames alive, they are formatted right away
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        if self.listener is not None:
+            # writes the records still in the queue
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+            self.listener = None
+        super().close()
+
+class SamplingFilter(logging.Filter):
+    """
+    This class keeps the info lines of one request out of every N for the endpoints of
+    sampling (path -> N). The decision is taken once per request, so the entering and
+    exiting lines of a request are kept or dropped together.
+    """
+
+    def __init__(self, sampling: dict):
+        super().__init__()
+        self.sampling = sampling
+        # path -> counter of its requests
+        self.counters = {path: itertools.count() for path in sampling}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO or not has_request_context():
+            return True
+        keep = g.get('log_sampled')
+        if keep is None:
+            path = request.path
+            if path not in self.counters:
+                # /api/get_results/<job_id> is sampled as /api/get_results
+                path = path.rsplit('/', 1)[0]
+            counter = self.counters.get(path)
+            # next() on a count is atomic, the request threads need no lock
+            keep = counter is None or next(counter) % self.sampling[path] == 0
+            g.log_sampled = keep
+        return keep
+
+class JsonFormatter(logging.Formatter):
+    """
+    This class formats a record as a json object with its time (seconds since the
+    epoch), level, thread and message.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"time": record.created, "level": record.levelname,
+                 "thread": record.threadName, "message": record.getMessage()}
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return dumps(entry)
+
+def parse_sampling(text: str) -> dict:
+    """
+    Parses LOG_SAMPLING, a list of path=N separated by commas, like
+    "/api/num_jobs=100,/api/get_results=10".
+    """
+
+    sampling = {}
+    for item in filter(None, text.split(',')):
+        path, rate = item.split('=')
+        sampling[path.strip()] = max(int(rate), 1)
+    return sampling
@@ -0,0 +1,151 @@
+"""
+This module keeps the metrics of the runners and renders them for /metrics in the
+Prometheus text format.
+Every runner writes to its own WorkerMetrics, so recording a job takes no lock and the
+runners never contend on a shared counter. /metrics sums the shards when it is read;
+a read may miss the job being recorded at that moment, which is fine for monitoring.
+"""
+
+from bisect import bisect_left
+from threading import Lock
+
+# upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+           10.0, float('inf'))
+
+class Histogram:
+    """
+    This class counts observations per bucket, with their sum, like a Prometheus histogram.
+    """
+
+    def __init__(self):
+        # observations per bucket, not cumulative
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        """
+        Adds an observation.
+        """
+
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        """
+        Adds the observations of another histogram to this one.
+        """
+
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.sum += other.sum
+        self.count += other.count
+
+class WorkerMetrics:
+    """
+    This class holds the metrics of one runner. It is only written by the thread of the
+    runner.
+    """
+
+    def __init__(self, worker_id: int):
+        self.worker_id = worker_id
+        # job type -> Histogram of the time spent in the queue
+        self.queue_wait = {}
+        # job type -> Histogram of the time spent computing the result
+        self.execution = {}
+        # results stored, including the ones of the coalesced jobs
+        self.results_written = 0
+        # seconds spent processing jobs
+        self.busy_seconds = 0.0
+
+    def observe_job(self, job_type: str, wait: float, execution: float):
+        """
+        Records the queue wait and the execution time of a job.
+        """
+
+        histogram = self.queue_wait.get(job_type)
+        if histogram is None:
+            histogram = self.queue_wait[job_type] = Histogram()
+        histogram.observe(wait)
+        histogram = self.execution.get(job_type)
+        if histogram is None:
+            histogram = self.execution[job_type] = Histogram()
+        histogram.observe(execution)
+
+class Metrics:
+    """
+    This class collects the WorkerMetrics of the runners.
+    """
+
+    def __init__(self):
+        self.workers = []
+        # jobs that were done before the runners started, recovered from the journal
+        self.recovered_done = 0
+        self.lock = Lock()
+
+    def worker(self, worker_id: int) -> WorkerMetrics:
+        """
+        Returns a new shard for a runner.
+        """
+
+        shard = WorkerMetrics(worker_id)
+        with self.lock:
+            self.workers.append(shard)
+        return shard
+
+    def shards(self) -> list:
+        """
+        Returns the shards of the runners.
+        """
+
+        with self.lock:
+            return list(self.workers)
+
+    def jobs_done(self) -> int:
+        """
+        Returns the number of jobs whose result is stored.
+        """
+
+        return self.recovered_done + sum(shard.results_written for shard in self.shards())
+
+    def render(self, gauges: dict) -> str:
+        """
+        Returns the metrics in the Prometheus text format, after the given gauges
+        (name -> (help, value)).
+        """
+
+        lines = []
+        for name, (description, value) in gauges.items():
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} gauge",
+                      f"{name} {value}"]
+        shards = self.shards()
+
+        lines += ["# HELP results_written_total Results stored by the runners.",
+                  "# TYPE results_written_total counter",
+                  f"results_written_total {sum(shard.results_written for shard in shards)}"]
+        lines += ["# HELP worker_busy_seconds_total Seconds spent processing jobs per runner.",
+                  "# TYPE worker_busy_seconds_total counter"]
+        lines += [f'worker_busy_seconds_total{{worker="{shard.worker_id}"}} {shard.busy_seconds}'
+                  for shard in shards]
+
+        for name, attribute, description in (
+                ("job_queue_wait_seconds", "queue_wait", "Time spent by the jobs in the queue."),
+                ("job_execution_seconds", "execution", "Time spent computing the jobs.")):
+            histograms = {}
+            for shard in shards:
+                # copy, a runner may add a job type meanwhile
+                for job_type, histogram in dict(getattr(shard, attribute)).items():
+                    histograms.setdefault(job_type, Histogram()).merge(histogram)
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} histogram"]
+            for job_type in sorted(histograms):
+                histogram = histograms[job_type]
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    cumulative += count
+                    label = "+Inf" if bound == float('inf') else repr(bound)
+                    lines.append(f'{name}_bucket{{type="{job_type}",le="{label}"}} {cumulative}')
+                lines.append(f'{name}_sum{{type="{job_type}"}} {histogram.sum}')
+                lines.append(f'{name}_count{{type="{job_type}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
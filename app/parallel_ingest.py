@@ -0,0 +1,72 @@
+"""
+This module parses a csv file with a pool of processes.
+The file is split into byte ranges that start and end on line boundaries, every
+range is parsed into its own ColumnStore by a worker process, and the partial
+stores are merged back in file order, so the result is the same as a sequential
+parse. Quoted fields are assumed not to contain line breaks.
+"""
+
+import csv
+import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from app.column_store import ColumnStore
+
+# ranges smaller than this are not worth a separate process
+MIN_RANGE_BYTES = 1024 * 1024
+
+def split_ranges(csv_path: str, parts: int) -> list:
+    """
+    Splits the data lines of a csv file (without the header) into at most parts
+    (start, end) byte ranges that begin at the start of a line.
+    """
+
+    size = os.path.getsize(csv_path)
+    with open(csv_path, 'rb') as file:
+        file.readline()
+        start = file.tell()
+        parts = max(1, min(parts, (size - start) // MIN_RANGE_BYTES))
+        step = (size - start) // parts
+        boundaries = [start]
+        for part in range(1, parts):
+            file.seek(start + part * step)
+            # move to the start of the next line
+            file.readline()
+            if file.tell() > boundaries[-1] and file.tell() < size:
+                boundaries.append(file.tell())
+    boundaries.append(size)
+    return list(zip(boundaries, boundaries[1:]))
+
+def parse_range(csv_path: str, start: int, end: int) -> ColumnStore:
+    """
+    Parses the csv lines between two byte offsets into a ColumnStore.
+    """
+
+    store = ColumnStore()
+    with open(csv_path, 'rb') as file:
+        file.seek(start)
+        data = file.read(end - start)
+    # same newline handling as reading the file in text mode
+    reader = csv.reader(io.TextIOWrapper(io.BytesIO(data), encoding='utf-8'))
+    for line in reader:
+        # second and third last columns are the stratification category and stratification
+        store.append(line[4], int(line[1]), int(line[2]), line[8],
+                     float(line[11]), line[-4], line[-3])
+    return store
+
+def parse_parallel(csv_path: str, workers: int):
+    """
+    Parses a csv file with the given number of processes. Yields the (end offset,
+    partial store) of every range, in file order.
+    """
+
+    ranges = split_ranges(csv_path, workers)
+    # spawned workers do not inherit the threads and locks of the webserver, a dataset
+    # reload runs while the runner and logging threads hold theirs
+    with ProcessPoolExecutor(max_workers=min(workers, len(ranges)),
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        partials = executor.map(parse_range, [csv_path] * len(ranges),
+                                [start for start, _ in ranges], [end for _, end in ranges])
+        for (_, end), store in zip(ranges, partials):
+            yield end, store
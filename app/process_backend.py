@@ -0,0 +1,193 @@
+"""
+This module runs the CPU-bound job calculations in a pool of processes, so they are
+not serialized by the GIL of the webserver process.
+Handing a job to a process costs about 0.4ms, more than most lookups of the aggregates
+take on a thread (10-100us), so only the jobs that cost at least PROCESS_MIN_COST go to
+the processes; the others are computed in the runner thread.
+Every published dataset version is written once to a shared memory block as its
+pickled aggregates, and every worker process loads them from there once, instead of
+receiving them with every job or rebuilding them from the rows. Results come back as
+encoded json.
+"""
+
+import logging
+import multiprocessing
+import os
+import pickle
+from atexit import register
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.shared_memory import SharedMemory
+from threading import Lock
+from types import SimpleNamespace
+from app.data_ingestor import DataIngestor
+from app.encoding import dumps
+from app.job_scheduler import job_cost
+from app.task_runner import JobCalculator, TaskRunner
+
+logger = logging.getLogger('webserver')
+
+# shared memory blocks kept for versions older than the current one
+KEPT_VERSIONS = 2
+
+# jobs that cost less than this are computed in the runner thread, see JOB_COSTS
+PROCESS_MIN_COST = 16
+
+# shared memory name -> JobCalculator over the loaded aggregates, in a worker process
+_attached = {}
+
+def attach(shm_name: str) -> JobCalculator:
+    """
+    Loads a published dataset in a worker process and returns a JobCalculator that
+    computes jobs on it. Only the last loaded dataset is kept.
+    """
+
+    calculator = _attached.get(shm_name)
+    if calculator is not None:
+        return calculator
+    # the workers share the resource tracker of the webserver, which unlinks the block
+    block = SharedMemory(shm_name)
+    try:
+        aggregates, questions_best_is_min = pickle.loads(block.buf)
+    finally:
+        block.close()
+    _attached.clear()
+    data_ingestor = SimpleNamespace(streaming=False, aggregates=aggregates,
+                                    questions_best_is_min=questions_best_is_min)
+    calculator = _attached[shm_name] = JobCalculator(data_ingestor)
+    return calculator
+
+def run_job(shm_name: str, job_type: str, data: dict) -> str:
+    """
+    Computes a job in a worker process and returns its json result.
+    """
+
+    calculator = attach(shm_name)
+    return dumps(calculator.compute(SimpleNamespace(type=job_type, data=data)))
+
+class ProcessBackend:
+    """
+    This class owns the pool of worker processes and the shared memory blocks of the
+    published dataset versions.
+    """
+
+    def __init__(self, workers: int = None):
+        self.workers = workers or os.cpu_count()
+        self.executor = self.new_executor()
+        # version -> shared memory block, oldest first
+        self.blocks = {}
+        # version -> lock held while the version is pickled, so it is pickled only once
+        self.publishing = {}
+        self.lock = Lock()
+        register(self.stop)
+
+    def new_executor(self) -> ProcessPoolExecutor:
+        """
+        Returns a new pool of worker processes.
+        """
+
+        # spawned workers do not inherit the threads and locks of the webserver
+        return ProcessPoolExecutor(max_workers=self.workers,
+                                   mp_context=multiprocessing.get_context('spawn'))
+
+    def publish(self, version: int, data_ingestor: DataIngestor) -> str:
+        """
+        Copies the aggregates of a dataset version to shared memory, once, and returns
+        the name of the block.
+        The blocks of older versions are released, except the last KEPT_VERSIONS.
+        The aggregates are pickled without the lock, so the jobs of the versions that are
+        published already do not wait for a new one.
+        """
+
+        with self.lock:
+            block = self.blocks.get(version)
+            if block is not None:
+                return block.name
+            guard = self.publishing.setdefault(version, Lock())
+        with guard:
+            with self.lock:
+                block = self.blocks.get(version)
+            if block is not None:
+                # published by the job that held the guard
+                return block.name
+            # builds the aggregates per period, if no ranged request did yet
+            payload = pickle.dumps((data_ingestor.aggregates,
+                                    data_ingestor.questions_best_is_min),
+                                   protocol=pickle.HIGHEST_PROTOCOL)
+            size = len(payload)
+            block = SharedMemory(create=True, size=size)
+            block.buf[:size] = payload
+            with self.lock:
+                self.blocks[version] = block
+                self.publishing.pop(version, None)
+                for old_version in sorted(self.blocks)[:-(KEPT_VERSIONS + 1)]:
+                    self.release(self.blocks.pop(old_version))
+        logger.info("Published dataset version %d to shared memory %s (%d bytes)",
+                    version, block.name, size)
+        return block.name
+
+    @staticmethod
+    def release(block: SharedMemory):
+        """
+        Unlinks a shared memory block. Workers that loaded it keep their copy.
+        """
+
+        block.close()
+        try:
+            block.unlink()
+        except FileNotFoundError:
+            pass
+
+    def run(self, version: int, data_ingestor: DataIngestor, job) -> str:
+        """
+        Computes a job on a dataset version in a worker process and returns its json result.
+        Raises BrokenProcessPool if a worker died, after replacing the pool.
+        """
+
+        shm_name = self.publish(version, data_ingestor)
+        executor = self.executor
+        try:
+            return executor.submit(run_job, shm_name, job.type, job.data).result()
+        except BrokenProcessPool:
+            with self.lock:
+                # the first runner that sees the broken pool replaces it
+                if self.executor is executor:
+                    logger.error("[ERROR] A worker process died, starting a new pool")
+                    self.executor = self.new_executor()
+            executor.shutdown(wait=False)
+            raise
+
+    def stop(self):
+        """
+        Stops the worker processes and releases all the shared memory blocks.
+        """
+
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        with self.lock:
+            for block in self.blocks.values():
+                self.release(block)
+            self.blocks.clear()
+
+class ProcessTaskRunner(TaskRunner):
+    """
+    This class implements a TaskRunner thread that hands the CPU-bound calculations to
+    the worker processes. Queueing, caching and writing the results stay in the webserver process.
+    """
+
+    def __init__(self, *args, backend: ProcessBackend = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.backend = backend
+
+    def encode_job(self, job) -> str:
+        """
+        Computes the json result of a CPU-bound job in a worker process. The cheaper jobs
+        are computed in this thread, as are the jobs whose version was released or whose
+        worker process died.
+        """
+
+        if job_cost(job) < PROCESS_MIN_COST:
+            return super().encode_job(job)
+        try:
+            return self.backend.run(self.dataset_version, self.data_ingestor, job)
+        except (FileNotFoundError, BrokenProcessPool):
+            return super().encode_job(job)
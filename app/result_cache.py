@@ -0,0 +1,76 @@
+"""
+This module defines the ResultCache class, a bounded, thread-safe LRU cache of
+encoded job results. Entries are keyed by the job type, the canonical json of the
+job data and the dataset version, so a new dataset version never serves old results.
+"""
+
+import json
+from collections import OrderedDict
+from threading import Lock
+
+class ResultCache:
+    """
+    This class keeps the most recently used results, up to max_entries entries and
+    max_bytes bytes of encoded json. A limit of 0 disables the cache.
+    """
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key -> (encoded result, its size in utf-8 bytes), least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    @staticmethod
+    def key(job_type: str, data: dict, version: int) -> tuple:
+        """
+        Builds the cache key of a job. Equal requests give equal keys whatever
+        the order of their json fields.
+        """
+
+        return (job_type, json.dumps(data, sort_keys=True, separators=(',', ':')), version)
+
+    def get(self, key: tuple):
+        """
+        Returns the encoded result for a key, or None on a miss.
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: tuple, value: str):
+        """
+        Stores an encoded result, evicting the least recently used entries over the limits.
+        """
+
+        # the budget counts bytes, not characters, of non-ascii results
+        size = len(value.encode('utf-8'))
+        if size > self.max_bytes or self.max_entries <= 0:
+            return
+        with self.lock:
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.size -= old_entry[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def stats(self) -> dict:
+        """
+        Returns the hit and miss counters and the current size of the cache.
+        """
+
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "entries": len(self.entries), "bytes": self.size}
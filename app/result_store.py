@@ -0,0 +1,408 @@
+"""
+This module defines where the results of the jobs are kept until a client reads them.
+- FileResultStore writes one file per job in the results folder.
+- MemoryResultStore keeps the recent results in memory as encoded bytes and moves the
+  results that are older than a TTL, or over a memory cap, to an append-only segment
+  file, where they are found through an in-memory index of offsets. The segment is kept
+  across restarts: every record starts with a header holding the job id, so the index is
+  rebuilt by reading the headers when the store is opened.
+Both return EncodedResult objects, so /api/get_results serves the bytes without parsing
+them. The results are compressed and hashed once, when they are stored; the segment keeps
+the compressed form and the ETag next to the json.
+With an on_durable callback, the stores report the results that are synced to disk. The
+writes are synced by a background thread every fsync_interval seconds, like the records
+of the job journal, so many results share one fsync.
+"""
+
+import fcntl
+import os
+import struct
+import time
+from collections import OrderedDict
+from threading import Event, Lock, Thread
+from app.encoding import EncodedResult
+
+# header of a result in the segment file: job id, length of the json, length of the
+# compressed body (0 if it is not compressed), crc32, adler32 and ETag of the body
+RECORD = struct.Struct('<QIIII12s')
+
+# bytes copied at once when the segment is compacted
+COPY_CHUNK = 1024 * 1024
+
+class DurableWrites:
+    """
+    This class calls on_durable with the ids of the written results once they are synced
+    to disk. The syncing thread is started by the first write reported while on_durable
+    is set.
+    """
+
+    def __init__(self, fsync_interval: float = 0.05):
+        self.fsync_interval = fsync_interval
+        # called with the ids of the results synced to disk
+        self.on_durable = None
+        # ids of the results written since the last sync
+        self.unsynced = []
+        self.unsynced_lock = Lock()
+        self.stopped = Event()
+        self.syncer = None
+
+    def written(self, *job_ids: int):
+        """
+        Records results that were written, to be synced by the next pass of the thread.
+        """
+
+        if self.on_durable is None:
+            return
+        with self.unsynced_lock:
+            self.unsynced.extend(job_ids)
+            if self.syncer is None and not self.stopped.is_set():
+                self.syncer = Thread(target=self.sync_loop, daemon=True)
+                self.syncer.start()
+
+    def sync_loop(self):
+        """
+        Syncs the written results every fsync_interval seconds and reports them.
+        """
+
+        while not self.stopped.wait(self.fsync_interval):
+            self.sync()
+
+    def sync(self):
+        """
+        Syncs the results written so far and calls on_durable with their ids.
+        """
+
+        with self.unsynced_lock:
+            job_ids, self.unsynced = self.unsynced, []
+        if job_ids and self.sync_files(job_ids):
+            self.on_durable(*job_ids)
+
+    def sync_files(self, job_ids: list) -> bool:
+        """
+        Syncs the files holding the given results, returns False if they are gone.
+        """
+
+        raise NotImplementedError
+
+    def stop_syncing(self):
+        """
+        Stops the syncing thread, after a last sync.
+        """
+
+        self.stopped.set()
+        if self.syncer is not None:
+            self.syncer.join()
+        self.sync()
+
+class FileResultStore(DurableWrites):
+    """
+    This class writes every result to results/<job_id>.
+    """
+
+    def __init__(self, directory: str = 'results', fsync_interval: float = 0.05):
+        super().__init__(fsync_interval)
+        self.directory = directory
+
+    def put(self, job_id: int, encoded: str):
+        """
+        Stores the json result of a job.
+        """
+
+        with open(os.path.join(self.directory, str(job_id)), 'w', encoding='utf-8') as file:
+            file.write(encoded)
+        self.written(job_id)
+
+    def sync_files(self, job_ids: list) -> bool:
+        """
+        Syncs the files of the results and the results folder.
+        """
+
+        for job_id in job_ids:
+            file = os.open(os.path.join(self.directory, str(job_id)), os.O_RDONLY)
+            try:
+                os.fsync(file)
+            finally:
+                os.close(file)
+        # the new names are synced once for all the files
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        return True
+
+    def close(self):
+        """
+        Syncs the results written so far and stops the syncing thread.
+        """
+
+        self.stop_syncing()
+
+    def get(self, job_id: int):
+        """
+        Returns the EncodedResult of a job, or None if it is not stored.
+        """
+
+        try:
+            with open(os.path.join(self.directory, str(job_id)), 'rb') as file:
+                return EncodedResult(file.read())
+        except FileNotFoundError:
+            return None
+
+    def has(self, job_id: int) -> bool:
+        """
+        Checks if the result of a job is stored.
+        """
+
+        return os.path.exists(os.path.join(self.directory, str(job_id)))
+
+class MemoryResultStore(DurableWrites):
+    """
+    This class keeps results in memory for ttl seconds, up to max_bytes bytes, and then
+    spills them, oldest first, to the segment file. The limits are checked when a result
+    is stored, so results may stay in memory past the TTL while no new results arrive;
+    the memory they use stays under max_bytes. When the segment grows over
+    max_segment_bytes it is compacted: the oldest results are dropped until it is half
+    that size. The segment is locked, so two servers can not share it.
+    """
+
+    def __init__(self, segment_path: str = 'results.segment',
+                 max_bytes: int = 64 * 1024 * 1024, ttl: float = 300.0,
+                 max_segment_bytes: int = 1024 * 1024 * 1024, fsync_interval: float = 0.05):
+        super().__init__(fsync_interval)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_segment_bytes = max_segment_bytes
+        # job id -> (EncodedResult, time it was stored), oldest first
+        self.recent = OrderedDict()
+        self.size = 0
+        # job id -> (offset, length) of the records in the segment file
+        self.index = {}
+        self.segment_path = segment_path
+        self.segment = self.open_segment(segment_path)
+        self.segment_size = self.load()
+        self.lock = Lock()
+        # held by the compaction, which copies the records without the lock
+        self.compact_lock = Lock()
+
+    @staticmethod
+    def open_segment(path: str) -> int:
+        """
+        Opens a segment file for appending and locks it.
+        """
+
+        segment = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND)
+        try:
+            fcntl.flock(segment, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(segment)
+            raise RuntimeError(f"the result segment {path} is used by another server, "
+                               "set a different RESULT_SEGMENT") from None
+        return segment
+
+    def load(self) -> int:
+        """
+        Rebuilds the index from the headers of the records in the segment file and
+        returns its size. A record cut by a crash is removed.
+        """
+
+        size = os.fstat(self.segment).st_size
+        offset = 0
+        while offset + RECORD.size <= size:
+            job_id, length, deflated_length, _, _, _ = RECORD.unpack(
+                os.pread(self.segment, RECORD.size, offset))
+            record_length = RECORD.size + length + deflated_length
+            if offset + record_length > size:
+                break
+            # a result stored again replaces the older record
+            self.index[job_id] = (offset, record_length)
+            offset += record_length
+        if offset < size:
+            os.ftruncate(self.segment, offset)
+        return offset
+
+    def put(self, job_id: int, encoded: str):
+        """
+        Stores the json result of a job, spilling the old results over the limits.
+        """
+
+        result = EncodedResult(encoded.encode('utf-8'))
+        now = time.monotonic()
+        with self.lock:
+            old = self.recent.pop(job_id, None)
+            if old is not None:
+                self.size -= old[0].size
+            self.index.pop(job_id, None)
+            self.recent[job_id] = (result, now)
+            self.size += result.size
+            self.spill(now)
+        if self.segment_size > self.max_segment_bytes:
+            self.compact()
+
+    def spill(self, now: float, everything: bool = False):
+        """
+        Moves the results older than the TTL, or over the memory cap, to the segment file,
+        or all of them. Called with the lock held, when a result is stored.
+        """
+
+        spilled, spilled_ids = [], []
+        offset = self.segment_size
+        while self.recent:
+            job_id, (result, stored_at) = next(iter(self.recent.items()))
+            if not everything and self.size <= self.max_bytes and now - stored_at < self.ttl:
+                break
+            del self.recent[job_id]
+            self.size -= result.size
+            data, deflated = result.data, result.deflated or b''
+            record = RECORD.pack(job_id, len(data), len(deflated),
+                                 result.crc32 if result.deflated else 0,
+                                 result.adler32 if result.deflated else 0,
+                                 bytes.fromhex(result.etag)) + data + deflated
+            self.index[job_id] = (offset, len(record))
+            offset += len(record)
+            spilled.append(record)
+            spilled_ids.append(job_id)
+        if spilled:
+            # a single write for all the spilled results
+            os.write(self.segment, b''.join(spilled))
+            self.segment_size = offset
+            self.written(*spilled_ids)
+
+    def compact(self):
+        """
+        Rewrites the segment file with the newest records, dropping the oldest ones until
+        it is half of max_segment_bytes, and the records replaced by a newer one. The
+        records are copied without the lock, so the store keeps serving meanwhile; only
+        the records spilled during the copy are copied with the lock held, before the
+        new file replaces the old one. A compaction that is already running is not
+        started again.
+        """
+
+        if not self.compact_lock.acquire(blocking=False):
+            return
+        try:
+            with self.lock:
+                if self.segment is None or self.segment_size <= self.max_segment_bytes:
+                    return
+                records = sorted(self.index.items(), key=lambda item: item[1][0])
+                end = self.segment_size
+                # a duplicate, the store may be closed while the records are copied
+                source = os.dup(self.segment)
+            total = sum(length for _, (_, length) in records)
+            first = 0
+            # the newest result is kept, even if it is larger
+            while first < len(records) - 1 and total > self.max_segment_bytes // 2:
+                total -= records[first][1][1]
+                first += 1
+            temp_path = f"{self.segment_path}.tmp"
+            segment = os.open(temp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC | os.O_APPEND)
+            kept = {}
+            offset = 0
+            chunk, chunk_start = [], 0
+            try:
+                for job_id, location in records[first:]:
+                    chunk.append(os.pread(source, location[1], location[0]))
+                    kept[job_id] = (location, (offset, location[1]))
+                    offset += location[1]
+                    if offset - chunk_start >= COPY_CHUNK:
+                        os.write(segment, b''.join(chunk))
+                        chunk, chunk_start = [], offset
+                if chunk:
+                    os.write(segment, b''.join(chunk))
+                os.fsync(segment)
+            finally:
+                os.close(source)
+            with self.lock:
+                if self.segment is None:
+                    os.close(segment)
+                    os.unlink(temp_path)
+                    return
+                # the records spilled during the copy follow the copied ones
+                tail = os.pread(self.segment, self.segment_size - end, end)
+                if tail:
+                    os.write(segment, tail)
+                    # the records not synced yet are synced in their new file
+                    os.fsync(segment)
+                index = {}
+                for job_id, location in self.index.items():
+                    if location[0] >= end:
+                        index[job_id] = (location[0] - end + offset, location[1])
+                    elif job_id in kept and kept[job_id][0] == location:
+                        # not stored again during the copy
+                        index[job_id] = kept[job_id][1]
+                fcntl.flock(segment, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                os.replace(temp_path, self.segment_path)
+                os.close(self.segment)
+                self.segment = segment
+                self.index = index
+                self.segment_size = offset + len(tail)
+        finally:
+            self.compact_lock.release()
+
+    def get(self, job_id: int):
+        """
+        Returns the EncodedResult of a job, or None if it is not stored.
+        """
+
+        with self.lock:
+            entry = self.recent.get(job_id)
+            if entry is not None:
+                return entry[0]
+            location = self.index.get(job_id)
+            if location is None:
+                return None
+            # read with the lock held, a compaction replaces the file
+            record = os.pread(self.segment, location[1], location[0])
+        _, length, deflated_length, crc32, adler32, etag = RECORD.unpack_from(record)
+        data = record[RECORD.size:RECORD.size + length]
+        deflated = record[RECORD.size + length:] if deflated_length else None
+        return EncodedResult.restore(data, etag.hex(), deflated, crc32, adler32)
+
+    def has(self, job_id: int) -> bool:
+        """
+        Checks if the result of a job is stored.
+        """
+
+        with self.lock:
+            return job_id in self.recent or job_id in self.index
+
+    def sync_files(self, job_ids: list) -> bool:
+        """
+        Syncs the segment file, which holds all the spilled results.
+        """
+
+        with self.lock:
+            if self.segment is None:
+                return False
+            # a duplicate, so a compaction can replace the segment while it is synced
+            segment = os.dup(self.segment)
+        try:
+            os.fsync(segment)
+        finally:
+            os.close(segment)
+        return True
+
+    def stats(self) -> dict:
+        """
+        Returns the number and size of the results in memory and in the segment file.
+        """
+
+        with self.lock:
+            return {"in_memory": len(self.recent), "memory_bytes": self.size,
+                    "spilled": len(self.index), "segment_bytes": self.segment_size}
+
+    def close(self):
+        """
+        Spills the results in memory to the segment file, so they are found after a
+        restart, reports them as durable and closes it.
+        """
+
+        with self.lock:
+            if self.segment is None:
+                return
+            self.spill(time.monotonic(), everything=True)
+        # the last sync reports the results spilled above
+        self.stop_syncing()
+        with self.lock:
+            os.close(self.segment)
+            self.segment = None
@@ -2,10 +2,24 @@
 This module defines the routes for the webserver.
 """
 
+import hmac
 import json
+import os
+import time
+from queue import Empty
 from dataclasses import dataclass
-from app import webserver
-from flask import request, jsonify
+from app.question import Question
+from app.result_cache import ResultCache
+from app.task_runner import BATCH_JOB_TYPES, JobCalculator
+from app.job_scheduler import priority_class
+from flask import Blueprint, Response, request, jsonify
+# the routes are registered on the app built by create_app
+from flask import current_app as webserver
+
+api = Blueprint('api', __name__)
+
+# an event stream sends a comment when no job was done for this long
+HEARTBEAT_SECONDS = 15
 
 @dataclass
 class Job:
@@ -15,9 +29,16 @@ class Job:
     data: dict
     type: str
     status: str
+    # key shared by identical jobs, set when the job leads coalesced followers
+    coalesce_key: tuple = None
+    # scheduling: the client that posted the job, its requested priority class and
+    # the time it was queued
+    client_id: str = None
+    priority: str = None
+    enqueued_at: float = None
 
 # Example endpoint definition
-@webserver.route('/api/post_endpoint', methods=['POST'])
+@api.route('/api/post_endpoint', methods=['POST'])
 def post_endpoint():
     if request.method == 'POST':
         # Assuming the request contains JSON data
@@ -35,7 +56,7 @@ def post_endpoint():
         # Method Not Allowed
         return jsonify({"error": "Method not allowed"}), 405
 
-@webserver.route('/api/get_results/<job_id>', methods=['GET'])
+@api.route('/api/get_results/<job_id>', methods=['GET'])
 def get_response(job_id):
     # log the request
     webserver.logger.info("Entering /api/get_results with: %s", job_id)
@@ -47,20 +68,112 @@ def get_response(job_id):
         "smaller than 1 or greater than %s", job_id, webserver.job_counter)
         return jsonify({"status": "error", "reason": "Invalid job_id"})
 
+    # long-poll: wait for the job to be done instead of answering running right away
+    wait = request.args.get('wait')
+    if wait is not None:
+        try:
+            wait = min(float(wait), webserver.config['MAX_WAIT'])
+        except ValueError:
+            webserver.logger.error("[ERROR] Invalid wait: %s", wait)
+            return jsonify({"status": "error", "reason": "Invalid wait"})
+        job_status = webserver.job_status
+        if wait > 0:
+            webserver.job_notifier.wait(int(job_id),
+                                        lambda: job_status.get(int(job_id)) == "done", wait)
+
     # check if job_id is done in the job_status map
     if webserver.job_status[int(job_id)] == "done":
-        with open(f"results/{job_id}", 'r', encoding='utf-8') as file:
-            data = json.load(file)
-            # log the exit
-            webserver.logger.info("Exiting /api/get_results with data for job_id %s",
-                                   job_id)
-            return jsonify({"status": "done", "data": data})
+        result = webserver.result_store.get(int(job_id))
+        if result is None:
+            # log the error
+            webserver.logger.error("[ERROR] No result stored for job_id %s", job_id)
+            return jsonify({"status": "error", "reason": "Result not found"})
+        # log the exit
+        webserver.logger.info("Exiting /api/get_results with data for job_id %s", job_id)
+        return result_response(result)
     # log the exit
     webserver.logger.info("Exiting /api/get_results with status %s for job_id %s",
                           "running" , job_id)
     # If not, return running
     return jsonify({"status": "running"})
 
+@api.route('/api/events', methods=['GET'])
+def job_events():
+    """ Function to handle the /api/events endpoint, a stream of job completions """
+    # log the request
+    webserver.logger.info("Entering /api/events with: %s", request.args.get('job_ids'))
+    try:
+        job_ids = {int(job_id) for job_id in request.args.get('job_ids', '').split(',')}
+        timeout = min(float(request.args.get('timeout', webserver.config['MAX_WAIT'])),
+                      webserver.config['MAX_WAIT'])
+    except ValueError:
+        webserver.logger.error("[ERROR] Invalid job_ids: %s", request.args.get('job_ids'))
+        return jsonify({"status": "error", "reason": "Invalid job_ids"})
+    num_job = webserver.job_counter.get_value()
+    if any(job_id < 1 or job_id > num_job for job_id in job_ids):
+        webserver.logger.error("[ERROR] Invalid job_ids: %s", request.args.get('job_ids'))
+        return jsonify({"status": "error", "reason": "Invalid job_id"})
+
+    job_status = webserver.job_status
+    notifier = webserver.job_notifier
+    result_store = webserver.result_store
+    logger = webserver.logger
+    completions = notifier.watch(job_ids, lambda job_id: job_status.get(job_id) == "done")
+
+    def stream():
+        pending = set(job_ids)
+        deadline = time.monotonic() + timeout
+        try:
+            while pending and time.monotonic() < deadline:
+                try:
+                    job_id = completions.get(timeout=min(deadline - time.monotonic(),
+                                                         HEARTBEAT_SECONDS))
+                except Empty:
+                    # keep proxies from closing an idle connection
+                    yield ": keep-alive\n\n"
+                    continue
+                if job_id not in pending:
+                    continue
+                pending.discard(job_id)
+                result = result_store.get(job_id)
+                if result is None:
+                    logger.error("[ERROR] No result stored for job_id %s", job_id)
+                    yield (f'event: error\ndata: {{"job_id": {job_id}, "status": "error", '
+                           '"reason": "Result not found"}\n\n')
+                    continue
+                data = result.data.decode('utf-8')
+                yield f'event: done\ndata: {{"job_id": {job_id}, "data": {data}}}\n\n'
+            if pending:
+                yield f"event: timeout\ndata: {json.dumps(sorted(pending))}\n\n"
+        finally:
+            notifier.unwatch(pending, completions)
+
+    # log the exit
+    webserver.logger.info("Exiting /api/events with a stream of %d jobs", len(job_ids))
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+def result_response(result):
+    """ Function that sends an EncodedResult, as it was stored, with its ETag """
+    # the client already has this result
+    if request.if_none_match.contains(result.etag):
+        response = Response(status=304)
+        response.set_etag(result.etag)
+        return response
+    body = result.body
+    encoding = None
+    for accepted in ('gzip', 'deflate'):
+        if request.accept_encodings[accepted] and result.encoded(accepted) is not None:
+            encoding = accepted
+            body = result.encoded(accepted)
+            break
+    response = Response(body, mimetype='application/json')
+    response.set_etag(result.etag)
+    response.vary.add('Accept-Encoding')
+    if encoding is not None:
+        response.content_encoding = encoding
+    return response
+
 def check_server_status():
     """ Function to check if the server is running """
     if webserver.shutdown:
@@ -69,21 +182,88 @@ def check_server_status():
         return True
     return False
 
+def check_dataset_status():
+    """ Function that returns a 503 response if jobs can not be accepted yet """
+    datasets = webserver.datasets
+    if datasets.is_ready():
+        return None
+    if datasets.state == "loading" and webserver.config['QUEUE_WHILE_LOADING']:
+        return None
+    # log the error
+    webserver.logger.error("[ERROR] Dataset is %s", datasets.state)
+    return jsonify({"status": "error", "reason": f"dataset {datasets.state}"}), 503
+
+def years_error(data):
+    """ Function that returns the reason why the year range of a job is invalid, or None """
+    for field in ('year_from', 'year_to'):
+        year = data.get(field)
+        if year is not None and (not isinstance(year, int) or isinstance(year, bool)):
+            return f"Invalid {field}"
+    return None
+
+def answer_inline(type, data):
+    """ Function that returns the json answer of a job that is cached or cheap, or None.
+    Raises KeyError, TypeError or ValueError for an invalid request """
+    version, data_ingestor = webserver.datasets.current_version()
+    if data_ingestor is None:
+        return None
+    key = ResultCache.key(type, data, version)
+    encoded = webserver.result_cache.get(key)
+    if encoded is not None:
+        return encoded
+    job = Job(job_id=0, data=data, type=type, status="running")
+    # only lookups in the precomputed groupings are answered in the request
+    if type == "batch" or priority_class(job) != "interactive":
+        return None
+    encoded = JobCalculator(data_ingestor).encode_job(job)
+    webserver.result_cache.put(key, encoded)
+    return encoded
+
 def put_job_in_queue(type, data):
     """ Function that puts a job in the queue and returns the job_id """
     if check_server_status():
         return jsonify({"status": "error", "reason": "shutting down"})
+    not_ready = check_dataset_status()
+    if not_ready is not None:
+        return not_ready
+    reason = years_error(data if isinstance(data, dict) else {})
+    if reason is not None:
+        webserver.logger.error("[ERROR] %s for /api/%s: %s", reason, type, data)
+        return jsonify({"status": "error", "reason": reason})
     # log the request
     webserver.logger.info("Entering /api/%s with: %s", type, data)
-    # Increment job_id counter in a thread-safe manner and get the new value
-    job_id = webserver.job_counter.increment_and_get()
     # Get request data
     data = request.json
+    if request.args.get('sync') == '1':
+        try:
+            encoded = answer_inline(type, data)
+        except (KeyError, TypeError, ValueError) as error:
+            # the request is invalid, a job would only fail the same way
+            webserver.logger.error("[ERROR] Invalid request for /api/%s: %r", type, error)
+            return jsonify({"status": "error", "reason": f"invalid request: {error}"}), 400
+        if encoded is not None:
+            # log exiting the function
+            webserver.logger.info("Exiting /api/%s with an inline answer", type)
+            return Response(f'{{"status": "done", "data": {encoded}}}',
+                            mimetype='application/json')
+    # Increment job_id counter in a thread-safe manner and get the new value
+    job_id = webserver.job_counter.increment_and_get()
 
     # Register job. Don't wait for task to finish
-    job = Job(job_id=job_id, data=data, type=type, status="running")
+    job = Job(job_id=job_id, data=data, type=type, status="running",
+              client_id=request.headers.get('X-Client-Id', request.remote_addr),
+              priority=request.headers.get('X-Priority'))
     # add job to job_status map
-    webserver.job_status[int(job.job_id)] = "running"
+    webserver.job_status.add(int(job.job_id), type)
+    if webserver.job_journal is not None:
+        webserver.job_journal.submit(job)
+    if webserver.job_coalescer is not None:
+        job.coalesce_key = ResultCache.key(type, data, webserver.datasets.version)
+        if not webserver.job_coalescer.attach(job.coalesce_key, job.job_id):
+            # an identical job is queued or running, its result will complete this one
+            webserver.logger.info("Exiting /api/%s with: %s, attached to a running job",
+                                  type, job)
+            return jsonify({"job_id": job.job_id})
     # add job to job_queue
     webserver.job_queue.put(job)
     # log exiting the function
@@ -91,52 +271,217 @@ def put_job_in_queue(type, data):
     # Return associated job_id
     return jsonify({"job_id": job.job_id})
 
-@webserver.route('/api/states_mean', methods=['POST'])
+@api.route('/api/states_mean', methods=['POST'])
 def states_mean_request():
     """ Function to handle the /api/states_mean endpoint """
     return put_job_in_queue("states_mean", request.json)
 
-@webserver.route('/api/state_mean', methods=['POST'])
+@api.route('/api/state_mean', methods=['POST'])
 def state_mean_request():
     """ Function to handle the /api/state_mean endpoint """
     return put_job_in_queue("state_mean", request.json)
 
-@webserver.route('/api/best5', methods=['POST'])
+@api.route('/api/best5', methods=['POST'])
 def best5_request():
     """ Function to handle the /api/best5 endpoint """
     return put_job_in_queue("best5", request.json)
 
-@webserver.route('/api/worst5', methods=['POST'])
+@api.route('/api/worst5', methods=['POST'])
 def worst5_request():
     """ Function to handle the /api/worst5 endpoint """
     return put_job_in_queue("worst5", request.json)
 
-@webserver.route('/api/global_mean', methods=['POST'])
+@api.route('/api/state_stats', methods=['POST'])
+def state_stats_request():
+    """ Function to handle the /api/state_stats endpoint """
+    return put_job_in_queue("state_stats", request.json)
+
+@api.route('/api/states_stats', methods=['POST'])
+def states_stats_request():
+    """ Function to handle the /api/states_stats endpoint """
+    return put_job_in_queue("states_stats", request.json)
+
+@api.route('/api/stats_by_category', methods=['POST'])
+def stats_by_category_request():
+    """ Function to handle the /api/stats_by_category endpoint """
+    return put_job_in_queue("stats_by_category", request.json)
+
+@api.route('/api/state_trend', methods=['POST'])
+def state_trend_request():
+    """ Function to handle the /api/state_trend endpoint """
+    return put_job_in_queue("state_trend", request.json)
+
+@api.route('/api/states_trend', methods=['POST'])
+def states_trend_request():
+    """ Function to handle the /api/states_trend endpoint """
+    return put_job_in_queue("states_trend", request.json)
+
+def topk_error(data):
+    """ Function that returns the reason why topk parameters are invalid, or None """
+    k = data.get('k', 5)
+    if not isinstance(k, int) or isinstance(k, bool) or k < 0:
+        return "Invalid k"
+    if data.get('order', "best") not in ("best", "worst"):
+        return "Invalid order"
+    if data.get('ties', "first") not in ("first", "all"):
+        return "Invalid ties"
+    return None
+
+@api.route('/api/topk', methods=['POST'])
+def topk_request():
+    """ Function to handle the /api/topk endpoint """
+    data = request.json
+    if data is None:
+        data = {}
+    reason = topk_error(data) if isinstance(data, dict) else "Invalid request body"
+    if reason is not None:
+        webserver.logger.error("[ERROR] %s for /api/topk: %s", reason, request.json)
+        return jsonify({"status": "error", "reason": reason})
+    return put_job_in_queue("topk", request.json)
+
+@api.route('/api/batch', methods=['POST'])
+def batch_request():
+    """ Function to handle the /api/batch endpoint """
+    body = request.json
+    if not isinstance(body, dict):
+        webserver.logger.error("[ERROR] Invalid request body for /api/batch: %s", body)
+        return jsonify({"status": "error", "reason": "Invalid request body"})
+    queries = body.get('queries')
+    if not isinstance(queries, list) or not queries:
+        webserver.logger.error("[ERROR] Invalid queries for /api/batch")
+        return jsonify({"status": "error", "reason": "Invalid queries"})
+    if len(queries) > webserver.config['MAX_BATCH_QUERIES']:
+        webserver.logger.error("[ERROR] Too many queries for /api/batch: %d", len(queries))
+        return jsonify({"status": "error", "reason": "Too many queries"})
+    for query in queries:
+        if not isinstance(query, dict) or query.get('type') not in BATCH_JOB_TYPES:
+            webserver.logger.error("[ERROR] Invalid query for /api/batch: %s", query)
+            return jsonify({"status": "error", "reason": "Invalid query"})
+        reason = years_error(query)
+        if reason is None and query['type'] == "topk":
+            reason = topk_error(query)
+        if reason is not None:
+            webserver.logger.error("[ERROR] Invalid query for /api/batch: %s", query)
+            return jsonify({"status": "error", "reason": reason})
+    return put_job_in_queue("batch", request.json)
+
+@api.route('/api/global_mean', methods=['POST'])
 def global_mean_request():
     """ Function to handle the /api/global_mean endpoint """
     return put_job_in_queue("global_mean", request.json)
 
-@webserver.route('/api/diff_from_mean', methods=['POST'])
+@api.route('/api/diff_from_mean', methods=['POST'])
 def diff_from_mean_request():
     """ Function to handle the /api/diff_from_mean endpoint """
     return put_job_in_queue("diff_from_mean", request.json)
 
-@webserver.route('/api/state_diff_from_mean', methods=['POST'])
+@api.route('/api/state_diff_from_mean', methods=['POST'])
 def state_diff_from_mean_request():
     """ Function to handle the /api/state_diff_from_mean endpoint """
     return put_job_in_queue("state_diff_from_mean", request.json)
 
-@webserver.route('/api/mean_by_category', methods=['POST'])
+@api.route('/api/mean_by_category', methods=['POST'])
 def mean_by_category_request():
     """ Function to handle the /api/mean_by_category endpoint """
     return put_job_in_queue("mean_by_category", request.json)
 
-@webserver.route('/api/state_mean_by_category', methods=['POST'])
+@api.route('/api/state_mean_by_category', methods=['POST'])
 def state_mean_by_category_request():
     """ Function to handle the /api/state_mean_by_category endpoint """
     return put_job_in_queue("state_mean_by_category", request.json)
 
-@webserver.route('/api/graceful_shutdown', methods=['GET'])
+def parse_rows(rows):
+    """ Function that converts the json rows of a request into Question objects """
+    questions = []
+    for row in rows:
+        questions.append(Question(location=str(row['location']),
+                                  year_start=int(row['year_start']),
+                                  year_end=int(row['year_end']),
+                                  question=str(row['question']),
+                                  data_value=float(row['data_value']),
+                                  stratification_category1=str(row['stratification_category1']),
+                                  stratification1=str(row['stratification1'])))
+    return questions
+
+def check_admin_token():
+    """ Function that returns an error response if the request has no valid admin token """
+    token = webserver.config['ADMIN_TOKEN']
+    if not token:
+        # the admin endpoints are disabled without a configured token
+        webserver.logger.error("[ERROR] Admin request with no ADMIN_TOKEN configured")
+        return jsonify({"status": "error", "reason": "admin endpoints disabled"}), 403
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', '').encode('utf-8'),
+                               token.encode('utf-8')):
+        webserver.logger.error("[ERROR] Invalid admin token for %s", request.path)
+        return jsonify({"status": "error", "reason": "Invalid admin token"}), 401
+    return None
+
+def data_file(csv_path):
+    """ Function that returns the real path of a file of the data directory, or None """
+    if not isinstance(csv_path, str):
+        return None
+    data_dir = os.path.realpath(webserver.config['DATA_DIR'])
+    path = os.path.realpath(os.path.join(data_dir, csv_path))
+    if os.path.commonpath([data_dir, path]) != data_dir or not os.path.isfile(path):
+        return None
+    return path
+
+@api.route('/api/admin/append', methods=['POST'])
+def admin_append():
+    """ Function to handle the /api/admin/append endpoint """
+    # log the request
+    webserver.logger.info("Entering /api/admin/append")
+    denied = check_admin_token()
+    if denied is not None:
+        return denied
+    if not webserver.datasets.is_ready():
+        return jsonify({"status": "error", "reason": f"dataset {webserver.datasets.state}"}), 503
+    try:
+        rows = parse_rows(request.json['rows'])
+    except (KeyError, TypeError, ValueError) as error:
+        # log the error
+        webserver.logger.error("[ERROR] Invalid rows for /api/admin/append: %s", error)
+        return jsonify({"status": "error", "reason": "Invalid rows"})
+    version = webserver.datasets.append_rows(rows)
+    # log the exit
+    webserver.logger.info("Exiting /api/admin/append with version %s", version)
+    return jsonify({"status": "done", "version": version,
+                    "rows": webserver.datasets.current().rows_loaded})
+
+@api.route('/api/admin/reload', methods=['POST'])
+def admin_reload():
+    """ Function to handle the /api/admin/reload endpoint """
+    # log the request
+    webserver.logger.info("Entering /api/admin/reload with: %s", request.json)
+    denied = check_admin_token()
+    if denied is not None:
+        return denied
+    body = request.json
+    csv_path = data_file(body.get('csv_path')) if isinstance(body, dict) else None
+    if csv_path is None:
+        # log the error
+        webserver.logger.error("[ERROR] Invalid csv_path: %s", request.json)
+        return jsonify({"status": "error", "reason": "Invalid csv_path"}), 400
+    try:
+        version = webserver.datasets.reload(csv_path)
+    except ValueError as error:
+        # the current version is still served
+        return jsonify({"status": "error", "reason": str(error)}), 400
+    # log the exit
+    webserver.logger.info("Exiting /api/admin/reload with version %s", version)
+    return jsonify({"status": "done", "version": version,
+                    "rows": webserver.datasets.current().rows_loaded})
+
+@api.route('/api/ready', methods=['GET'])
+def ready():
+    """ Function to handle the /api/ready endpoint """
+    datasets = webserver.datasets
+    response = {"status": datasets.state, "version": datasets.version}
+    response.update(datasets.progress)
+    # 503 until the dataset is loaded, so load balancers keep the server out of rotation
+    return jsonify(response), 200 if datasets.is_ready() else 503
+
+@api.route('/api/graceful_shutdown', methods=['GET'])
 def graceful_shutdown():
     """ Function to handle the /api/graceful_shutdown endpoint """
     # log the request
@@ -158,40 +503,105 @@ def graceful_shutdown():
         webserver.logger.info("Exiting /api/graceful_shutdown with status running")
         return jsonify({"status": "running"})
 
-@webserver.route('/api/jobs', methods=['GET'])
+@api.route('/api/jobs', methods=['GET'])
 def get_jobs():
     """ Function to handle the /api/jobs endpoint """
     # log the request
     webserver.logger.info("Entering /api/jobs")
 
-    # get all jobs from job_status map
-    jobs = []
-    for job_id, status in webserver.job_status.items():
-        jobs.append({job_id: status})
+    try:
+        cursor = int(request.args.get('cursor', 0))
+        limit = int(request.args.get('limit', 1000))
+    except ValueError:
+        webserver.logger.error("[ERROR] Invalid cursor or limit: %s", request.args)
+        return jsonify({"status": "error", "reason": "Invalid cursor or limit"})
+    if cursor < 0 or not 1 <= limit <= webserver.config['MAX_JOBS_PAGE']:
+        webserver.logger.error("[ERROR] Invalid cursor or limit: %s", request.args)
+        return jsonify({"status": "error", "reason": "Invalid cursor or limit"})
+    status = request.args.get('status')
+    if status not in (None, "running", "done"):
+        webserver.logger.error("[ERROR] Invalid status: %s", status)
+        return jsonify({"status": "error", "reason": "Invalid status"})
+
+    # get one page of jobs from the job table
+    jobs, next_cursor = webserver.job_status.page(cursor, limit, status,
+                                                  request.args.get('type'))
+
+    def stream():
+        yield '{"status": "done", "data": ['
+        # a few hundred jobs per chunk of the response
+        for start in range(0, len(jobs), 500):
+            yield (',' if start else '') + ','.join(
+                f'{{"{job_id}": "{job_status}"}}' for job_id, job_status in jobs[start:start + 500])
+        yield f'], "next_cursor": {json.dumps(next_cursor)}}}'
 
     # log the exit
-    webserver.logger.info("Exiting /api/jobs with status done")
-    return jsonify({"status": "done", "data": jobs})
+    webserver.logger.info("Exiting /api/jobs with %d jobs, next cursor %s", len(jobs), next_cursor)
+    return Response(stream(), mimetype='application/json')
 
-@webserver.route('/api/num_jobs', methods=['GET'])
+@api.route('/api/num_jobs', methods=['GET'])
 def num_jobs():
     """ Function to handle the /api/num_jobs endpoint """
     # log the request
     webserver.logger.info("Entering /api/num_jobs")
 
-    # get the number of jobs in the queue, that are not done
-    num_jobs = 0
-    for job_id, status in webserver.job_status.items():
-        if status != "done":
-            num_jobs += 1
+    # get the number of jobs in the queue, that are not done: every job id was given to
+    # a job, and the runners count the jobs they are done with
+    num_jobs = webserver.job_counter.get_value() - webserver.metrics.jobs_done()
 
     # log the exit
     webserver.logger.info("Exiting /api/num_jobs with status done")
     return jsonify({"status": "done", "data": num_jobs})
 
+@api.route('/api/queue_stats', methods=['GET'])
+def queue_stats():
+    """ Function to handle the /api/queue_stats endpoint """
+    # log the request
+    webserver.logger.info("Entering /api/queue_stats")
+    stats = webserver.job_queue.stats()
+    # log the exit
+    webserver.logger.info("Exiting /api/queue_stats with: %s", stats)
+    return jsonify({"status": "done", "data": stats})
+
+@api.route('/api/cache_stats', methods=['GET'])
+def cache_stats():
+    """ Function to handle the /api/cache_stats endpoint """
+    # log the request
+    webserver.logger.info("Entering /api/cache_stats")
+    stats = webserver.result_cache.stats()
+    # log the exit
+    webserver.logger.info("Exiting /api/cache_stats with: %s", stats)
+    return jsonify({"status": "done", "data": stats})
+
+@api.route('/metrics', methods=['GET'])
+def metrics():
+    """ Function to handle the /metrics endpoint """
+    # log the request
+    webserver.logger.info("Entering /metrics")
+    cache = webserver.result_cache.stats()
+    lookups = cache["hits"] + cache["misses"]
+    gauges = {
+        "job_queue_depth": ("Jobs waiting in the queue.", webserver.job_queue.qsize()),
+        "jobs_pending": ("Jobs that are not done.",
+                         webserver.job_counter.get_value() - webserver.metrics.jobs_done()),
+        "result_cache_hits": ("Results served from the cache.", cache["hits"]),
+        "result_cache_misses": ("Results computed after a cache miss.", cache["misses"]),
+        "result_cache_hit_ratio": ("Share of the cache lookups that were hits.",
+                                   cache["hits"] / lookups if lookups else 0.0),
+        "result_cache_entries": ("Results in the cache.", cache["entries"]),
+        "result_cache_bytes": ("Bytes of the results in the cache.", cache["bytes"]),
+        "log_records_dropped": ("Log records dropped because the log queue was full.",
+                                sum(getattr(handler, 'dropped', 0)
+                                    for handler in webserver.logger.handlers)),
+    }
+    body = webserver.metrics.render(gauges)
+    # log the exit
+    webserver.logger.info("Exiting /metrics with status done")
+    return Response(body, mimetype='text/plain; version=0.0.4')
+
 # You can check localhost in your browser to see what this displays
-@webserver.route('/')
-@webserver.route('/index')
+@api.route('/')
+@api.route('/index')
 def index():
     routes = get_defined_routes()
     msg = f"Hello, World!\n Interact with the webserver using one of the defined routes:\n"
@@ -0,0 +1,142 @@
+"""
+This module implements TDigest, a mergeable sketch of a distribution that answers
+quantile queries (median, p90, ...) with bounded memory.
+Values are buffered and merged into a sorted list of centroids (mean, weight). A
+centroid may only grow while it stays small relative to its rank: centroids near the
+median hold many values, the ones in the tails hold few, so the extreme quantiles stay
+accurate. Groups with fewer values than the compression are kept exactly.
+"""
+
+class TDigest:
+    """
+    This class keeps a number of centroids proportional to the compression (a few
+    hundred for the default) and at most 4 * compression buffered values, whatever
+    the number of values added.
+    """
+
+    def __init__(self, compression: int = 100):
+        self.compression = compression
+        # sorted centroids
+        self.means = []
+        self.weights = []
+        # values added since the last compression
+        self.buffer = []
+        # (means, weights) of the centroids merged with the buffer, until the next change
+        self.cached = None
+        self.count = 0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def add(self, value: float):
+        """
+        Adds a value to the digest.
+        """
+
+        self.buffer.append(value)
+        self.cached = None
+        self.count += 1
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        if len(self.buffer) >= 4 * self.compression:
+            self.means, self.weights = self.compressed()
+            self.buffer = []
+            self.cached = self.means, self.weights
+
+    def merge(self, other):
+        """
+        Adds the values of another digest to this one.
+        """
+
+        self.means, self.weights = self.compressed(other)
+        self.buffer = []
+        # nothing is buffered, the centroids are already compressed
+        self.cached = self.means, self.weights
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def copy(self):
+        """
+        Returns an independent copy of the digest.
+        """
+
+        digest = TDigest(self.compression)
+        digest.means = list(self.means)
+        digest.weights = list(self.weights)
+        digest.buffer = list(self.buffer)
+        # the cached lists are never changed in place
+        digest.cached = self.cached
+        digest.count = self.count
+        digest.min = self.min
+        digest.max = self.max
+        return digest
+
+    def compressed(self, other=None):
+        """
+        Returns the (means, weights) of the centroids merged with the buffered values
+        and, if given, with the centroids of another digest. The digest is not changed,
+        so it can be read by several threads.
+        """
+
+        items = list(zip(self.means, self.weights)) + [(value, 1) for value in self.buffer]
+        if other is not None:
+            items += list(zip(other.means, other.weights))
+            items += [(value, 1) for value in other.buffer]
+        if not items:
+            return [], []
+        items.sort()
+        total = sum(weight for _, weight in items)
+        means, weights = [], []
+        mean, weight = items[0]
+        merged = 0
+        for next_mean, next_weight in items[1:]:
+            # quantile of the centroid if the next item is merged into it
+            quantile = (merged + (weight + next_weight) / 2) / total
+            if weight + next_weight <= 4 * total * quantile * (1 - quantile) / self.compression:
+                weight += next_weight
+                mean += (next_mean - mean) * next_weight / weight
+            else:
+                means.append(mean)
+                weights.append(weight)
+                merged += weight
+                mean, weight = next_mean, next_weight
+        means.append(mean)
+        weights.append(weight)
+        return means, weights
+
+    def quantile(self, quantile: float) -> float:
+        """
+        Returns an estimate of a quantile, between 0 and 1, or 0 for an empty digest.
+        The centroids are compressed on the first query and kept until the next value is
+        added, so the other queries do not sort them again.
+        The estimate is exact, with linear interpolation between ranks, while every
+        centroid holds a single value.
+        """
+
+        if self.count == 0:
+            return 0.0
+        if self.cached is None:
+            # a single assignment, a concurrent reader sees it whole or compresses again
+            self.cached = self.compressed()
+        means, weights = self.cached
+        # rank of the quantile, between 0 and count - 1
+        rank = quantile * (self.count - 1)
+        # the values of a centroid are spread around its mean, which sits at its middle rank
+        previous_rank, previous_mean = 0.0, self.min
+        first_rank = 0
+        for mean, weight in zip(means, weights):
+            center = first_rank + (weight - 1) / 2
+            if rank <= center:
+                if center == previous_rank:
+                    return mean
+                fraction = (rank - previous_rank) / (center - previous_rank)
+                return previous_mean + fraction * (mean - previous_mean)
+            previous_rank, previous_mean = center, mean
+            first_rank += weight
+        last_rank = self.count - 1
+        if last_rank == previous_rank:
+            return previous_mean
+        fraction = (rank - previous_rank) / (last_rank - previous_rank)
+        return previous_mean + fraction * (self.max - previous_mean)
@@ -0,0 +1,199 @@
+"""
+This module reads and writes binary snapshots of a parsed dataset.
+A snapshot is written next to the csv file and holds the columns of the ColumnStore
+as raw arrays, so a later start can memory-map it instead of parsing the csv again.
+The snapshot remembers the size, modification time and sha256 of the csv file it
+was built from, and is ignored when the csv file changes.
+
+Usage, to build the snapshot ahead of a deploy:
+    python build_snapshot.py path/to/file.csv
+"""
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+from app.column_store import ColumnStore, DictionaryColumn
+
+MAGIC = b'LSSNAP'
+# bump when the layout changes, older snapshots are then rebuilt
+VERSION = 1
+# magic, version, header length
+PREAMBLE = struct.Struct('<6sHI')
+ALIGNMENT = 8
+
+NUMERIC_COLUMNS = ('year_start', 'year_end', 'data_value')
+DICTIONARY_COLUMNS = ('question', 'location', 'stratification_category1', 'stratification1')
+
+logger = logging.getLogger('webserver')
+
+def snapshot_path(csv_path: str) -> str:
+    """
+    Returns the path of the snapshot that belongs to a csv file.
+    """
+
+    return csv_path + '.snapshot'
+
+def file_hash(path: str) -> str:
+    """
+    Returns the sha256 of a file, read in blocks.
+    """
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def snapshot_parts(store: ColumnStore, metadata: dict) -> list:
+    """
+    Returns the buffers that make up the snapshot of a store, in order. The columns
+    are not copied. The metadata is saved in the header.
+    """
+
+    columns = [(name, getattr(store, name)) for name in NUMERIC_COLUMNS]
+    columns += [(name, getattr(store, name).codes) for name in DICTIONARY_COLUMNS]
+
+    # offsets are relative to the start of the data section
+    layout = {}
+    offset = 0
+    for name, column in columns:
+        size = len(column) * column.itemsize
+        typecode = getattr(column, 'typecode', None) or column.format
+        layout[name] = [offset, size, typecode, column.itemsize]
+        offset += size + (-size % ALIGNMENT)
+    header = json.dumps(dict(metadata, **{
+        'byteorder': sys.byteorder,
+        'rows': len(store),
+        'columns': layout,
+        'dictionaries': {name: getattr(store, name).values for name in DICTIONARY_COLUMNS},
+    })).encode('utf-8')
+    header += b' ' * (-(PREAMBLE.size + len(header)) % ALIGNMENT)
+
+    parts = [PREAMBLE.pack(MAGIC, VERSION, len(header)), header]
+    for _, column in columns:
+        data = memoryview(column).cast('B')
+        parts.append(data)
+        parts.append(b'\0' * (-len(data) % ALIGNMENT))
+    return parts
+
+def read_snapshot(buffer):
+    """
+    Reads a snapshot from a buffer (a memory mapping or shared memory) and returns
+    (header, store). The columns of the store are views into the buffer.
+    Raises ValueError if the buffer does not hold a snapshot that can be used here.
+    """
+
+    try:
+        magic, version, header_size = PREAMBLE.unpack_from(buffer)
+    except struct.error as error:
+        raise ValueError("truncated snapshot") from error
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"snapshot version {version} is not supported")
+    try:
+        header = json.loads(bytes(buffer[PREAMBLE.size:PREAMBLE.size + header_size]))
+        layout = header['columns']
+        byteorder = header['byteorder']
+    except KeyError as error:
+        raise ValueError("incomplete snapshot header") from error
+    if byteorder != sys.byteorder:
+        raise ValueError("snapshot built on another platform")
+
+    data = memoryview(buffer)[PREAMBLE.size + header_size:]
+    columns = {}
+    for name, (offset, size, typecode, itemsize) in layout.items():
+        view = data[offset:offset + size].cast(typecode)
+        if view.itemsize != itemsize:
+            raise ValueError("snapshot built on another platform")
+        columns[name] = view
+
+    store = ColumnStore()
+    for name in NUMERIC_COLUMNS:
+        setattr(store, name, columns[name])
+    for name in DICTIONARY_COLUMNS:
+        column = DictionaryColumn()
+        column.values = header['dictionaries'][name]
+        column.index = {value: code for code, value in enumerate(column.values)}
+        column.codes = columns[name]
+        setattr(store, name, column)
+    return header, store
+
+def write_snapshot(store: ColumnStore, csv_path: str, path: str = None) -> str:
+    """
+    Writes the store to a snapshot file and returns its path.
+    The file is written under a temporary name and renamed, so readers never see a
+    partial snapshot.
+    """
+
+    path = path or snapshot_path(csv_path)
+    stat = os.stat(csv_path)
+    metadata = {
+        'csv_size': stat.st_size,
+        'csv_mtime_ns': stat.st_mtime_ns,
+        'csv_sha256': file_hash(csv_path),
+    }
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as file:
+        for part in snapshot_parts(store, metadata):
+            file.write(part)
+    os.replace(temp_path, path)
+    return path
+
+def is_fresh(header: dict, csv_path: str) -> bool:
+    """
+    Checks if a snapshot header still matches the csv file. The hash is only computed
+    when the size matches but the modification time does not.
+    """
+
+    stat = os.stat(csv_path)
+    if header['csv_size'] != stat.st_size:
+        return False
+    if header['csv_mtime_ns'] == stat.st_mtime_ns:
+        return True
+    return header['csv_sha256'] == file_hash(csv_path)
+
+def load_snapshot(csv_path: str, path: str = None):
+    """
+    Memory-maps the snapshot of a csv file and returns a read-only ColumnStore whose
+    columns are views into the mapping. Returns None if there is no valid snapshot.
+    """
+
+    path = path or snapshot_path(csv_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as file:
+        try:
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            return None
+    try:
+        header, store = read_snapshot(mapping)
+        if not is_fresh(header, csv_path):
+            logger.info("Ignoring stale snapshot %s", path)
+            return None
+    except (ValueError, KeyError) as error:
+        logger.info("Ignoring snapshot %s: %s", path, error)
+        return None
+    return store
+
+def main(argv=None):
+    """
+    Builds the snapshots of the csv files given on the command line.
+    """
+
+    # imported here, the data ingestor module imports this one
+    from app.data_ingestor import DataIngestor
+
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        print("usage: python build_snapshot.py file.csv [file.csv ...]", file=sys.stderr)
+        return 2
+    for csv_path in argv:
+        ingestor = DataIngestor(csv_path)
+        path = write_snapshot(ingestor.store, csv_path)
+        print(f"{csv_path}: {len(ingestor.store)} rows -> {path}")
+    return 0
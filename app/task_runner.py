@@ -1,12 +1,46 @@
 """
-This module implements ThreadPool and TaskRunner classes.
+This module implements ThreadPool, JobCalculator and TaskRunner classes.
 """
 
+import heapq
 import json
+import logging
 import os
+import time
+from types import SimpleNamespace
 from queue import Queue
 from threading import Thread, Event
 from app.data_ingestor import DataIngestor
+from app.dataset_registry import DatasetRegistry
+from app.aggregation import MeanReducer, StatsReducer
+from app.result_cache import ResultCache
+from app.job_coalescer import JobCoalescer
+from app.job_notifier import JobNotifier
+from app.result_store import FileResultStore
+from app.encoding import dumps
+from app.metrics import Metrics
+
+logger = logging.getLogger('webserver')
+
+# job types answered by a JobCalculator.calculate_<type> method
+JOB_TYPES = ("states_mean", "state_mean", "best5", "worst5", "global_mean", "diff_from_mean",
+             "state_diff_from_mean", "mean_by_category", "state_mean_by_category", "topk",
+             "state_stats", "states_stats", "stats_by_category", "state_trend", "states_trend",
+             "batch")
+# job types that can be sent in a batch, batches are not nested
+BATCH_JOB_TYPES = JOB_TYPES[:-1]
+
+def job_years(data: dict):
+    """
+    Returns the (year_from, year_to) range of a job, or None if it covers all the years.
+    """
+
+    if not isinstance(data, dict):
+        return None
+    year_from, year_to = data.get('year_from'), data.get('year_to')
+    if year_from is None and year_to is None:
+        return None
+    return (year_from, year_to)
 
 class ThreadPool:
     """
@@ -14,7 +48,10 @@ class ThreadPool:
     """
 
     def __init__(self, given_queue: Queue, given_job_status: dict,
-                data_ingestor: DataIngestor):
+                datasets: DatasetRegistry, num_threads: int = None, cache: ResultCache = None,
+                coalescer: JobCoalescer = None, notifier: JobNotifier = None,
+                result_store=None, journal=None, metrics: Metrics = None,
+                runner_class: type = None, **runner_options):
         # You must implement a ThreadPool of TaskRunners
         # Your ThreadPool should check if an environment variable TP_NUM_OF_THREADS is defined
         # If the env var is defined, that is the number of threads to be used by the thread pool
@@ -32,12 +69,20 @@ class ThreadPool:
         max_threads = os.cpu_count()
         if 'TP_NUM_OF_THREADS' in os.environ:
             max_threads = int(os.environ['TP_NUM_OF_THREADS'])
+        if num_threads is not None:
+            max_threads = num_threads
         self.threads = []
+        # TaskRunner, or a subclass that computes the jobs elsewhere
+        runner_class = runner_class or TaskRunner
 
         # Create threads
         for i in range(max_threads):
-            self.threads.append(TaskRunner(self.queue, self.job_status,
-                                           self.shutdown_event, data_ingestor, i))
+            self.threads.append(runner_class(self.queue, self.job_status,
+                                             self.shutdown_event, datasets.current(), i,
+                                             datasets=datasets, cache=cache,
+                                             coalescer=coalescer, notifier=notifier,
+                                             result_store=result_store, journal=journal,
+                                             metrics=metrics, **runner_options))
 
     def start(self):
         """
@@ -57,90 +102,89 @@ class ThreadPool:
         for thread in self.threads:
             thread.join()
 
-class TaskRunner(Thread):
+class JobCalculator:
     """
-    This class implements a thread that will process jobs from the queue.
+    This class computes the results of the jobs with lookups in the precomputed aggregates
+    of a dataset. It is not a thread: the runners compute their jobs with it, and so do
+    the requests answered inline.
     """
 
-    def __init__(self, given_queue: Queue, given_job_status: dict,
-                 shutdown_event: Event, data_ingestor: DataIngestor, thread_id: int):
-        super().__init__()
-        self.queue = given_queue
-        self.shutdown_event = shutdown_event
+    def __init__(self, data_ingestor: DataIngestor):
         self.data_ingestor = data_ingestor
-        self.thread_id = thread_id
-        self.job_status = given_job_status
+        # (year_from, year_to) of the job being computed, None for all the years
+        self.years = None
+
+    def means(self, grouping: str, *keys) -> dict:
+        """
+        Returns {key: mean} for the level under the given keys of a precomputed grouping.
+        """
+
+        node = self.data_ingestor.aggregates.lookup(grouping, keys, self.years) or {}
+        return {key: MeanReducer.result(state) for key, state in node.items()}
+
+    def mean(self, grouping: str, *keys) -> float:
+        """
+        Returns the mean under the given keys of a precomputed grouping, or 0 if there is none.
+        """
+
+        state = self.data_ingestor.aggregates.lookup(grouping, keys, self.years)
+        return MeanReducer.result(state or MeanReducer.new())
+
+    def state_means(self, question):
+        """
+        Returns the mean of every state for a given question.
+        """
+
+        return self.means('by_location', question)
+
+    def top_states(self, question: str, k: int, order: str = "best", ties: str = "first") -> dict:
+        """
+        Selects the k best (or worst) states for a question with a heap, without sorting
+        all the states. Ties are broken by state name; with ties="all" every state equal
+        to the k-th one is also kept. The result is in ascending order of the means.
+        """
+
+        means = self.state_means(question)
+        # lower values are better for the questions in questions_best_is_min
+        lowest = (order == "best") == (question in self.data_ingestor.questions_best_is_min)
+        select = heapq.nsmallest if lowest else heapq.nlargest
+        chosen = select(k, means.items(), key=lambda item: (item[1], item[0]))
+        if ties == "all" and chosen:
+            boundary = chosen[-1][1]
+            names = {state for state, _ in chosen}
+            chosen += [(state, mean) for state, mean in means.items()
+                       if mean == boundary and state not in names]
+        return dict(sorted(chosen, key=lambda item: (item[1], item[0])))
+
+    def calculate_topk(self, job):
+        """
+        Calculates the k best or worst states for a given question.
+        """
+
+        return self.top_states(job.data['question'], int(job.data.get('k', 5)),
+                               job.data.get('order', "best"), job.data.get('ties', "first"))
 
     def calculate_worst5(self, job):
         """
         Calculates the 5 worst-performing states for a given question.
         """
 
-        question = job.data['question']
-        sums = {}
-        counts = {}
-        for q in self.data_ingestor.questions:
-            if q.question == question:
-                if q.location not in sums:
-                    sums[q.location] = 0.0
-                    counts[q.location] = 0
-                sums[q.location] += q.data_value
-                counts[q.location] += 1
-        for state in sums:
-            if counts[state] > 0:
-                sums[state] = sums[state] / counts[state]
-        result = dict(sorted(sums.items(), key=lambda item: item[1], reverse=False))
-        # search in best_is_min or best_is_max
-        if not question in self.data_ingestor.questions_best_is_min:
-            result = dict(list(result.items())[:5])
-        else:
-            result = dict(list(result.items())[-5:])
-        return result
+        return self.top_states(job.data['question'], 5, "worst")
 
     def calculate_best5(self, job):
         """
         Calculates the 5 best-performing states for a given question."
         """
 
-        question = job.data['question']
-        sums = {}
-        counts = {}
-        for q in self.data_ingestor.questions:
-            if q.question == question:
-                if q.location not in sums:
-                    sums[q.location] = 0.0
-                    counts[q.location] = 0
-                sums[q.location] += q.data_value
-                counts[q.location] += 1
-        for state in sums:
-            if counts[state] > 0:
-                sums[state] = sums[state] / counts[state]
-        result = dict(sorted(sums.items(), key=lambda item: item[1]))
-        # search in best_is_min or best_is_max
-        if question in self.data_ingestor.questions_best_is_min:
-            result = dict(list(result.items())[:5])
-        else:
-            result = dict(list(result.items())[-5:])
-        return result
+        return self.top_states(job.data['question'], 5, "best")
 
     def calculate_state_mean(self, job):
         """
         Calculates the mean for a given question and state.
         """
 
-        question = job.data['question']
         state = job.data['state']
-        float_result = 0.0
-        count = 0
-        # access questions from data_ingestor
-        for q in self.data_ingestor.questions:
-            if q.question == question and q.location == state:
-                float_result += q.data_value
-                count += 1
-        if count > 0:
-            float_result = float_result / count
-        result = {state: float_result}
-        return result
+        return {state: self.mean('by_location', job.data['question'], state)}
 
     def calculate_states_mean(self, job):
         """
@@ -148,96 +192,32 @@ class TaskRunner(Thread):
         """
 
         question = job.data['question']
-        result = {}
-        count = {}
-        for q in self.data_ingestor.questions:
-            if q.question == question:
-                if q.location not in result:
-                    result[q.location] = 0.0
-                    count[q.location] = 0
-                result[q.location] += q.data_value
-                count[q.location] += 1
-        for state in result:
-            if count[state] > 0:
-                result[state] = result[state] / count[state]
-        result = dict(sorted(result.items(), key=lambda item: item[1]))
-        return result
+        return dict(sorted(self.state_means(question).items(), key=lambda item: item[1]))
 
     def calculate_global_mean(self, job):
         """
         Calculates the global mean for a given question.
         """
 
-        question = job.data['question']
-        float_result = 0.0
-        count = 0
-        for q in self.data_ingestor.questions:
-            if q.question == question:
-                float_result += q.data_value
-                count += 1
-        if count > 0:
-            float_result = float_result / count
-        result = {"global_mean": float_result}
-        return result
+        return {"global_mean": self.mean('by_question', job.data['question'])}
 
     def calculate_diff_from_mean(self, job):
         """
         Calculates the difference from the mean for a given question and all states.
         """
 
-        question = job.data['question']
-        result = {}
-        count = {}
-        for q in self.data_ingestor.questions:
-            if q.question == question:
-                if q.location not in result:
-                    result[q.location] = 0.0
-                    count[q.location] = 0
-                result[q.location] += q.data_value
-                count[q.location] += 1
-        for state in result:
-            if count[state] > 0:
-                result[state] = result[state] / count[state]
-        result = dict(sorted(result.items(), key=lambda item: item[1]))
-        global_mean = 0.0
-        global_count = 0
-        for q in self.data_ingestor.questions:
-            if q.question == question:
-                global_mean += q.data_value
-                global_count += 1
-        if global_count > 0:
-            global_mean = global_mean / global_count
-        for state in result:
-            result[state] = - result[state] + global_mean
-        return result
+        global_mean = self.calculate_global_mean(job)["global_mean"]
+        return {state: - mean + global_mean
+                for state, mean in self.calculate_states_mean(job).items()}
 
     def calculate_state_diff_from_mean(self, job):
         """
         Calculates the difference from the mean for a given question and state.
         """
 
-        question = job.data['question']
         state = job.data['state']
-        float_result = 0.0
-        count = 0
-        # access questions from data_ingestor
-        for q in self.data_ingestor.questions:
-            if q.question == question and q.location == state:
-                float_result += q.data_value
-                count += 1
-        if count > 0:
-            float_result = float_result / count
-        global_mean = 0.0
-        global_count = 0
-        for q in self.data_ingestor.questions:
-            if q.question == question:
-                global_mean += q.data_value
-                global_count += 1
-        if global_count > 0:
-            global_mean = global_mean / global_count
-        float_result = - float_result + global_mean
-        result = {state: float_result}
-        return result
+        global_mean = self.calculate_global_mean(job)["global_mean"]
+        return {state: - self.calculate_state_mean(job)[state] + global_mean}
 
     def calculate_state_mean_by_category(self, job):
         """
@@ -246,25 +226,13 @@ class TaskRunner(Thread):
 
         question = job.data['question']
         state = job.data['state']
-        result = {}
-        count = {}
-        for q in self.data_ingestor.questions:
-            if q.question == question and q.location == state:
-                # concat StratificationCategory1,Stratification1
-                concat = f"('{q.stratification_category1}', '{q.stratification1}')"
-                if concat not in result:
-                    result[concat] = 0.0
-                    count[concat] = 0
-                result[concat] += q.data_value
-                count[concat] += 1
-        for strat in result:
-            if count[strat] > 0:
-                result[strat] = result[strat] / count[strat]
+        # concat StratificationCategory1,Stratification1
+        result = {f"('{strat_category1}', '{strat1}')": mean for (strat_category1, strat1), mean
+                  in self.means('by_category', question, state).items()}
         # sort alphabetically the result
         result = dict(sorted(result.items(), key=lambda item: item[0]))
         # put the state : result
-        result = {state: result}
-        return result
+        return {state: result}
 
     def calculate_mean_by_category(self, job):
         """
@@ -273,64 +241,189 @@ class TaskRunner(Thread):
 
         question = job.data['question']
         result = {}
-        count = {}
-        for q in self.data_ingestor.questions:
-            if q.question == question:
+        tree = self.data_ingestor.aggregates.lookup('by_category', (question,), self.years) or {}
+        for location, node in tree.items():
+            for (strat_category1, strat1), state in node.items():
                 # concat State, StratificationCategory1, Stratification1
                 # for json entry
                 # if one of the values is None or empty, skip
-                if q.location == "" or q.stratification_category1 == "" or q.stratification1 == "":
+                if location == "" or strat_category1 == "" or strat1 == "":
                     continue
-                location = q.location
-                strat_category1 = q.stratification_category1
-                strat1 = q.stratification1
-                concat =f"('{location}', '{strat_category1}', '{strat1}')"
-                if concat not in result:
-                    result[concat] = 0.0
-                    count[concat] = 0
-                result[concat] += q.data_value
-                count[concat] += 1
-        for strat in result:
-            if count[strat] > 0:
-                result[strat] = result[strat] / count[strat]
+                result[f"('{location}', '{strat_category1}', '{strat1}')"] = \
+                    MeanReducer.result(state)
         return result
 
-    def find_job(self):
+    def statistics(self, grouping: str, *keys) -> dict:
         """
-        When there is a job in the queue, it is processed.
+        Returns {key: statistics} for the level under the given keys of a precomputed
+        statistics grouping.
         """
 
-        job = self.queue.get()
-        # process the job, write in the result folder
-        result = None
+        node = self.data_ingestor.aggregates.lookup(grouping, keys, self.years) or {}
+        return {key: StatsReducer.result(state) for key, state in node.items()}
+
+    def calculate_state_stats(self, job):
+        """
+        Calculates the count, mean, standard deviation, extremes, median and p90 for a
+        given question and state.
+        """
+
+        state = job.data['state']
+        node = self.data_ingestor.aggregates.lookup('stats_by_location',
+                                                    (job.data['question'], state), self.years)
+        return {state: StatsReducer.result(node or StatsReducer.new())}
+
+    def calculate_states_stats(self, job):
+        """
+        Calculates the statistics of every state for a given question.
+        """
+
+        result = self.statistics('stats_by_location', job.data['question'])
+        # sort alphabetically the result
+        return dict(sorted(result.items(), key=lambda item: item[0]))
 
-        if job.type == "worst5":
-            result = self.calculate_worst5(job)
+    def calculate_stats_by_category(self, job):
+        """
+        Calculates the statistics for a given question, stratified by category, over
+        all the states.
+        """
+
+        result = {f"('{strat_category1}', '{strat1}')": statistics
+                  for (strat_category1, strat1), statistics
+                  in self.statistics('stats_by_stratification', job.data['question']).items()}
+        # sort alphabetically the result
+        return dict(sorted(result.items(), key=lambda item: item[0]))
 
-        if job.type == "best5":
-            result = self.calculate_best5(job)
+    @staticmethod
+    def trend(means: dict) -> dict:
+        """
+        Returns the means of a time series in year order and the slope of the least
+        squares line through them, in value per year (0 for less than two years).
+        """
 
-        if job.type == "state_mean":
-            result = self.calculate_state_mean(job)
+        years = sorted(means)
+        slope = 0.0
+        if len(years) > 1:
+            mean_year = sum(years) / len(years)
+            mean_value = sum(means.values()) / len(years)
+            slope = (sum((year - mean_year) * (means[year] - mean_value) for year in years)
+                     / sum((year - mean_year) ** 2 for year in years))
+        return {"means": {str(year): means[year] for year in years}, "slope": slope}
 
-        if job.type == "states_mean":
-            result = self.calculate_states_mean(job)
+    def calculate_state_trend(self, job):
+        """
+        Calculates the mean of every year and the trend for a given question and state.
+        """
+
+        state = job.data['state']
+        return {state: self.trend(self.means('by_year', job.data['question'], state))}
+
+    def calculate_states_trend(self, job):
+        """
+        Calculates the mean of every year and the trend for a given question and all states.
+        """
+
+        question = job.data['question']
+        tree = self.data_ingestor.aggregates.lookup('by_year', (question,), self.years) or {}
+        return {state: self.trend({year: MeanReducer.result(value)
+                                   for year, value in node.items()})
+                for state, node in sorted(tree.items())}
 
-        if job.type == "global_mean":
-            result = self.calculate_global_mean(job)
+    def answer_query(self, query: dict):
+        """
+        Calculates one query of a batch, or returns an error if it can not be answered.
+        """
+
+        if query.get('type') not in BATCH_JOB_TYPES:
+            return {"error": f"unknown job type {query.get('type')}"}
+        try:
+            return self.compute(SimpleNamespace(type=query['type'], data=query))
+        except (KeyError, TypeError, ValueError) as error:
+            return {"error": f"invalid query: {error}"}
+
+    def calculate_batch(self, job):
+        """
+        Calculates every query of a batch on the same dataset version. The answers are
+        lookups in the precomputed groupings, so the batch costs no scan of the rows;
+        identical queries are answered once. A query that can not be answered gets an
+        error instead of failing the whole batch.
+        """
+
+        answers = {}
+        results = []
+        for query in job.data['queries']:
+            key = json.dumps(query, sort_keys=True)
+            if key not in answers:
+                answers[key] = self.answer_query(query)
+            results.append(answers[key])
+        return {"results": results}
+
+    def encode_job(self, job) -> str:
+        """
+        Computes a job and encodes its result as json.
+        """
+
+        return dumps(self.compute(job))
+
+    def compute(self, job):
+        """
+        Computes the result of a job with its calculate_<type> method.
+        """
 
-        if job.type == "diff_from_mean":
-            result = self.calculate_diff_from_mean(job)
+        if job.type not in JOB_TYPES:
+            return {"error": f"unknown job type {job.type}"}
+        self.years = job_years(job.data)
+        return getattr(self, f"calculate_{job.type}")(job)
 
-        if job.type == "state_diff_from_mean":
-            result = self.calculate_state_diff_from_mean(job)
+class TaskRunner(JobCalculator, Thread):
+    """
+    This class implements a thread that will process jobs from the queue. The jobs are
+    computed by its JobCalculator methods, on the dataset version of each job.
+    """
 
-        if job.type == "state_mean_by_category":
-            result = self.calculate_state_mean_by_category(job)
+    def __init__(self, given_queue: Queue, given_job_status: dict,
+                 shutdown_event: Event, data_ingestor: DataIngestor, thread_id: int,
+                 datasets: DatasetRegistry = None, cache: ResultCache = None,
+                 coalescer: JobCoalescer = None, notifier: JobNotifier = None,
+                 result_store=None, journal=None, metrics: Metrics = None):
+        Thread.__init__(self)
+        JobCalculator.__init__(self, data_ingestor)
+        self.queue = given_queue
+        self.shutdown_event = shutdown_event
+        # when set, every job reads the dataset version that is current when it starts
+        self.datasets = datasets
+        self.dataset_version = None
+        # encoded results of recent jobs, shared by all the threads
+        self.cache = cache
+        # followers of coalesced jobs, completed with the result of their leader
+        self.coalescer = coalescer
+        # wakes up the clients waiting for a job to be done
+        self.notifier = notifier
+        # where the results are kept until they are read, results/<job_id> by default
+        self.result_store = result_store or FileResultStore()
+        # records when the jobs start, the result store records when they are done
+        self.journal = journal
+        # latencies and counters of this runner, written without locks
+        self.metrics = metrics.worker(thread_id) if metrics is not None else None
+        self.thread_id = thread_id
+        self.job_status = given_job_status
 
-        if job.type == "mean_by_category":
-            result = self.calculate_mean_by_category(job)
+    def find_job(self):
+        """
+        When there is a job in the queue, it is processed.
+        """
 
+        job = self.queue.get()
+        started = time.monotonic()
+        if self.datasets is not None and job.type != "shutdown":
+            # jobs queued while the dataset is loading wait for it here
+            self.datasets.wait_ready()
+            # keep this version for the whole job, even if a new one is published
+            self.dataset_version, self.data_ingestor = self.datasets.current_version()
+            if self.data_ingestor is None:
+                # the dataset failed to load, there is nothing to compute on
+                self.finish_job(job, dumps({"error": "dataset not loaded"}))
+                return
         if job.type == "shutdown":
             # shutdown the thread
             self.shutdown_event.set()
@@ -338,14 +431,69 @@ class TaskRunner(Thread):
             del self.job_status[int(job.job_id)]
             return
 
-        # write the result to disk (file with job_id name)
-        with open(f"results/{job.job_id}", 'w', encoding='utf-8') as file:
-            # clear the file, if it exists
-            file.write('')
-            file.write(json.dumps(result))
-        # set the job status to done
-        self.job_status[int(job.job_id)] = "done"
+        if self.journal is not None:
+            self.journal.start(int(job.job_id))
+        # process the job, write in the result folder
+        try:
+            encoded = self.encoded_result(job)
+        except Exception as error:  # pylint: disable=broad-except
+            # a job that can not be computed is done with an error, the runner goes on
+            logger.error("[ERROR] Job %s (%s) failed: %r", job.job_id, job.type, error)
+            encoded = dumps({"status": "error", "reason": f"invalid request: {error}"})
+        computed = time.monotonic()
+        self.finish_job(job, encoded)
+        if self.metrics is not None:
+            wait = started - job.enqueued_at if job.enqueued_at is not None else 0.0
+            self.metrics.observe_job(job.type, wait, computed - started)
+            self.metrics.busy_seconds += time.monotonic() - started
+
+    def finish_job(self, job, encoded: str):
+        """
+        Writes the result of a job and of the identical jobs attached to it.
+        """
+
+        try:
+            self.write_result(job, encoded)
+        finally:
+            # the followers are released even if the result could not be stored, so the
+            # next identical job does not attach to this one
+            if self.coalescer is not None and job.coalesce_key is not None:
+                for follower_id in self.coalescer.complete(job.coalesce_key):
+                    self.write_result_for(follower_id, encoded)
+
+    def encoded_result(self, job) -> str:
+        """
+        Returns the json result of a job, taken from the cache when possible.
+        """
+
+        if self.cache is None:
+            return self.encode_job(job)
+        key = ResultCache.key(job.type, job.data, self.dataset_version)
+        encoded = self.cache.get(key)
+        if encoded is None:
+            encoded = self.encode_job(job)
+            self.cache.put(key, encoded)
+        return encoded
+
+    def write_result(self, job, encoded: str):
+        """
+        Stores the json result of a job and marks the job as done.
+        """
 
+        self.write_result_for(job.job_id, encoded)
+
+    def write_result_for(self, job_id: int, encoded: str):
+        """
+        Stores a json result for a job id and marks the job as done.
+        """
+
+        self.result_store.put(int(job_id), encoded)
+        # set the job status to done
+        self.job_status[int(job_id)] = "done"
+        if self.metrics is not None:
+            self.metrics.results_written += 1
+        if self.notifier is not None:
+            self.notifier.notify(int(job_id))
 
     def run(self):
         """
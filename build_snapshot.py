@@ -0,0 +1,8 @@
+"""
+Builds the binary snapshot of the dataset ahead of a deploy.
+Usage: python build_snapshot.py file.csv [file.csv ...]
+"""
+import sys
+from app.snapshot import main
+
+sys.exit(main())
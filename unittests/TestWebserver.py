@@ -1,7 +1,28 @@
+import gzip
+import json
+import os
+import pickle
+import shutil
+import zlib
+import statistics
+import tempfile
 import unittest
+from threading import Event
 from app.data_ingestor import DataIngestor
+from app.dataset_registry import DatasetRegistry
+from app import parallel_ingest
+from app import create_app
+from app.aggregation import Grouping, aggregate, store_rows
+from app.result_cache import ResultCache
+from app.question import Question
 from app.task_runner import TaskRunner
 from app.routes import Job
+from app.job_scheduler import JobScheduler, priority_class
+from app.job_table import JobTable, SCAN_CHUNK
+from app.sketches import TDigest
+from app.result_store import FileResultStore, MemoryResultStore
+from app.encoding import dumps
+from app.process_backend import ProcessBackend, ProcessTaskRunner
 
 class TestWebserver(unittest.TestCase):
     def setUp(self):
@@ -9,6 +30,29 @@ class TestWebserver(unittest.TestCase):
         self.data_ingestor = DataIngestor("./unittests/data_subset.csv")
         # instance of class TaskRunner with the data_ingestor
         self.task_runner = TaskRunner(None, None, None, self.data_ingestor, 1)
+        # the files written by the apps of the tests
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
+    def create_test_app(self, config: dict = None):
+        """ Builds an app on data_subset.csv that writes its files in the test directory """
+
+        return create_app({'CSV_PATH': './unittests/data_subset.csv', 'NUM_THREADS': 0,
+                           'DATA_SNAPSHOT': False,
+                           'LOG_FILE': os.path.join(self.directory, 'webserver.log'),
+                           'RESULT_SEGMENT': os.path.join(self.directory, 'results.segment'),
+                           'RESULT_DIR': os.path.join(self.directory, 'results'),
+                           **(config or {})})
+
+    @staticmethod
+    def runner_for(webserver, thread_id: int = 0) -> TaskRunner:
+        """ Builds a runner of the jobs of an app, run by hand by the tests """
+
+        return TaskRunner(webserver.job_queue, webserver.job_status, Event(), None, thread_id,
+                          datasets=webserver.datasets, cache=webserver.result_cache,
+                          coalescer=webserver.job_coalescer, notifier=webserver.job_notifier,
+                          result_store=webserver.result_store, journal=webserver.job_journal,
+                          metrics=webserver.metrics)
 
     def test_calculate_worst5(self):
         """ Test the worst5 function """
@@ -253,4 +297,742 @@ class TestWebserver(unittest.TestCase):
             result = self.task_runner.calculate_state_mean_by_category(job)
             # check if the result is equal to the expected result
             self.assertEqual(result, expected_results[index])
-            index += 1
\ No newline at end of file
+            index += 1
+
+    def test_questions_view(self):
+        """ Test the Question view over the columnar store """
+
+        questions = self.data_ingestor.questions
+        self.assertEqual(len(questions), 159)
+        locations = [q.location for q in questions]
+        self.assertEqual(locations, sorted(locations))
+        self.assertEqual(questions[0].location, 'Alabama')
+        self.assertIsInstance(questions[-1].data_value, float)
+
+    def test_aggregate_index(self):
+        """ Test that the precomputed groupings agree with each other """
+
+        aggregates = self.data_ingestor.aggregates
+        for question in self.data_ingestor.questions_best_is_min + self.data_ingestor.questions_best_is_max:
+            count = aggregates.question_total(question)[1]
+            self.assertEqual(count, sum(c for _, c in aggregates.location_totals(question).values()))
+            self.assertEqual(count, sum(c for _, c in aggregates.stratification_totals(question).values()))
+        self.assertEqual(aggregates.location_total('unknown question', 'Utah'), [0.0, 0])
+
+    def test_streaming_ingest(self):
+        """ Test that streaming ingestion builds the same aggregates without keeping rows """
+
+        streamed = DataIngestor("./unittests/data_subset.csv", streaming=True, chunk_size=16)
+        self.assertEqual(len(streamed.questions), 0)
+        self.assertEqual(streamed.rows_loaded, len(self.data_ingestor.questions))
+        self.assertEqual(streamed.aggregates.by_location, self.data_ingestor.aggregates.by_location)
+        for question, (total, count) in self.data_ingestor.aggregates.by_question.items():
+            self.assertEqual(streamed.aggregates.question_total(question)[1], count)
+            self.assertAlmostEqual(streamed.aggregates.question_total(question)[0], total)
+
+    def test_snapshot(self):
+        """ Test that the binary snapshot is reused and rebuilt when the csv changes """
+
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, "data.csv")
+            shutil.copy("./unittests/data_subset.csv", csv_path)
+            DataIngestor(csv_path, use_snapshot=True)
+            self.assertTrue(os.path.exists(csv_path + ".snapshot"))
+
+            cached = DataIngestor(csv_path, use_snapshot=True)
+            self.assertIsInstance(cached.store.data_value, memoryview)
+            self.assertEqual(list(cached.questions), list(self.data_ingestor.questions))
+            self.assertEqual(cached.aggregates.by_category, self.data_ingestor.aggregates.by_category)
+
+            with open(csv_path, 'a', encoding='utf-8') as file:
+                file.write("\n,2020,2020,UT,Utah,,,,question,,,1.0,,,,,,,,,,,,,,,,,,,Total,Total,,")
+            reparsed = DataIngestor(csv_path, use_snapshot=True)
+            self.assertNotIsInstance(reparsed.store.data_value, memoryview)
+            self.assertEqual(len(reparsed.questions), len(self.data_ingestor.questions) + 1)
+
+    def test_append_rows(self):
+        """ Test that appending rows publishes a new version and leaves the old one intact """
+
+        datasets = DatasetRegistry(self.data_ingestor)
+        question = self.data_ingestor.questions_best_is_min[0]
+        job = Job(job_id=1, data={"question": question, "state": "Louisiana"}, type="state_mean", status="running")
+        version = datasets.append_rows([Question('Louisiana', 2020, 2020, question, 36.5, 'Total', 'Total')])
+        self.assertEqual(version, 2)
+        self.assertEqual(self.task_runner.calculate_state_mean(job), {'Louisiana': 34.5})
+        self.assertEqual(len(datasets.current().questions), len(self.data_ingestor.questions) + 1)
+
+        task_runner = TaskRunner(None, None, None, self.data_ingestor, 1, datasets=datasets)
+        task_runner.data_ingestor = datasets.current()
+        self.assertEqual(task_runner.calculate_state_mean(job), {'Louisiana': 35.5})
+        total, count = self.data_ingestor.aggregates.question_total(question)
+        self.assertEqual(task_runner.calculate_global_mean(job)['global_mean'],
+                         (total + 36.5) / (count + 1))
+        self.assertEqual(datasets.current().questions[-1],
+                         Question('Louisiana', 2020, 2020, question, 36.5, 'Total', 'Total'))
+
+        # rows appended while a reload reads its csv file are appended to the new version
+        row = Question('Louisiana', 2021, 2021, question, 40.5, 'Total', 'Total')
+        datasets = DatasetRegistry(self.data_ingestor, progress=lambda *_: (
+            datasets.reload_appends == [] and datasets.append_rows([row])))
+        self.assertEqual(datasets.reload("./unittests/data_subset.csv"), 3)
+        self.assertEqual(datasets.current().questions[-1], row)
+        self.assertEqual(len(datasets.current().questions), len(self.data_ingestor.questions) + 1)
+
+    def test_admin_endpoints(self):
+        """ Test the token and the data folder checks of the admin endpoints """
+
+        csv_path = os.path.join(self.directory, 'data.csv')
+        shutil.copy('./unittests/data_subset.csv', csv_path)
+        with open(os.path.join(self.directory, 'bad.csv'), 'w', encoding='utf-8') as file:
+            file.write('a,b\n1,2\n')
+        webserver = self.create_test_app({'CSV_PATH': csv_path})
+        client = webserver.test_client()
+        response = client.post('/api/admin/reload', json={"csv_path": "data.csv"})
+        self.assertEqual(response.status_code, 403)
+        webserver.config['ADMIN_TOKEN'] = 'secret'
+        response = client.post('/api/admin/reload', json={"csv_path": "data.csv"},
+                               headers={'X-Admin-Token': 'guess'})
+        self.assertEqual(response.status_code, 401)
+
+        headers = {'X-Admin-Token': 'secret'}
+        for path in ("/etc/passwd", "../data.csv", "missing.csv", "bad.csv"):
+            response = client.post('/api/admin/reload', json={"csv_path": path}, headers=headers)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.get_json()["status"], "error")
+        for body in (["data.csv"], "data.csv", 1):
+            response = client.post('/api/admin/reload', json=body, headers=headers)
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(webserver.datasets.version, 1)
+        response = client.post('/api/admin/reload', json={"csv_path": "data.csv"}, headers=headers)
+        self.assertEqual(response.get_json(), {"status": "done", "version": 2, "rows": 159})
+
+    def test_parallel_ingest(self):
+        """ Test that parsing with several processes gives the same rows in the same order """
+
+        min_range_bytes = parallel_ingest.MIN_RANGE_BYTES
+        parallel_ingest.MIN_RANGE_BYTES = 4096
+        try:
+            self.assertEqual(len(parallel_ingest.split_ranges("./unittests/data_subset.csv", 4)), 4)
+            parallel = DataIngestor("./unittests/data_subset.csv", workers=4)
+        finally:
+            parallel_ingest.MIN_RANGE_BYTES = min_range_bytes
+        self.assertEqual(list(parallel.questions), list(self.data_ingestor.questions))
+        self.assertEqual(parallel.aggregates.by_question, self.data_ingestor.aggregates.by_question)
+
+    def test_create_app(self):
+        """ Test the readiness endpoint of apps built by the factory """
+
+        webserver = self.create_test_app()
+        response = webserver.test_client().get('/api/ready')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['rows_loaded'], 159)
+        # the next app opens the same result segment
+        webserver.result_store.close()
+
+        webserver = self.create_test_app({'CSV_PATH': os.path.join(self.directory, 'missing.csv'),
+                                          'LOAD_IN_BACKGROUND': True})
+        webserver.datasets.wait_ready()
+        client = webserver.test_client()
+        self.assertEqual(client.get('/api/ready').status_code, 503)
+        response = client.post('/api/global_mean', json={"question": "question"})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.get_json(), {"status": "error", "reason": "dataset failed"})
+
+    def test_aggregation_engine(self):
+        """ Test that several groupings are computed in one pass, with filters """
+
+        question = self.data_ingestor.questions_best_is_min[1]
+        store = self.data_ingestor.store
+        by_state, utah_by_year = aggregate(store_rows(store, question=question),
+                                           [Grouping(('location',)),
+                                            Grouping(('year_start',), where={'location': 'Utah'})])
+        self.assertEqual(by_state.table, self.data_ingestor.aggregates.location_totals(question))
+        self.assertEqual(utah_by_year.table, {2015: [24.9, 1]})
+        self.assertEqual(by_state.lookup('Utah'), [24.9, 1])
+        self.assertIsNone(by_state.lookup('Atlantis'))
+
+    def test_result_cache(self):
+        """ Test the LRU eviction, key canonicalization and counters of the result cache """
+
+        cache = ResultCache(max_entries=2)
+        key = ResultCache.key("state_mean", {"question": "q", "state": "Utah"}, 1)
+        self.assertEqual(key, ResultCache.key("state_mean", {"state": "Utah", "question": "q"}, 1))
+        self.assertNotEqual(key, ResultCache.key("state_mean", {"question": "q", "state": "Utah"}, 2))
+        cache.put(key, '{"Utah": 1.0}')
+        cache.put(("a",), '1')
+        self.assertEqual(cache.get(key), '{"Utah": 1.0}')
+        cache.put(("b",), '2')
+        self.assertIsNone(cache.get(("a",)))
+        self.assertEqual(cache.stats(), {"hits": 1, "misses": 1, "entries": 2, "bytes": 14})
+
+        # the byte budget counts utf-8 bytes: "é" takes 2 of them
+        small = ResultCache(max_bytes=12)
+        small.put(("c",), '{"é": 1.0}')
+        self.assertEqual(small.stats()["bytes"], 11)
+        small.put(("d",), '"ééééééé"')
+        self.assertIsNone(small.get(("d",)))
+        small.put(("e",), '"é"')
+        self.assertIsNone(small.get(("c",)))
+        self.assertEqual(small.stats()["bytes"], 4)
+
+        task_runner = TaskRunner(None, None, None, self.data_ingestor, 1, cache=cache)
+        job = Job(job_id=1, data={"question": self.data_ingestor.questions_best_is_min[0]},
+                  type="global_mean", status="running")
+        self.assertEqual(task_runner.encoded_result(job), dumps({"global_mean": 33.9076923076923}))
+        self.assertEqual(task_runner.encoded_result(job), dumps({"global_mean": 33.9076923076923}))
+        self.assertEqual(cache.stats()["hits"], 2)
+
+    def test_coalesce_jobs(self):
+        """ Test that identical jobs posted together are computed once """
+
+        webserver = self.create_test_app()
+        client = webserver.test_client()
+        data = {"question": self.data_ingestor.questions_best_is_min[0]}
+        job_ids = [client.post('/api/global_mean', json=data).get_json()["job_id"] for _ in range(3)]
+        job_ids.append(client.post('/api/states_mean', json=data).get_json()["job_id"])
+        self.assertEqual(webserver.job_queue.qsize(), 2)
+
+        task_runner = self.runner_for(webserver)
+        task_runner.find_job()
+        for job_id in job_ids[:3]:
+            self.assertEqual(client.get(f'/api/get_results/{job_id}').get_json(),
+                             {"status": "done", "data": {"global_mean": 33.9076923076923}})
+        self.assertEqual(client.get(f'/api/get_results/{job_ids[3]}').get_json(), {"status": "running"})
+
+    def test_invalid_jobs(self):
+        """ Test that identical invalid jobs are done with an error and do not stop the runner """
+
+        webserver = self.create_test_app()
+        client = webserver.test_client()
+        job_ids = [client.post('/api/states_mean', json={}).get_json()["job_id"] for _ in range(2)]
+        task_runner = self.runner_for(webserver)
+        task_runner.find_job()
+        for job_id in job_ids:
+            response = client.get(f'/api/get_results/{job_id}').get_json()
+            self.assertEqual(response["status"], "done")
+            self.assertEqual(response["data"]["status"], "error")
+
+        # the failed job released its key, a new identical job is computed again
+        job_id = client.post('/api/states_mean', json={}).get_json()["job_id"]
+        task_runner.find_job()
+        self.assertEqual(client.get(f'/api/get_results/{job_id}').get_json()["data"]["status"],
+                         "error")
+        self.assertTrue(webserver.job_queue.empty())
+
+    def test_calculate_topk(self):
+        """ Test the topk function with k, order and ties """
+
+        question = self.data_ingestor.questions_best_is_max[0]
+        job = Job(job_id=1, data={"question": question, "k": 4, "order": "worst"}, type="topk", status="running")
+        self.assertEqual(self.task_runner.calculate_topk(job),
+                         {'Puerto Rico': 26.6, 'Arkansas': 38.5, 'Virginia': 44.9, 'Kansas': 45.5})
+        job.data["ties"] = "all"
+        self.assertEqual(self.task_runner.calculate_topk(job),
+                         {'Puerto Rico': 26.6, 'Arkansas': 38.5, 'Virginia': 44.9, 'Kansas': 45.5,
+                          'Missouri': 45.5})
+        job.data = {"question": question, "k": 20}
+        self.assertEqual(len(self.task_runner.calculate_topk(job)), 7)
+        job.data = {"question": question, "k": 1}
+        self.assertEqual(self.task_runner.calculate_topk(job), {'Connecticut': 55.2})
+
+        # the parameters are checked when the job is posted
+        client = self.create_test_app().test_client()
+        for body in ([1], 5, {"question": question, "k": -1}):
+            response = client.post('/api/topk', json=body).get_json()
+            self.assertEqual(response["status"], "error")
+
+    def test_process_backend(self):
+        """ Test that jobs computed by the worker processes give the same results """
+
+        backend = ProcessBackend(1)
+        try:
+            task_runner = ProcessTaskRunner(None, {}, Event(), self.data_ingestor, 0, backend=backend)
+            task_runner.dataset_version = 1
+            for job_type in ("states_mean", "best5"):
+                job = Job(job_id=1, data={"question": self.data_ingestor.questions_best_is_min[1]},
+                          type=job_type, status="running")
+                self.assertEqual(task_runner.encode_job(job), self.task_runner.encode_job(job))
+            # the cheap jobs are computed in the runner thread
+            self.assertEqual(backend.blocks, {})
+            for job_type in ("mean_by_category", "states_stats", "stats_by_category"):
+                job = Job(job_id=1, data={"question": self.data_ingestor.questions_best_is_min[1]},
+                          type=job_type, status="running")
+                self.assertEqual(task_runner.encode_job(job), self.task_runner.encode_job(job))
+            self.assertEqual(list(backend.blocks), [1])
+            # a dead worker breaks the pool: the job is computed here and the pool replaced
+            executor = backend.executor
+            with self.assertRaises(Exception):
+                executor.submit(os._exit, 1).result()
+            self.assertEqual(task_runner.encode_job(job), self.task_runner.encode_job(job))
+            self.assertIsNot(backend.executor, executor)
+            self.assertEqual(task_runner.encode_job(job), self.task_runner.encode_job(job))
+            # a version is copied to shared memory only once
+            self.assertEqual(backend.publish(1, self.data_ingestor), backend.publish(1, None))
+        finally:
+            backend.stop()
+        self.assertEqual(backend.blocks, {})
+
+    def test_calculate_batch(self):
+        """ Test that a batch gives the answers of the separate jobs, in order """
+
+        question = self.data_ingestor.questions_best_is_min[1]
+        queries = [{"type": "global_mean", "question": question},
+                   {"type": "state_mean", "question": question, "state": "Utah"},
+                   {"type": "topk", "question": question, "k": 2},
+                   {"type": "state_mean", "question": question},
+                   {"type": "global_mean", "question": question}]
+        job = Job(job_id=1, data={"queries": queries}, type="batch", status="running")
+        results = self.task_runner.calculate_batch(job)["results"]
+        self.assertEqual(len(results), 5)
+        for query, result in zip(queries[:3], results):
+            single = Job(job_id=2, data=query, type=query["type"], status="running")
+            self.assertEqual(result, self.task_runner.compute(single))
+        self.assertIn("error", results[3])
+        self.assertEqual(results[4], results[0])
+
+        # the queries are checked when the batch is posted
+        client = self.create_test_app().test_client()
+        for body in ([1], "queries", {"queries": []}, {"queries": [{"type": "shutdown"}]}):
+            response = client.post('/api/batch', json=body).get_json()
+            self.assertEqual(response["status"], "error")
+
+    def test_job_table(self):
+        """ Test the eviction of the job table and the pages of /api/jobs """
+
+        table = JobTable(retention=10)
+        table.add(1, "best5")
+        for job_id in range(2, SCAN_CHUNK + 20):
+            table.add(job_id, "global_mean", "done")
+        # the old jobs are evicted, the running job 1 is kept apart until it is done
+        self.assertEqual((table.base, len(table.statuses)), (SCAN_CHUNK, 20))
+        self.assertEqual((table[1], table[2]), ("running", "done"))
+        self.assertEqual(table.page(0, 2, job_type="best5"), ([(1, "running")], None))
+        self.assertEqual(table.page(0, 1, status="done"), ([(SCAN_CHUNK, "done")], SCAN_CHUNK + 1))
+        table[1] = "done"
+        self.assertEqual((table[1], table.evicted_running), ("done", {}))
+        job_id = SCAN_CHUNK + 19
+        while table.base == SCAN_CHUNK:
+            job_id += 1
+            table.add(job_id, "global_mean", "done")
+        table.add(job_id + 1, "best5")
+        self.assertEqual((table.base, len(table.statuses)), (job_id - 9, 11))
+        self.assertEqual(table[5], "done")
+        self.assertEqual(table[job_id + 1], "running")
+        self.assertNotIn(job_id + 2, table)
+        self.assertEqual(table.page(0, 2), ([(job_id - 9, "done"), (job_id - 8, "done")],
+                                            job_id - 7))
+        self.assertEqual(table.page(0, 5, job_type="best5"), ([(job_id + 1, "running")], None))
+        self.assertEqual(table.page(0, 5, status="running", job_type="global_mean"), ([], None))
+
+        webserver = self.create_test_app()
+        client = webserver.test_client()
+        data = {"question": self.data_ingestor.questions_best_is_min[0]}
+        for year, job_type in enumerate(("global_mean", "best5", "global_mean", "worst5",
+                                         "global_mean")):
+            # different years, so the jobs are not coalesced
+            client.post(f'/api/{job_type}', json=dict(data, year_from=2011 + year))
+        self.runner_for(webserver).find_job()
+
+        response = client.get('/api/jobs?limit=2').get_json()
+        self.assertEqual(response, {"status": "done", "data": [{"1": "done"}, {"2": "running"}],
+                                    "next_cursor": 3})
+        response = client.get('/api/jobs?limit=2&cursor=3').get_json()
+        self.assertEqual(response["data"], [{"3": "running"}, {"4": "running"}])
+        response = client.get('/api/jobs?limit=2&cursor=5').get_json()
+        self.assertEqual(response, {"status": "done", "data": [{"5": "running"}],
+                                    "next_cursor": None})
+        response = client.get('/api/jobs?type=global_mean&status=running').get_json()
+        self.assertEqual(response["data"], [{"3": "running"}, {"5": "running"}])
+        response = client.get('/api/jobs?status=lost').get_json()
+        self.assertEqual(response["status"], "error")
+        response = client.get('/api/jobs?limit=0').get_json()
+        self.assertEqual(response["status"], "error")
+
+    def test_log_pipeline(self):
+        """ Test the sampled, json log written by the log thread """
+
+        webserver = self.create_test_app({'LOG_FORMAT': 'json',
+                                          'LOG_SAMPLING': {'/api/num_jobs': 3}})
+        client = webserver.test_client()
+        for _ in range(6):
+            client.get('/api/num_jobs')
+        client.get('/api/get_results/1')
+        # writes the queued records
+        webserver.logger.handlers[0].close()
+
+        with open(os.path.join(self.directory, 'webserver.log'), 'r', encoding='utf-8') as file:
+            entries = [json.loads(line) for line in file]
+        messages = [entry["message"] for entry in entries]
+        self.assertEqual(messages.count("Entering /api/num_jobs"), 2)
+        self.assertEqual(messages.count("Exiting /api/num_jobs with status done"), 2)
+        # errors are never sampled
+        self.assertIn("ERROR", [entry["level"] for entry in entries])
+        self.assertIn("Entering /api/get_results with: 1", messages)
+
+    def test_metrics(self):
+        """ Test the /metrics endpoint and the job count kept by the runners """
+
+        webserver = self.create_test_app()
+        client = webserver.test_client()
+        data = {"question": self.data_ingestor.questions_best_is_min[0]}
+        client.post('/api/global_mean', json=data)
+        client.post('/api/global_mean', json=dict(data, year_from=2011))
+        client.post('/api/best5', json=data)
+        self.assertEqual(client.get('/api/num_jobs').get_json()["data"], 3)
+
+        runner = self.runner_for(webserver, 7)
+        runner.find_job()
+        runner.find_job()
+        self.assertEqual(client.get('/api/num_jobs').get_json()["data"], 1)
+
+        response = client.get('/metrics')
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        lines = dict(line.rsplit(' ', 1) for line in response.get_data(as_text=True).splitlines()
+                     if not line.startswith('#'))
+        self.assertEqual(lines['job_queue_depth'], '1')
+        self.assertEqual(lines['jobs_pending'], '1')
+        self.assertEqual(lines['results_written_total'], '2')
+        self.assertEqual(lines['result_cache_misses'], '2')
+        self.assertEqual(lines['job_execution_seconds_count{type="global_mean"}'], '2')
+        self.assertEqual(lines['job_queue_wait_seconds_bucket{type="global_mean",le="+Inf"}'], '2')
+        self.assertNotIn('job_execution_seconds_count{type="best5"}', lines)
+        self.assertGreater(float(lines['worker_busy_seconds_total{worker="7"}']), 0.0)
+
+    def test_job_scheduler(self):
+        """ Test that cheap jobs go first and clients are served fairly """
+
+        scheduler = JobScheduler()
+        def job(job_id, type, client_id):
+            return Job(job_id=job_id, data={}, type=type, status="running", client_id=client_id)
+        scheduler.put(Job(job_id=0, data={}, type="shutdown", status="running"))
+        for job_id in range(1, 5):
+            scheduler.put(job(job_id, "mean_by_category", "flood"))
+        scheduler.put(job(5, "mean_by_category", "other"))
+        scheduler.put(job(6, "state_mean", "flood"))
+        self.assertEqual(scheduler.qsize(), 7)
+        order = [scheduler.get().job_id for _ in range(7)]
+        self.assertEqual(order, [6, 1, 5, 2, 3, 4, 0])
+        self.assertTrue(scheduler.empty())
+        self.assertEqual(scheduler.stats()["bulk"]["served"], 5)
+
+        # a client can demote its jobs, not promote them
+        promoted = Job(job_id=1, data={}, type="states_stats", status="running", priority="interactive")
+        demoted = Job(job_id=2, data={}, type="state_mean", status="running", priority="bulk")
+        self.assertEqual((priority_class(promoted), priority_class(demoted)), ("bulk", "bulk"))
+
+        # a bulk job is served after every interactive_share interactive jobs
+        scheduler = JobScheduler(interactive_share=2)
+        for job_id in range(1, 3):
+            scheduler.put(job(job_id, "states_stats", "bulk"))
+        for job_id in range(3, 9):
+            scheduler.put(job(job_id, "state_mean", "interactive"))
+        order = [scheduler.get().job_id for _ in range(8)]
+        self.assertEqual(order, [3, 4, 1, 5, 6, 2, 7, 8])
+
+    def test_wait_for_results(self):
+        """ Test the long-poll and event stream notifications of done jobs """
+
+        webserver = self.create_test_app()
+        client = webserver.test_client()
+        data = {"question": self.data_ingestor.questions_best_is_min[0]}
+        job_ids = [client.post(endpoint, json=data).get_json()["job_id"]
+                   for endpoint in ('/api/global_mean', '/api/states_mean')]
+        self.assertEqual(client.get(f'/api/get_results/{job_ids[0]}?wait=0.01').get_json(),
+                         {"status": "running"})
+        # the waiters drop the events they no longer need
+        self.assertEqual(webserver.job_notifier.events, {})
+        # a done job whose result is gone gets an error event
+        lost_id = client.post('/api/best5', json=data).get_json()["job_id"]
+        webserver.job_status[lost_id] = "done"
+        events = client.get(f'/api/events?job_ids={lost_id}&timeout=5').get_data(as_text=True)
+        self.assertIn('event: error\ndata: {"job_id": %d, "status": "error"' % lost_id, events)
+
+        task_runner = self.runner_for(webserver)
+        task_runner.start()
+        response = client.get(f'/api/get_results/{job_ids[0]}?wait=5')
+        self.assertEqual(response.get_json(),
+                         {"status": "done", "data": {"global_mean": 33.9076923076923}})
+        events = client.get(f'/api/events?job_ids={job_ids[0]},{job_ids[1]}&timeout=5')
+        self.assertEqual(events.get_data(as_text=True).count("event: done"), 2)
+        client.get(f'/api/get_results/{job_ids[0]}?wait=5')
+        self.assertEqual(webserver.job_notifier.events, {})
+        task_runner.shutdown_event.set()
+        webserver.job_queue.put(Job(job_id=0, data={}, type="shutdown", status="running"))
+        webserver.job_status[0] = "running"
+        task_runner.join()
+
+    def test_sync_answers(self):
+        """ Test that cheap or cached jobs are answered in the request with ?sync=1 """
+
+        webserver = self.create_test_app()
+        client = webserver.test_client()
+        data = {"question": self.data_ingestor.questions_best_is_min[0]}
+        self.assertEqual(client.post('/api/global_mean?sync=1', json=data).get_json(),
+                         {"status": "done", "data": {"global_mean": 33.9076923076923}})
+        self.assertEqual(webserver.job_counter.get_value(), 0)
+
+        # expensive jobs are queued, and answered inline once their result is cached
+        response = client.post('/api/mean_by_category?sync=1', json=data).get_json()
+        self.assertEqual(response, {"job_id": 1})
+        self.runner_for(webserver).find_job()
+        response = client.post('/api/mean_by_category?sync=1', json=data).get_json()
+        self.assertEqual(response["status"], "done")
+        self.assertEqual(webserver.job_counter.get_value(), 1)
+
+        # invalid requests are answered with an error, no job is queued
+        response = client.post('/api/state_mean?sync=1', json=data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()["status"], "error")
+        self.assertEqual(webserver.job_counter.get_value(), 1)
+
+    def test_calculate_stats(self):
+        """ Test the statistics endpoints against exact computations """
+
+        question = self.data_ingestor.questions_best_is_min[1]
+        values = [row.data_value for row in self.data_ingestor.questions
+                  if row.question == question and row.location == "Arkansas"]
+        job = Job(job_id=1, data={"question": question, "state": "Arkansas"}, type="state_stats",
+                  status="running")
+        stats = self.task_runner.calculate_state_stats(job)["Arkansas"]
+        self.assertEqual(stats["count"], len(values))
+        self.assertAlmostEqual(stats["mean"], statistics.mean(values))
+        self.assertAlmostEqual(stats["stddev"], statistics.stdev(values))
+        self.assertAlmostEqual(stats["median"], statistics.median(values))
+        self.assertEqual((stats["min"], stats["max"]), (min(values), max(values)))
+
+        job.type = "states_stats"
+        self.assertEqual(self.task_runner.calculate_states_stats(job)["Arkansas"], stats)
+        job.type = "stats_by_category"
+        by_category = self.task_runner.calculate_stats_by_category(job)
+        self.assertEqual(sum(stats["count"] for stats in by_category.values()),
+                         len([row for row in self.data_ingestor.questions if row.question == question]))
+
+        # merged digests give the quantiles of all the values
+        digest, other = TDigest(), TDigest()
+        values = [float(value) for value in range(1000)]
+        for value in values[::2]:
+            digest.add(value)
+        for value in values[1::2]:
+            other.add(value)
+        digest.merge(other)
+        self.assertEqual(digest.count, 1000)
+        self.assertAlmostEqual(digest.quantile(0.5), 499.5, delta=5)
+        self.assertAlmostEqual(digest.quantile(0.9), 899.1, delta=5)
+
+        # the compressed centroids are kept between queries, until a value is added
+        digest = TDigest()
+        for value in (3.0, 1.0, 2.0):
+            digest.add(value)
+        self.assertEqual(digest.quantile(0.5), 2.0)
+        self.assertIsNotNone(digest.cached)
+        digest.add(10.0)
+        self.assertIsNone(digest.cached)
+        self.assertEqual(digest.quantile(1), 10.0)
+
+    def test_year_range(self):
+        """ Test that year_from and year_to only count the rows of overlapping periods """
+
+        question = self.data_ingestor.questions_best_is_min[1]
+        rows = [row for row in self.data_ingestor.questions
+                if row.question == question and row.year_end >= 2015 and row.year_start <= 2018]
+        expected = {}
+        for row in rows:
+            expected.setdefault(row.location, []).append(row.data_value)
+        job = Job(job_id=1, data={"question": question, "year_from": 2015, "year_to": 2018},
+                  type="states_mean", status="running")
+        result = self.task_runner.compute(job)
+        self.assertEqual(result.keys(), expected.keys())
+        for location, values in expected.items():
+            self.assertAlmostEqual(result[location], sum(values) / len(values))
+        job.type = "global_mean"
+        self.assertAlmostEqual(self.task_runner.compute(job)["global_mean"],
+                               sum(row.data_value for row in rows) / len(rows))
+        job.type = "mean_by_category"
+        self.assertEqual(len(self.task_runner.compute(job)),
+                         len({(row.location, row.stratification_category1, row.stratification1)
+                              for row in rows}))
+        # without a range the results do not change
+        job.data = {"question": question, "year_from": None}
+        self.assertEqual(self.task_runner.compute(job), self.task_runner.calculate_mean_by_category(job))
+
+        # the periods are built on the first ranged lookup, with the rows appended before it
+        data_ingestor = DataIngestor("./unittests/data_subset.csv")
+        self.assertTrue(data_ingestor.aggregates.pending)
+        appended = data_ingestor.with_rows([Question("Utah", 2016, 2016, question, 100.0,
+                                                     "Total", "Total")])
+        values = [row.data_value for row in self.data_ingestor.questions
+                  if row.question == question and row.location == "Utah"
+                  and row.year_start <= 2016 <= row.year_end] + [100.0]
+        job = Job(job_id=1, data={"question": question, "state": "Utah", "year_from": 2016,
+                                  "year_to": 2016}, type="state_mean", status="running")
+        result = TaskRunner(None, None, None, appended, 2).compute(job)
+        self.assertAlmostEqual(result["Utah"], sum(values) / len(values))
+        self.assertFalse(appended.aggregates.pending)
+        self.assertTrue(data_ingestor.aggregates.pending)
+        # a pickled index carries its periods
+        aggregates = pickle.loads(pickle.dumps(data_ingestor.aggregates))
+        self.assertEqual(aggregates.lookup('by_location', (question,), (2016, 2016)),
+                         data_ingestor.aggregates.lookup('by_location', (question,), (2016, 2016)))
+
+    def test_calculate_trend(self):
+        """ Test the per-year means and slopes of the trend endpoints """
+
+        question = self.data_ingestor.questions_best_is_min[1]
+        job = Job(job_id=1, data={"question": question}, type="states_trend", status="running")
+        trends = self.task_runner.compute(job)
+        for state, trend in trends.items():
+            job = Job(job_id=2, data={"question": question, "state": state}, type="state_trend",
+                      status="running")
+            self.assertEqual(self.task_runner.compute(job), {state: trend})
+            years = [int(year) for year in trend["means"]]
+            self.assertEqual(years, sorted(years))
+            for year, mean in trend["means"].items():
+                values = [row.data_value for row in self.data_ingestor.questions
+                          if row.question == question and row.location == state
+                          and row.year_start == int(year)]
+                self.assertAlmostEqual(mean, sum(values) / len(values))
+        self.assertEqual(TaskRunner.trend({2011: 10.0, 2012: 12.0, 2013: 14.0})["slope"], 2.0)
+        self.assertEqual(TaskRunner.trend({2011: 10.0})["slope"], 0.0)
+
+    def test_result_store(self):
+        """ Test that old results are spilled to the segment file and found after a restart """
+
+        path = os.path.join(self.directory, 'results.segment')
+        store = MemoryResultStore(path, max_bytes=40)
+        results = {job_id: f'{{"job_id": {job_id}, "mean": 0.5}}' for job_id in range(1, 6)}
+        for job_id, encoded in results.items():
+            store.put(job_id, encoded)
+        stats = store.stats()
+        self.assertEqual(stats["in_memory"] + stats["spilled"], 5)
+        self.assertGreater(stats["spilled"], 0)
+        self.assertLessEqual(stats["memory_bytes"], 40)
+        for job_id, encoded in results.items():
+            self.assertEqual(store.get(job_id).data, encoded.encode('utf-8'))
+        self.assertIsNone(store.get(6))
+
+        store.ttl = 0
+        store.put(6, '{}')
+        self.assertEqual(store.stats()["in_memory"], 0)
+        self.assertEqual(store.get(6).data, b'{}')
+        # a result stored again replaces the old one, and is counted once
+        store.ttl, store.max_bytes = 300, 1000000
+        store.put(6, '[]')
+        store.put(6, '[]')
+        self.assertEqual(store.get(6).data, b'[]')
+        self.assertEqual(store.stats()["memory_bytes"], store.get(6).size)
+        store.put(7, dumps(list(range(1000))))
+        etag, compressed = store.get(7).etag, store.get(7).encoded('gzip')
+        store.close()
+
+        # a new store finds the results of the old one, with the same ETags and bodies
+        store = MemoryResultStore(path)
+        with self.assertRaises(RuntimeError):
+            MemoryResultStore(path)
+        for job_id, encoded in results.items():
+            self.assertEqual(store.get(job_id).data, encoded.encode('utf-8'))
+        self.assertEqual(store.get(6).data, b'[]')
+        self.assertEqual((store.get(7).etag, store.get(7).encoded('gzip')), (etag, compressed))
+        store.close()
+
+        # a segment over its limit keeps only the newest results
+        store = MemoryResultStore(path, max_bytes=0, max_segment_bytes=10000)
+        self.assertEqual(store.stats()["spilled"], 7)
+        store.put(8, dumps(list(range(1000))))
+        self.assertFalse(store.has(1))
+        self.assertTrue(store.has(8))
+        self.assertLessEqual(store.stats()["segment_bytes"], 10000)
+        self.assertEqual(store.get(8).data, dumps(list(range(1000))).encode('utf-8'))
+        store.close()
+
+        # the written results are reported as durable by the sync that follows them
+        for store in (MemoryResultStore(path, max_bytes=0, fsync_interval=3600),
+                      FileResultStore(self.directory, fsync_interval=3600)):
+            durable = []
+            store.on_durable = lambda *job_ids: durable.extend(job_ids)
+            store.put(9, '{}')
+            store.put(10, '{}')
+            self.assertEqual(durable, [])
+            store.sync()
+            self.assertEqual(durable, [9, 10])
+            store.put(11, '{}')
+            store.close()
+            self.assertEqual(durable, [9, 10, 11])
+
+    def test_result_encoding(self):
+        """ Test the ETag, conditional GET and compressed forms of stored results """
+
+        webserver = self.create_test_app()
+        client = webserver.test_client()
+        data = {"question": self.data_ingestor.questions_best_is_min[0]}
+        job_id = client.post('/api/mean_by_category', json=data).get_json()["job_id"]
+        self.runner_for(webserver).find_job()
+
+        response = client.get(f'/api/get_results/{job_id}')
+        etag = response.headers['ETag']
+        self.assertEqual(response.get_json()["status"], "done")
+        response = client.get(f'/api/get_results/{job_id}', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        plain = client.get(f'/api/get_results/{job_id}').data
+        response = client.get(f'/api/get_results/{job_id}', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.data), plain)
+        response = client.get(f'/api/get_results/{job_id}', headers={'Accept-Encoding': 'deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(response.data), plain)
+        self.assertEqual(json.loads(plain)["data"], TaskRunner(
+            None, None, None, self.data_ingestor, 0).calculate_mean_by_category(
+                Job(job_id=1, data=data, type="mean_by_category", status="running")))
+
+    def test_job_journal(self):
+        """ Test that the job journal recovers the counter and the unfinished jobs """
+
+        config = {'JOB_JOURNAL': os.path.join(self.directory, 'jobs'), 'JOB_MAX_ATTEMPTS': 2}
+        webserver = self.create_test_app(config)
+        client = webserver.test_client()
+        data = {"question": self.data_ingestor.questions_best_is_min[0]}
+        lost_id = client.post('/api/global_mean', json=data).get_json()["job_id"]
+        self.runner_for(webserver).find_job()
+        pending_id = client.post('/api/states_mean', json=data).get_json()["job_id"]
+        failing_id = client.post('/api/best5', json=data).get_json()["job_id"]
+        webserver.job_journal.start(failing_id)
+        webserver.job_journal.start(failing_id)
+        # the server crashes: the result kept in memory is lost
+        os.close(webserver.result_store.segment)
+        webserver.result_store.segment = None
+        webserver.job_journal.close()
+
+        # a restart continues the job ids and queues the unfinished jobs again, with the
+        # job whose result was lost
+        webserver = self.create_test_app(config)
+        self.assertEqual(webserver.job_counter.counter, failing_id)
+        self.assertEqual(webserver.job_status[pending_id], "running")
+        jobs = [webserver.job_queue.get(block=False) for _ in range(2)]
+        self.assertEqual(sorted((job.job_id, job.type, job.data) for job in jobs),
+                         [(lost_id, "global_mean", data), (pending_id, "states_mean", data)])
+        self.assertTrue(webserver.job_queue.empty())
+        # the job started too many times is done with an error
+        self.assertEqual(webserver.job_status[failing_id], "done")
+        self.assertEqual(json.loads(webserver.result_store.get(failing_id).data)["status"],
+                         "error")
+        for job in jobs:
+            webserver.job_queue.put(job)
+        runner = self.runner_for(webserver)
+        runner.find_job()
+        runner.find_job()
+        client = webserver.test_client()
+        self.assertEqual(client.post('/api/global_mean', json=data).get_json()["job_id"],
+                         failing_id + 1)
+        # a clean stop writes the results in memory to disk
+        webserver.result_store.close()
+        webserver.job_journal.close()
+
+        webserver = self.create_test_app(config)
+        self.assertEqual(webserver.job_queue.qsize(), 1)
+        client = webserver.test_client()
+        self.assertEqual(client.get(f'/api/get_results/{lost_id}').get_json(),
+                         {"status": "done", "data": {"global_mean": 33.9076923076923}})
+        self.assertEqual(client.get(f'/api/get_results/{pending_id}').get_json()["status"], "done")
+        webserver.result_store.close()
+        webserver.job_journal.close()